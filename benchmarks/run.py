@@ -0,0 +1,230 @@
+"""
+Offline benchmark suite of collection scanner, run on the indexed fake collection backend
+
+Basic usage (from the repository root):
+
+python -m benchmarks.run --records 200000 --output results/$(git rev-parse --short HEAD).json
+python -m benchmarks.run --records 200000 --compare results/<previous commit>.json
+
+Each benchmark is run --repeat times on freshly created scanners and the median duration is reported.
+With --latency, each request to the fake backend sleeps the given seconds, which is useful for measuring
+the effect of concurrency features (fetch_workers, prefetch) on network bound scans. With --http, the backend
+is accessed through the local http stand-in server (see collection_scanner/tests/server.py).
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner, CollectionCounter
+from collection_scanner.tests.indexed import IndexedFakeClient, generate_samples, partition_samples
+from collection_scanner.tests.server import CollectionsServer
+
+
+PROJECT_ID = '10'
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+class Environment(object):
+    """
+    Fake hubstorage backends shared by all benchmarks
+    """
+    def __init__(self, records, record_size, partitions, latency, http=False):
+        samples = generate_samples(records, record_size=record_size)
+        secondary = [(key, {'extra': key[::-1]}) for key, _ in samples[::3]]
+        self.keys = sorted(key for key, _ in samples)
+        collections = {}
+        collections.update(partition_samples('main', samples, 0))
+        collections.update(partition_samples('partitioned', samples, partitions))
+        collections.update(partition_samples('secondary', secondary, 0))
+        self.client = IndexedFakeClient(collections, latency=latency)
+        self.server = None
+        if http:
+            self.server = CollectionsServer(collections, latency=latency).start()
+            os.environ['SHUB_STORAGE'] = self.server.url
+
+    def close(self):
+        if self.server is not None:
+            self.server.stop()
+
+    def run(self, func, **kwargs):
+        if self.server is not None:
+            return func(self, **kwargs)
+        with patch('collection_scanner.scanner.ScrapinghubClient') as scanner_client, \
+                patch('collection_scanner.counter.ScrapinghubClient') as counter_client:
+            scanner_client.return_value._hsclient = self.client
+            counter_client.return_value._hsclient = self.client
+            return func(self, **kwargs)
+
+
+def _scan(collection_name, **kwargs):
+    scanner = CollectionScanner(collection_name, project_id=PROJECT_ID, apikey='apikey', **kwargs)
+    count = sum(len(batch) for batch in scanner.scan_collection_batches())
+    scanner.close()
+    return count
+
+
+@benchmark
+def full_scan(env):
+    return _scan('main', meta=['_key', '_ts'])
+
+
+@benchmark
+def full_scan_prefetch(env):
+    return _scan('main', meta=['_key', '_ts'], prefetch=2)
+
+
+@benchmark
+def partitioned_scan(env):
+    return _scan('partitioned', meta=['_key'])
+
+
+@benchmark
+def partitioned_scan_concurrent(env):
+    return _scan('partitioned', meta=['_key'], fetch_workers=8)
+
+
+@benchmark
+def random_mode(env):
+    scanner = CollectionScanner('partitioned', project_id=PROJECT_ID, apikey='apikey', batchsize=100,
+                                max_next_records=100, meta=['_key'])
+    count = 0
+    # the startafter series of a scanner must be increasing
+    for startafter in sorted(random.Random(0).sample(env.keys, 100)):
+        scanner.reset()
+        scanner.set_startafter(startafter)
+        count += sum(1 for _ in scanner.get_new_batch(random_mode=True))
+    scanner.close()
+    return count
+
+
+@benchmark
+def exclude_prefixes_scan(env):
+    # excludes half of the key space in 128 separated ranges
+    exclude_prefixes = ['%.2x' % i for i in range(0, 256, 2)]
+    return _scan('main', meta=['_key'], exclude_prefixes=exclude_prefixes)
+
+
+@benchmark
+def secondary_join(env):
+    return _scan('main', meta=['_key'], secondary_collections=['secondary'])
+
+
+@benchmark
+def counter_count(env):
+    counter = CollectionCounter('partitioned', project_id=PROJECT_ID, apikey='apikey')
+    return counter.count(prefix=['a', 'b', 'c'])
+
+
+@benchmark
+def counter_fast_count(env):
+    counter = CollectionCounter('partitioned', project_id=PROJECT_ID, apikey='apikey')
+    return counter.fast_count()
+
+
+@benchmark
+def counter_get_prefixes(env):
+    counter = CollectionCounter('partitioned', project_id=PROJECT_ID, apikey='apikey')
+    return len(list(counter.get_prefixes(3)))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(env, names, repeat):
+    results = {}
+    for name in names:
+        durations = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            records = env.run(BENCHMARKS[name])
+            durations.append(time.perf_counter() - started)
+        median = statistics.median(durations)
+        results[name] = {
+            'seconds': median,
+            'min_seconds': min(durations),
+            'records': records,
+            'records_per_second': records / median if median else None,
+        }
+        print('{:<32}{:>10.3f} s{:>12} records{:>14.0f} records/s'.format(
+              name, median, records, results[name]['records_per_second'] or 0))
+    return results
+
+
+def compare(results, previous):
+    print('\n{:<32}{:>12}{:>12}{:>10}'.format('benchmark', 'previous', 'current', 'change'))
+    for name, result in results.items():
+        if name not in previous['results']:
+            continue
+        before = previous['results'][name]['seconds']
+        print('{:<32}{:>12.3f}{:>12.3f}{:>+9.1f}%'.format(name, before, result['seconds'],
+                                                         100 * (result['seconds'] - before) / before))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100000, help='number of records of the main collection')
+    parser.add_argument('--record-size', type=int, default=100, help='approximate size of each record, in bytes')
+    parser.add_argument('--partitions', type=int, default=4, help='number of partitions of partitioned collection')
+    parser.add_argument('--latency', type=float, default=0, help='seconds slept by the backend on each request')
+    parser.add_argument('--http', action='store_true', help='access the backend through the local http server, '
+                        'in order to include http and decoding costs')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each benchmark')
+    parser.add_argument('--output', help='save results as json in the given file')
+    parser.add_argument('--compare', help='compare with the results saved in the given file')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run. All by default: {}'.format(
+                        ', '.join(BENCHMARKS)))
+    args = parser.parse_args(argv)
+
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+    params = {'records': args.records, 'record_size': args.record_size, 'partitions': args.partitions,
+              'latency': args.latency, 'http': args.http, 'repeat': args.repeat}
+    env = Environment(args.records, args.record_size, args.partitions, args.latency, args.http)
+    try:
+        results = run_benchmarks(env, names, args.repeat)
+    finally:
+        env.close()
+    report = {
+        'commit': get_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'params': params,
+        'results': results,
+    }
+    if args.output:
+        dirname = os.path.dirname(args.output)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous['params'] != params:
+            print('Warning: compared results were obtained with different params: {}'.format(previous['params']),
+                  file=sys.stderr)
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 from .scanner import CollectionScanner, DEFAULT_BATCHSIZE
 from .counter import CollectionCounter
+from .aio import AsyncCollectionScanner, AsyncCollectionCounter
+from .parallel import ParallelCollectionScanner
 
 __version__ = '0.5.0'
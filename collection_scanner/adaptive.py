@@ -0,0 +1,78 @@
+"""
+Adaptive sizing of the number of records requested to hubstorage on each call
+
+Basic usage:
+
+from collection_scanner import CollectionScanner
+from collection_scanner.adaptive import AdaptiveNextRecords
+
+scanner = CollectionScanner(<collection name>, adaptive_next_records=AdaptiveNextRecords(100, 20000, target_latency=2),
+                            **kwargs)
+"""
+import threading
+
+from .stats import ScanHook
+
+
+__all__ = ['AdaptiveNextRecords']
+
+
+class AdaptiveNextRecords(ScanHook):
+    """
+    Proportional controller of the max_next_records scanner value. Each read call to hubstorage is measured, and
+    the next value is the one that would have hit the target with the measured performance, smoothed and bounded.
+    """
+    # max factor of change of the value on a single update
+    MAX_STEP = 2.0
+
+    def __init__(self, min_next_records=100, max_next_records=10000, target_latency=None, target_rate=None,
+                 smoothing=0.5):
+        """
+        min_next_records, max_next_records - bounds of the value
+        target_latency - target duration of each read call, in seconds
+        target_rate - target records per second of each read call. If neither target is given, target_latency
+                defaults to 1 second.
+        smoothing - weight of each new measure, between 0 and 1
+        """
+        if target_latency and target_rate:
+            raise ValueError('Only one of target_latency and target_rate can be given')
+        if not target_rate:
+            target_latency = target_latency or 1.0
+        self.min_next_records = min_next_records
+        self.max_next_records = max_next_records
+        self.target_latency = target_latency
+        self.target_rate = target_rate
+        self.smoothing = smoothing
+        self._value = float(min_next_records)
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return int(self._value)
+
+    def start(self, value):
+        """
+        Sets the initial value
+        """
+        self._value = float(self._bound(value))
+
+    def _bound(self, value):
+        return max(self.min_next_records, min(self.max_next_records, value))
+
+    def on_request(self, colname, requested, records, seconds):
+        self.update(requested, len(records), seconds)
+
+    def update(self, requested, records, seconds):
+        """
+        Updates value with the measure of a read call of requested records, which returned the given
+        number of records in the given seconds. Incomplete reads (end of collection) are not taken into account.
+        """
+        if not records or records < requested or seconds <= 0:
+            return
+        if self.target_rate:
+            ratio = self.target_rate / (records / seconds)
+        else:
+            ratio = self.target_latency / seconds
+        ratio = max(1 / self.MAX_STEP, min(self.MAX_STEP, ratio))
+        with self._lock:
+            self._value = self._bound((1 - self.smoothing) * self._value + self.smoothing * requested * ratio)
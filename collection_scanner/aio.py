@@ -0,0 +1,166 @@
+"""
+Asyncio interface for collection scanner and counter
+
+Basic usage:
+
+from collection_scanner import AsyncCollectionScanner
+
+scanner = AsyncCollectionScanner(<collection name>, project_id=<project id>, **kwargs)
+async for batch in scanner.scan_collection_batches():
+    for record in batch:
+        ...
+await scanner.close()
+
+Hubstorage client is blocking, so reads are run in an executor. The event loop is never blocked, so a single
+process can drive many scans at the same time. Partition and secondary collection blocks are fetched concurrently.
+"""
+import time
+import asyncio
+import random
+from functools import partial
+
+from .scanner import CollectionScanner
+from .counter import CollectionCounter
+from .utils import generate_prefixes
+from .columnar import num_rows
+
+
+__all__ = ['AsyncCollectionScanner', 'AsyncCollectionCounter']
+
+# default size of the thread pools used to read partitions and secondary collections concurrently
+DEFAULT_FETCH_WORKERS = 8
+
+
+class AsyncCollectionScanner(object):
+    """
+    Async version of CollectionScanner
+    """
+    def __init__(self, collection_name, scanner_class=CollectionScanner, executor=None, **kwargs):
+        """
+        collection_name - target collection
+        scanner_class - the CollectionScanner class (or subclass, i.e. with secondary collections) to wrap
+        executor - the concurrent.futures executor where the blocking reads are run. If None, use the loop default one.
+        **kwargs - the same arguments accepted by scanner_class (project_id, apikey, batchsize, count, startafter,
+                stopbefore, exclude_prefixes, startts, endts, etc). fetch_workers defaults here to DEFAULT_FETCH_WORKERS.
+        """
+        kwargs.setdefault('fetch_workers', DEFAULT_FETCH_WORKERS)
+        self.scanner = scanner_class(collection_name, **kwargs)
+        self.executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def get_new_batch(self, random_mode=False, columnar=False, fields=None):
+        """
+        Returns the next batch as a list of records, or as a columnar batch if columnar is given (see columnar.py)
+        """
+        return await self._run(self.scanner._read_batch, random_mode, columnar, fields)
+
+    async def scan_collection_batches(self, columnar=False, fields=None):
+        while self.scanner.is_enabled:
+            batch = await self.get_new_batch(columnar=columnar, fields=fields)
+            if num_rows(batch):
+                yielded = time.time()
+                yield batch
+                self.scanner.stats.consumer_seconds += time.time() - yielded
+            await self._run(self.scanner._batch_done)
+
+    async def sample(self, n, **kwargs):
+        """
+        Approximately uniform random sample of up to n records (see CollectionScanner.sample)
+        """
+        return await self._run(self.scanner.sample, n, **kwargs)
+
+    def set_startafter(self, startafter):
+        self.scanner.set_startafter(startafter)
+
+    def reset(self):
+        self.scanner.reset()
+
+    async def close(self):
+        await self._run(self.scanner.close)
+
+    @property
+    def scanned_count(self):
+        return self.scanner.scanned_count
+
+    @property
+    def is_enabled(self):
+        return self.scanner.is_enabled
+
+    @property
+    def lastkey(self):
+        return self.scanner.lastkey
+
+    @property
+    def stats(self):
+        return self.scanner.stats
+
+
+class AsyncCollectionCounter(object):
+    """
+    Async version of CollectionCounter. Partitions are counted concurrently.
+    """
+    def __init__(self, collection_name, executor=None, **kwargs):
+        """
+        collection_name - target collection
+        executor - the concurrent.futures executor where the blocking requests are run. If None, use the loop
+                default one.
+        **kwargs - the same arguments accepted by CollectionCounter
+        """
+        self.counter = CollectionCounter(collection_name, **kwargs)
+        self.executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def count(self, *args, **kwargs):
+        """
+        Real count: count on all partitions concurrently, and sum (see CollectionCounter.count)
+        """
+        return await self._run(self.counter.count, *args, **kwargs)
+
+    async def fast_count(self, *args, **kwargs):
+        """
+        Fast count: pick a random partition, count on it, and multiply by number of partitions
+        """
+        col = random.choice(self.counter.collections)
+        return await self._run(col.count, *args, **kwargs) * len(self.counter.collections)
+
+    async def estimate_count(self, samples=4, confidence=0.95, **kwargs):
+        """
+        Sampled count with confidence interval (see CollectionCounter.estimate_count)
+        """
+        return await self._run(self.counter.estimate_count, samples, confidence, **kwargs)
+
+    async def get_prefixes(self, codelen, fast=False, **kwargs):
+        """
+        Generate all prefixes of given codelen. If fast is True, it will pick only
+        one partition. Otherwise prefixes are generated from all partitions concurrently.
+        """
+        cols = [random.choice(self.counter.collections)] if fast else self.counter.collections
+        results = await asyncio.gather(*[self._run(lambda c=col: list(generate_prefixes(c, codelen, **kwargs)))
+                                         for col in cols])
+        prefixes = set()
+        for result in results:
+            for prefix in result:
+                if prefix not in prefixes:
+                    prefixes.add(prefix)
+                    yield prefix
+
+    async def discover_prefixes(self, codelen, block=1, index=None, **kwargs):
+        """
+        Sorted list of prefixes, discovered level by level (see CollectionCounter.discover_prefixes)
+        """
+        return await self._run(self.counter.discover_prefixes, codelen, block=block, index=index, **kwargs)
+
+    async def count_by_prefix(self, codelen, block=1, index=None, **kwargs):
+        """
+        Record counts by prefix (see CollectionCounter.count_by_prefix)
+        """
+        return await self._run(self.counter.count_by_prefix, codelen, block=block, index=index, **kwargs)
+
+    async def close(self):
+        await self._run(self.counter.close)
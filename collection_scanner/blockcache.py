@@ -0,0 +1,124 @@
+"""
+Persistent local cache of collection blocks, for jobs that scan the same collections repeatedly
+
+Basic usage:
+
+from collection_scanner import CollectionScanner
+from collection_scanner.blockcache import SQLiteBlockCache
+
+cache = SQLiteBlockCache('/path/to/blocks.db', ttl=6 * 3600, refresh_after=600, max_bytes=2 * 1024 ** 3)
+scanner = CollectionScanner(<collection name>, block_cache=cache, **kwargs)
+
+Each block read from hubstorage is stored under its collection (or partition) name, startafter key and the
+normalized get arguments, so it is only reused by scans that request exactly the same block.
+Entries older than ttl are discarded. Entries older than refresh_after are refreshed before being used, by
+requesting only the records of the block key range with _ts newer than the cached snapshot. Deleted records
+are not detected by refreshes, only by ttl expiration.
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from .utils import normalize_kwargs
+
+
+__all__ = ['SQLiteBlockCache']
+
+# snapshot times are taken this number of seconds before the read, in order to cover clock differences with server
+SNAPSHOT_MARGIN = 60
+
+log = logging.getLogger(__name__)
+
+
+class SQLiteBlockCache(object):
+    def __init__(self, path, ttl=86400, refresh_after=None, max_bytes=1024 ** 3):
+        """
+        path - path of the SQLite database
+        ttl - max age of cached blocks, in seconds
+        refresh_after - age in seconds after which a cached block is refreshed before being used. If None,
+                cached blocks are used without refresh until they expire.
+        max_bytes - max total size of cached blocks. Least recently used ones are evicted first.
+        """
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS blocks (id TEXT PRIMARY KEY, colname TEXT, fetched_at REAL, '
+                               'last_used REAL, size INTEGER, data BLOB)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS blocks_last_used ON blocks (last_used)')
+
+    @staticmethod
+    def _block_id(colname, startafter, kwargs):
+        return hashlib.sha1(json.dumps([colname, startafter, normalize_kwargs(kwargs)]).encode()).hexdigest()
+
+    def get(self, colname, startafter, kwargs):
+        """
+        Returns a tuple (records, fetched_at) for the given block, or None if not cached. fetched_at is
+        the snapshot time, in epoch millisecs.
+        """
+        block_id = self._block_id(colname, startafter, kwargs)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT fetched_at, data FROM blocks WHERE id = ?', (block_id,)).fetchone()
+            if row is None:
+                return None
+            if now - row[0] / 1000 > self.ttl:
+                self._conn.execute('DELETE FROM blocks WHERE id = ?', (block_id,))
+                return None
+            self._conn.execute('UPDATE blocks SET last_used = ? WHERE id = ?', (now, block_id))
+        return json.loads(row[1]), row[0]
+
+    @staticmethod
+    def snapshot_time():
+        """
+        Returns the snapshot time of a block read now, in epoch millisecs
+        """
+        return int((time.time() - SNAPSHOT_MARGIN) * 1000)
+
+    def needs_refresh(self, fetched_at):
+        return self.refresh_after is not None and time.time() - fetched_at / 1000 > self.refresh_after
+
+    def put(self, colname, startafter, kwargs, records, fetched_at):
+        """
+        Stores a block, read from hubstorage at fetched_at epoch millisecs
+        """
+        try:
+            data = json.dumps(records)
+        except TypeError:
+            log.warning('Block of %s after %s is not json serializable, not cached', colname, startafter)
+            return
+        block_id = self._block_id(colname, startafter, kwargs)
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO blocks (id, colname, fetched_at, last_used, size, data) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', (block_id, colname, fetched_at, time.time(), len(data), data))
+            self._evict()
+
+    def _evict(self):
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blocks').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for block_id, size in self._conn.execute('SELECT id, size FROM blocks ORDER BY last_used').fetchall():
+            self._conn.execute('DELETE FROM blocks WHERE id = ?', (block_id,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    @property
+    def size(self):
+        """
+        Total size of cached blocks, in bytes
+        """
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blocks').fetchone()[0]
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM blocks')
+
+    def close(self):
+        self._conn.close()
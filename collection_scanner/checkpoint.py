@@ -0,0 +1,99 @@
+"""
+Durable storage of scanner state, in order to resume crashed scans
+
+Basic usage:
+
+from collection_scanner import CollectionScanner
+from collection_scanner.checkpoint import SQLiteCheckpointStore
+
+store = SQLiteCheckpointStore('/path/to/checkpoints.db')
+scanner = CollectionScanner(<collection name>, checkpoint_store=store, **kwargs)
+for batch in scanner.scan_collection_batches():
+    ...
+
+If a checkpoint is found in the store under the scanner checkpoint name, the scanner resumes from it.
+The checkpoint is saved after the consumer has processed each batch (or every checkpoint_interval batches),
+so on resume the last unacknowledged batches may be delivered again.
+
+Stores also keep the _ts watermarks of incremental scans:
+
+scanner = CollectionScanner(<collection name>, watermark_store=store, **kwargs)
+
+Each run only reads the records written since the previous complete run, partition by partition.
+"""
+import json
+import time
+import sqlite3
+import threading
+
+from .utils import read_json_file, write_json_file
+
+
+__all__ = ['FileCheckpointStore', 'SQLiteCheckpointStore']
+
+
+class FileCheckpointStore(object):
+    """
+    Stores checkpoints in a json file, one entry per checkpoint name. File is replaced atomically on each save.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        return read_json_file(self.path)
+
+    def _write(self, checkpoints):
+        write_json_file(self.path, checkpoints, tmp_prefix='.checkpoint')
+
+    def load(self, name):
+        """
+        Returns the saved state for name, or None if there is no such checkpoint
+        """
+        with self._lock:
+            return self._read().get(name)
+
+    def save(self, name, state):
+        with self._lock:
+            checkpoints = self._read()
+            checkpoints[name] = state
+            self._write(checkpoints)
+
+    def delete(self, name):
+        with self._lock:
+            checkpoints = self._read()
+            if checkpoints.pop(name, None) is not None:
+                self._write(checkpoints)
+
+
+class SQLiteCheckpointStore(object):
+    """
+    Stores checkpoints in a SQLite database
+    """
+    def __init__(self, path, table='checkpoints'):
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS {} (name TEXT PRIMARY KEY, state TEXT, updated REAL)'
+                               .format(table))
+
+    def load(self, name):
+        """
+        Returns the saved state for name, or None if there is no such checkpoint
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT state FROM {} WHERE name = ?'.format(self.table), (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, name, state):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO {} (name, state, updated) VALUES (?, ?, ?)'.format(self.table),
+                               (name, json.dumps(state), time.time()))
+
+    def delete(self, name):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM {} WHERE name = ?'.format(self.table), (name,))
+
+    def close(self):
+        self._conn.close()
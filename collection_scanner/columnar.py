@@ -0,0 +1,82 @@
+"""
+Columnar batches, for analytics consumers
+
+Basic usage:
+
+from collection_scanner import CollectionScanner
+
+scanner = CollectionScanner(<collection name>, meta=['_key', '_ts'], **kwargs)
+for batch in scanner.scan_collection_batches(columnar=True, fields=['_key', '_ts', 'price']):
+    keys, timestamps, prices = batch['_key'], batch['_ts'], batch['price']
+
+With columnar=True, each batch is a dict of columns by field name: _ts is an array.array of 64 bits ints (that
+numpy.frombuffer() can wrap without copy), and other fields are lists, with None where a record lacks the field.
+With columnar='arrow', each batch is a pyarrow RecordBatch, with _key typed as string and _ts as timestamp in
+milliseconds (requires pyarrow).
+
+Records are appended to the columns as they are read, so the records of a batch are never all held as dicts.
+If fields is given, only those fields are kept. Otherwise, columns are added as new fields are found.
+"""
+from array import array
+from collections import OrderedDict
+
+
+__all__ = ['ColumnBuilder', 'num_rows']
+
+COLUMNAR_FORMATS = (True, 'arrow')
+
+
+class ColumnBuilder(object):
+    def __init__(self, fields=None):
+        """
+        fields - list of fields to keep. If None, all fields are kept.
+        """
+        self.fields = list(fields) if fields is not None else None
+        self.columns = OrderedDict((name, self._new_column(name, 0)) for name in self.fields or [])
+        self.length = 0
+
+    @staticmethod
+    def _new_column(name, length):
+        if name == '_ts':
+            return array('q', [0] * length)
+        return [None] * length
+
+    def append(self, record):
+        columns = self.columns
+        if self.fields is None:
+            for name in record:
+                if name not in columns:
+                    columns[name] = self._new_column(name, self.length)
+        for name, column in columns.items():
+            value = record.get(name)
+            column.append(value if value is not None or name != '_ts' else 0)
+        self.length += 1
+
+    def build(self, columnar=True):
+        """
+        Returns the columns in the given format (see module docstring)
+        """
+        if columnar == 'arrow':
+            return to_record_batch(self.columns)
+        return self.columns
+
+
+def to_record_batch(columns):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("columnar='arrow' requires pyarrow library")
+    types = {'_key': pyarrow.string(), '_ts': pyarrow.timestamp('ms')}
+    arrays = [pyarrow.array(column, type=types.get(name)) for name, column in columns.items()]
+    return pyarrow.RecordBatch.from_arrays(arrays, names=list(columns))
+
+
+def num_rows(batch):
+    """
+    Returns the number of records of a batch, either a list of records or a columnar batch
+    """
+    if isinstance(batch, list):
+        return len(batch)
+    if isinstance(batch, dict):
+        return len(next(iter(batch.values()))) if batch else 0
+    return batch.num_rows
@@ -0,0 +1,359 @@
+"""
+Coordinated scan of a collection by several workers, possibly in different machines, through key range leases
+
+Basic usage:
+
+from collection_scanner.coordinator import ScanCoordinator, SQLiteLeaseBackend
+
+coordinator = ScanCoordinator(<collection name>, SQLiteLeaseBackend('/shared/path/leases.db'), ranges=64, **kwargs)
+for batch in coordinator.scan_collection_batches():
+    for record in batch:
+        ...
+
+The same code runs on every worker. The key space is split into ranges at key prefixes discovered in the
+collection (or at the given split points) by the first worker, and saved in the lease backend. Each worker claims a
+range for lease_ttl seconds and scans it with a CollectionScanner. After each batch is processed, the worker renews
+its lease and records the scanner state, so a range whose lease expires (i.e. its worker crashed) is claimed by
+another worker and resumed from the last processed batch. When no range is left to claim, idle workers request the
+split of the leased range with most remaining work. Its owner splits it on its next renewal, at one of the finer
+split points discovered in advance, and the upper part is claimed by the idle worker.
+
+Records are delivered at least once: batches being processed by a worker that loses its lease are delivered again
+by the worker that claims the range. Leases are renewed after each batch, so lease_ttl must be well above the time
+needed to read and process a batch.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from .scanner import CollectionScanner
+from .parallel import find_split_points
+from .utils import get_project_id
+
+
+__all__ = ['ScanCoordinator', 'LeaseBackend', 'FileLeaseBackend', 'SQLiteLeaseBackend']
+
+# number of finer split points discovered per initial range, in order to split ranges for idle workers
+STEAL_POINTS = 8
+
+log = logging.getLogger(__name__)
+
+
+class LeaseBackend(object):
+    """
+    Base of lease backends. The ranges of each scan are kept in a json serializable document, read and updated
+    atomically by _transaction(). New backends only need to implement it.
+
+    Each range is a dict with id, start (inclusive lower key, None for the scan lower limit), stop (exclusive
+    upper key, None for the scan upper limit), owner and expires of its lease, state of its scanner and done flag.
+    """
+    @contextmanager
+    def _transaction(self, name):
+        """
+        Yields the document of the given scan (empty dict if it does not exist) under an exclusive lock, and saves
+        it on exit if it was changed
+        """
+        raise NotImplementedError
+
+    def init(self, name, starts, points):
+        """
+        Creates the ranges of a scan, starting at each of the given sorted starts, if not already created.
+        points are the sorted keys where ranges can be split later. Returns True if created.
+        """
+        with self._transaction(name) as doc:
+            if doc:
+                return False
+            bounds = list(starts) + [None]
+            doc['points'] = points
+            doc['next_id'] = len(starts)
+            doc['ranges'] = [self._new_range(i, bounds[i], bounds[i + 1]) for i in range(len(starts))]
+            return True
+
+    @staticmethod
+    def _new_range(range_id, start, stop):
+        return {'id': range_id, 'start': start, 'stop': stop, 'owner': None, 'expires': 0, 'state': None,
+                'done': False}
+
+    def claim(self, name, worker, ttl):
+        """
+        Leases to worker a range never leased or with an expired lease, and returns it. Returns None if there is not
+        any.
+        """
+        now = time.time()
+        with self._transaction(name) as doc:
+            free = [r for r in doc.get('ranges', []) if not r['done'] and (r['owner'] is None or r['expires'] < now)]
+            if not free:
+                return None
+            # ranges never leased first
+            lease = min(free, key=lambda r: (r['owner'] is not None, r['start'] or ''))
+            if lease['owner'] is not None:
+                log.info('Lease of range %d of %s by %s expired', lease['id'], name, lease['owner'])
+            lease['owner'] = worker
+            lease['expires'] = now + ttl
+            return dict(lease)
+
+    def request_split(self, name, worker):
+        """
+        Requests the split of the leased range with most split points ahead of its progress. Its owner splits it on
+        its next renewal, at the middle split point ahead of its exact progress, so the upper part can be claimed.
+        Returns True if a range split was requested.
+        """
+        with self._transaction(name) as doc:
+            best, best_points = None, 0
+            for r in doc.get('ranges', []):
+                if r['done'] or r['owner'] is None or r['owner'] == worker:
+                    continue
+                points = len(self._split_points(doc, r))
+                if points > best_points:
+                    best, best_points = r, points
+            if best is None:
+                return False
+            best['split_requested'] = True
+            return True
+
+    @staticmethod
+    def _split_points(doc, r):
+        progress = max((r['state'] or {}).get('lastkey') or '', r['start'] or '')
+        return [p for p in doc['points'] if p > progress and (r['stop'] is None or p < r['stop'])]
+
+    def renew(self, name, range_id, worker, ttl, state):
+        """
+        Extends the lease of a range and records the scanner state. If a split of the range was requested, it is
+        split. Returns the range, whose stop may have changed, or None if the lease was lost.
+        """
+        with self._transaction(name) as doc:
+            lease = self._get_range(doc, range_id)
+            if lease['owner'] != worker or lease['done']:
+                return None
+            lease['expires'] = time.time() + ttl
+            lease['state'] = state
+            if lease.pop('split_requested', False):
+                points = self._split_points(doc, lease)
+                if points:
+                    split = points[len(points) // 2]
+                    doc['ranges'].append(self._new_range(doc['next_id'], split, lease['stop']))
+                    doc['next_id'] += 1
+                    lease['stop'] = split
+                    log.info('Range %d of %s split at %s', lease['id'], name, split)
+            return dict(lease)
+
+    def complete(self, name, range_id, worker):
+        """
+        Marks a range as scanned. Returns False if the lease was lost.
+        """
+        with self._transaction(name) as doc:
+            lease = self._get_range(doc, range_id)
+            if lease['owner'] != worker:
+                return False
+            lease['done'] = True
+            return True
+
+    def get_ranges(self, name):
+        """
+        Returns the ranges of a scan, sorted by key
+        """
+        with self._transaction(name) as doc:
+            return sorted(doc.get('ranges', []), key=lambda r: r['start'] or '')
+
+    def is_done(self, name):
+        ranges = self.get_ranges(name)
+        return bool(ranges) and all(r['done'] for r in ranges)
+
+    def delete(self, name):
+        with self._transaction(name) as doc:
+            doc.clear()
+
+    @staticmethod
+    def _get_range(doc, range_id):
+        for r in doc['ranges']:
+            if r['id'] == range_id:
+                return r
+        raise KeyError(range_id)
+
+
+class FileLeaseBackend(LeaseBackend):
+    """
+    Keeps the ranges of each scan in a json file of the given directory, i.e. in a shared filesystem. Files are
+    locked by exclusive creation of a lock file, and replaced atomically.
+    """
+    def __init__(self, directory, lock_timeout=30, stale_lock=60):
+        """
+        directory - directory of the files
+        lock_timeout - max seconds waited for a lock
+        stale_lock - age in seconds after which a lock file is considered left by a crashed worker, and removed
+        """
+        self.directory = directory
+        self.lock_timeout = lock_timeout
+        self.stale_lock = stale_lock
+
+    @contextmanager
+    def _lock(self, name):
+        path = os.path.join(self.directory, '{}.lock'.format(name))
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) > self.stale_lock:
+                        log.warning('Removing stale lock %s', path)
+                        os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.time() > deadline:
+                    raise TimeoutError('Could not lock {}'.format(path))
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.remove(path)
+
+    @contextmanager
+    def _transaction(self, name):
+        path = os.path.join(self.directory, '{}.json'.format(name))
+        with self._lock(name):
+            try:
+                with open(path) as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = '{}'
+            doc = json.loads(data)
+            yield doc
+            if json.dumps(doc) != data:
+                fd, tmppath = tempfile.mkstemp(dir=self.directory, prefix='.lease')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(doc, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmppath, path)
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """
+    Keeps the ranges of each scan in a SQLite database
+    """
+    def __init__(self, path, timeout=30):
+        """
+        path - path of the database
+        timeout - max seconds waited for a lock
+        """
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, doc TEXT)')
+
+    @contextmanager
+    def _transaction(self, name):
+        # the lock serializes the transactions of threads sharing the connection, and SQLite those of processes
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT doc FROM leases WHERE name = ?', (name,)).fetchone()
+                data = row[0] if row else '{}'
+                doc = json.loads(data)
+                yield doc
+                if json.dumps(doc) != data:
+                    self._conn.execute('INSERT OR REPLACE INTO leases VALUES (?, ?)', (name, json.dumps(doc)))
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._conn.execute('COMMIT')
+
+
+class ScanCoordinator(object):
+    def __init__(self, collection_name, backend, scan_name=None, ranges=16, split_points=None, split_codelen=None,
+                 lease_ttl=300, poll_interval=10, scanner_class=CollectionScanner, **kwargs):
+        """
+        collection_name - target collection
+        backend - a LeaseBackend where ranges are leased
+        scan_name - name of the scan in the backend. By default, the collection name. Workers of the same scan
+                must use the same name and arguments.
+        ranges - number of ranges the key space is initially split into
+        split_points - sorted list of keys where ranges can be split. If not given, they are selected among the key
+                prefixes found in the collection. Initial ranges are split at some of them, and the rest are
+                used for splitting ranges for idle workers.
+        split_codelen - length of the key prefixes used for discovering split points (see ParallelCollectionScanner)
+        lease_ttl - seconds a lease lasts without renewal
+        poll_interval - seconds an idle worker waits before trying again to get a lease, while other workers
+                hold leases that can not be split
+        scanner_class - the CollectionScanner class (or subclass) to run on each range
+        **kwargs - the same arguments accepted by scanner_class, except count. startafter, start and stopbefore
+                define the limits of the full scan.
+        """
+        if kwargs.get('count'):
+            raise ValueError('count is not supported on coordinated scans')
+        self.collection_name = collection_name
+        self.backend = backend
+        self.scan_name = scan_name or collection_name
+        self.ranges = ranges
+        self.split_points = split_points
+        self.split_codelen = split_codelen
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.scanner_class = scanner_class
+        kwargs['project_id'] = kwargs.get('project_id') or get_project_id()
+        self.kwargs = kwargs
+
+    def setup(self):
+        """
+        Splits the key space and saves the ranges in the backend, unless another worker already did
+        """
+        if self.backend.get_ranges(self.scan_name):
+            return
+        points = find_split_points(self.collection_name, self.ranges * STEAL_POINTS, self.kwargs, self.split_points,
+                                   self.split_codelen)
+        starts = [None] + sorted(set(points[len(points) * i // self.ranges] for i in range(1, self.ranges) if points))
+        if self.backend.init(self.scan_name, starts, points):
+            log.info('Scan %s split into %d ranges', self.scan_name, len(starts))
+
+    def scan_collection_batches(self, worker=None):
+        """
+        Scans ranges until all of them are done, and generates their batches
+        worker - unique name of this worker. By default, generated from host name and process id.
+        """
+        worker = worker or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.setup()
+        while True:
+            lease = self.backend.claim(self.scan_name, worker, self.lease_ttl)
+            if lease is None:
+                if self.backend.is_done(self.scan_name):
+                    return
+                self.backend.request_split(self.scan_name, worker)
+                time.sleep(self.poll_interval)
+                continue
+            yield from self._scan_range(lease, worker)
+
+    def _scan_range(self, lease, worker):
+        kwargs = self.kwargs.copy()
+        if lease['start'] is not None:
+            kwargs.pop('startafter', None)
+            kwargs['start'] = lease['start']
+        kwargs['stopbefore'] = lease['stop'] if lease['stop'] is not None else self.kwargs.get('stopbefore')
+        log.info('Worker %s scanning range %d from %s to %s', worker, lease['id'], lease['start'], lease['stop'])
+        scanner = self.scanner_class(self.collection_name, **kwargs)
+        if lease['state'] is not None:
+            scanner.set_state(lease['state'])
+            log.info('Range %d resumed after key %s', lease['id'], scanner.lastkey)
+        stop = lease['stop']
+        try:
+            for batch in scanner.scan_collection_batches():
+                yield batch
+                lease = self.backend.renew(self.scan_name, lease['id'], worker, self.lease_ttl, scanner.get_state())
+                if lease is None:
+                    log.warning('Worker %s lost its lease', worker)
+                    return
+                if lease['stop'] != stop:
+                    stop = lease['stop']
+                    scanner.set_stopbefore(stop)
+            self.backend.complete(self.scan_name, lease['id'], worker)
+        finally:
+            scanner.close()
@@ -1,26 +1,108 @@
 """
 Allow to count on partitioned collections
+
+Basic usage:
+
+from collection_scanner import CollectionCounter
+from collection_scanner.counter import PrefixIndex
+
+counter = CollectionCounter(<collection name>, cache_ttl=300, **kwargs)
+counter.count(prefix=['AD'])
+low, high = counter.estimate_count(samples=8, confidence=0.95, prefix=['AD'])[1:3]
+histogram = counter.count_by_prefix(3, index=PrefixIndex('/path/to/prefixes.json'))
 """
+import math
+import time
 import logging
+import threading
+from statistics import NormalDist
+from collections import namedtuple, OrderedDict
 from scrapinghub import ScrapinghubClient
 import random
-from .utils import get_num_partitions, generate_prefixes, get_project_id
+from .utils import (
+    get_num_partitions,
+    generate_prefixes,
+    discover_prefixes,
+    get_project_id,
+    normalize_kwargs,
+    restrict_prefixes,
+    read_json_file,
+    write_json_file,
+    WorkerPool,
+)
+from .registry import registry
 
 
-__all__ = ['CollectionCounter']
+__all__ = ['CollectionCounter', 'CountEstimate', 'PrefixIndex']
 
 
 log = logging.getLogger(__name__)
 
 
+CountEstimate = namedtuple('CountEstimate', ['estimate', 'low', 'high', 'sampled', 'partitions'])
+CountEstimate.__doc__ = """
+Estimated count, with the bounds of its confidence interval, and the number of sampled and total partitions.
+Bounds are None when the interval can not be computed (a single partition sampled out of many).
+"""
+
+
+class PrefixIndex(object):
+    """
+    Stores discovered prefixes in a json file, by collection, arguments and prefix length, for reuse by later
+    discoveries. File is replaced atomically on each save.
+    """
+    def __init__(self, path, ttl=None):
+        """
+        path - path of the json file
+        ttl - max age of saved prefixes, in seconds. If None, they never expire.
+        """
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _read(self):
+        return read_json_file(self.path)
+
+    def _write(self, data):
+        write_json_file(self.path, data, tmp_prefix='.prefixes')
+
+    @staticmethod
+    def _entry_key(collection_name, kwargs):
+        return '{}:{}'.format(collection_name, normalize_kwargs(kwargs))
+
+    def load(self, collection_name, codelen, kwargs):
+        """
+        Returns a tuple (length, prefixes) of the longest saved level not longer than codelen, or None
+        """
+        with self._lock:
+            levels = self._read().get(self._entry_key(collection_name, kwargs), {})
+        now = time.time()
+        for length in sorted((int(length) for length in levels), reverse=True):
+            level = levels[str(length)]
+            if length <= codelen and (self.ttl is None or now - level['created'] < self.ttl):
+                return length, level['prefixes']
+
+    def save(self, collection_name, length, kwargs, prefixes):
+        with self._lock:
+            data = self._read()
+            levels = data.setdefault(self._entry_key(collection_name, kwargs), {})
+            levels[str(length)] = {'created': time.time(), 'prefixes': prefixes}
+            self._write(data)
+
+
 class CollectionCounter(object):
-    def __init__(self, collection_name, project_id=None, apikey=None, autodetect_partitions=True):
+    def __init__(self, collection_name, project_id=None, apikey=None, autodetect_partitions=True, fetch_workers=8,
+                 cache_ttl=0):
         """
         collection_name - target collection
         project_id - target project id
         apikey - hubstorage apikey with access to given project. If None, delegate to scrapinghub lib.
         autodetect_partitions - If provided, autodetect partitioned collection. By default is True. If you want instead to force to read a non-partitioned
                 collection when partitioned version also exists under the same name, use False.
+        fetch_workers - max number of partitions counted concurrently. With 1 or less, they are counted one after
+                another.
+        cache_ttl - if greater than 0, results of count() and estimate_count() are cached by arguments during this
+                number of seconds.
         """
         self.hsc = ScrapinghubClient(apikey)._hsclient
         project_id = project_id or get_project_id()
@@ -36,15 +118,47 @@ class CollectionCounter(object):
 
         if num_partitions:
             for p in range(num_partitions):
-                self.collections.append(self.hsp.collections.new_store("{}_{}".format(collection_name, p)))
+                self.collections.append(registry.get_store(self.hsp, "{}_{}".format(collection_name, p)))
         else:
-            self.collections.append(self.hsp.collections.new_store(collection_name))
+            self.collections.append(registry.get_store(self.hsp, collection_name))
+
+        self.collection_name = collection_name
+        self.fetch_workers = fetch_workers
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        self._pool = WorkerPool(fetch_workers)
+
+    def _map(self, func, items):
+        """
+        Maps func on items, concurrently if fetch_workers is greater than 1
+        """
+        return self._pool.map(func, items)
+
+    def _cached(self, name, func, kwargs):
+        if not self.cache_ttl:
+            return func()
+        key = (name, normalize_kwargs(kwargs))
+        now = time.time()
+        with self._cache_lock:
+            entry = self._cache.get(key)
+        if entry is not None and now - entry[0] < self.cache_ttl:
+            return entry[1]
+        result = func()
+        with self._cache_lock:
+            self._cache[key] = (now, result)
+        return result
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
 
     def count(self, *args, **kwargs):
         """
-        Real count: iterates over all partitions, count on each one, and sum
+        Real count: count on all partitions concurrently, and sum
         """
-        return sum(col.count(*args, **kwargs) for col in self.collections)
+        return self._cached('count:{!r}'.format(args),
+                            lambda: sum(self._map(lambda col: col.count(*args, **kwargs), self.collections)), kwargs)
 
     def fast_count(self, *args, **kwargs):
         """
@@ -54,21 +168,82 @@ class CollectionCounter(object):
         col = random.choice(self.collections)
         return col.count(*args, **kwargs) * len(self.collections)
 
+    def estimate_count(self, samples=4, confidence=0.95, **kwargs):
+        """
+        Sampled count: count concurrently on the given number of randomly chosen partitions, and extrapolate to all.
+        Returns a CountEstimate with the confidence interval of the given level, computed from the variance among
+        the sampled partitions (normal approximation, with finite population correction).
+        """
+        return self._cached('estimate_count:{}:{}'.format(samples, confidence),
+                            lambda: self._estimate_count(samples, confidence, kwargs), kwargs)
+
+    def _estimate_count(self, samples, confidence, kwargs):
+        total = len(self.collections)
+        samples = max(1, min(samples, total))
+        counts = self._map(lambda col: col.count(**kwargs), random.sample(self.collections, samples))
+        estimate = total * sum(counts) / samples
+        if samples == total:
+            return CountEstimate(int(estimate), int(estimate), int(estimate), samples, total)
+        if samples == 1:
+            return CountEstimate(int(round(estimate)), None, None, samples, total)
+        mean = sum(counts) / samples
+        variance = sum((c - mean) ** 2 for c in counts) / (samples - 1)
+        stderr = total * math.sqrt((1 - samples / total) * variance / samples)
+        margin = NormalDist().inv_cdf((1 + confidence) / 2) * stderr
+        return CountEstimate(int(round(estimate)), max(0, int(math.floor(estimate - margin))),
+                             int(math.ceil(estimate + margin)), samples, total)
+
     def get_prefixes(self, codelen, fast=False, **kwargs):
         """
         Generate all prefixes of given codelen. If fast is True, it will pick only
-        one partition. Otherwise will generate prefixes using all ones.
+        one partition. Otherwise prefixes are generated from all partitions concurrently.
         """
         cols = [random.choice(self.collections)] if fast else self.collections
-        gens = [generate_prefixes(col, codelen, **kwargs) for col in cols]
         prefixes = set()
-        while gens:
-            for g in list(gens):
-                try:
-                    prefix = next(g)
-                    if prefix not in prefixes:
-                        prefixes.add(prefix)
-                        yield prefix
-                except StopIteration:
-                    gens.remove(g)
-                    continue
+        for result in self._map(lambda col: list(generate_prefixes(col, codelen, **kwargs)), cols):
+            for prefix in result:
+                if prefix not in prefixes:
+                    prefixes.add(prefix)
+                    yield prefix
+
+    def discover_prefixes(self, codelen, block=1, index=None, level=None, **kwargs):
+        """
+        Returns the sorted list of all prefixes of given codelen, discovered level by level: the prefixes of each
+        length are searched concurrently inside each prefix of the previous length and each partition, so the
+        number of sequential requests is bounded by the number of children of a single prefix instead of the number
+        of prefixes.
+        block - number of keys read on each request. Greater values save requests on collections with few records
+                by prefix.
+        index - an optional PrefixIndex. Discovery starts from the longest level saved there for the same
+                collection and arguments, and discovered levels are saved.
+        level - a tuple (length, prefixes) of an already discovered level, with the same arguments, to start from
+                (i.e. from a previous call with a shorter codelen). If not given, it is searched in index.
+        """
+        on_level = None
+        if index is not None:
+            if level is None:
+                level = index.load(self.collection_name, codelen, kwargs)
+            on_level = lambda length, prefixes: index.save(self.collection_name, length, kwargs, prefixes)
+        return discover_prefixes(self.collections, codelen, block=block, map_func=self._map, level=level,
+                                 on_level=on_level, **kwargs)
+
+    def count_by_prefix(self, codelen, block=1, index=None, **kwargs):
+        """
+        Returns a dict of record counts by key prefix of given codelen, sorted by prefix. Prefixes are discovered
+        with discover_prefixes(), and counted concurrently on all partitions.
+        """
+        prefixes = self.discover_prefixes(codelen, block=block, index=index, **kwargs)
+        user_prefixes = kwargs.pop('prefix', None)
+        if isinstance(user_prefixes, str):
+            user_prefixes = [user_prefixes]
+        tasks = [(col, prefix) for prefix in prefixes for col in self.collections]
+        counts = self._map(lambda task: task[0].count(prefix=restrict_prefixes(task[1], user_prefixes) or [task[1]],
+                                                      **kwargs), tasks)
+        histogram = OrderedDict((prefix, 0) for prefix in prefixes)
+        for (_, prefix), count in zip(tasks, counts):
+            histogram[prefix] += count
+        return histogram
+
+    def close(self):
+        self._pool.shutdown()
+        self.hsc.close()
@@ -0,0 +1,306 @@
+"""
+Streaming export of scanned records to files, with bounded memory
+
+Basic usage:
+
+from collection_scanner import CollectionScanner
+from collection_scanner.export import JsonLinesSink, export
+
+scanner = CollectionScanner(<collection name>, **kwargs)
+with JsonLinesSink('/path/to/export-{part:04d}.jl.gz', compression='gzip', max_bytes=4 * 1024 ** 3) as sink:
+    export(scanner, sink)
+
+Records are serialized and written by a background thread, so the scan does not wait for the disk. The scan
+only blocks when queue_size chunks of chunk_size records are pending to be written, which bounds memory.
+If max_bytes is given, a new file is started whenever the current one reaches that size, and the path must
+contain a {part} placeholder that is formatted with the file number.
+
+MsgpackSink requires msgpack, and ParquetSink and ArrowSink require pyarrow.
+
+Records of scanners in raw mode (see raw.py) are written as is by JsonLinesSink, and decoded by the other sinks.
+"""
+import bz2
+import gzip
+import json
+import lzma
+import queue
+import logging
+import threading
+
+from .raw import RawRecord
+
+__all__ = ['JsonLinesSink', 'MsgpackSink', 'ParquetSink', 'ArrowSink', 'export']
+
+COMPRESSORS = {
+    'gzip': lambda raw: gzip.GzipFile(fileobj=raw, mode='wb'),
+    'bz2': lambda raw: bz2.BZ2File(raw, 'wb'),
+    'xz': lambda raw: lzma.LZMAFile(raw, 'wb'),
+}
+
+log = logging.getLogger(__name__)
+
+
+def export(scanner, sink):
+    """
+    Streams all records of scanner into sink, batch by batch, without building the batches in memory.
+    If the scanner has a checkpoint store, checkpoints are saved by the sink writer thread once the records
+    of the checkpointed batches have been written. Returns the number of exported records.
+    """
+    exported = 0
+    while scanner.is_enabled:
+        for record in scanner.get_new_batch():
+            sink.write(record)
+            exported += 1
+        scanner._batch_done(defer=sink.call_after)
+    sink.flush()
+    return exported
+
+
+class _Sink(object):
+    """
+    Base class of sinks. Subclasses implement _open_file(), _write_chunk() and _close_file().
+    """
+    def __init__(self, path, max_bytes=None, compression=None, chunk_size=1000, queue_size=8):
+        """
+        path - path of the output file. If max_bytes is given, it must contain a {part} placeholder.
+        max_bytes - if given, files are rotated when they reach this size. For compressed streams, the size before
+                compression is used.
+        compression - compression of the output files
+        chunk_size - number of records passed at once to the writer thread
+        queue_size - max number of chunks pending to be written
+        """
+        if max_bytes and '{part' not in path:
+            raise ValueError('path must contain a {part} placeholder in order to rotate files')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.files = []
+        self.records = 0
+        self._raw = None
+        self._chunk = []
+        self._error = None
+        self._closed = False
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, record):
+        if self._error is not None:
+            raise self._error
+        self._chunk.append(record)
+        if len(self._chunk) >= self.chunk_size:
+            self._queue.put(self._chunk)
+            self._chunk = []
+
+    def call_after(self, func):
+        """
+        Calls func from the writer thread, once all records written before are flushed to the file
+        """
+        if self._chunk:
+            self._queue.put(self._chunk)
+            self._chunk = []
+        self._queue.put(func)
+
+    def flush(self):
+        """
+        Waits until all written records are flushed to the file
+        """
+        done = threading.Event()
+        self.call_after(done)
+        done.wait()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        if self._closed:
+            return
+        self.call_after(None)
+        self._thread.join()
+        self._closed = True
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        """
+        Writer thread. Queue items are chunks of records, callables, flush events, or None to finish.
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if self._error is not None:
+                    # after a failure, nothing else is written or called back, but queue is still drained
+                    # so the producer never blocks
+                    continue
+                if isinstance(item, list):
+                    if self._raw is None:
+                        self._start_file()
+                    self._write_chunk(item)
+                    self.records += len(item)
+                    if self.max_bytes and self._file_size() >= self.max_bytes:
+                        self._finish_file()
+                elif item is None:
+                    self._finish_file()
+                else:
+                    if self._raw is not None:
+                        self._flush_file()
+                    if not isinstance(item, threading.Event):
+                        item()
+            except Exception as e:
+                log.exception('Export to %s failed', self.path)
+                self._error = e
+            finally:
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is None:
+                    return
+
+    def _start_file(self):
+        path = self.path.format(part=len(self.files))
+        self._raw = open(path, 'wb')
+        self.files.append(path)
+        self._open_file(self._raw)
+
+    def _finish_file(self):
+        if self._raw is not None:
+            self._close_file()
+            self._raw.close()
+            self._raw = None
+
+    def _open_file(self, raw):
+        raise NotImplementedError
+
+    def _write_chunk(self, records):
+        raise NotImplementedError
+
+    def _flush_file(self):
+        self._raw.flush()
+
+    def _close_file(self):
+        pass
+
+    def _file_size(self):
+        return self._raw.tell()
+
+
+class _StreamSink(_Sink):
+    """
+    Sink of a stream of serialized records, optionally compressed with gzip, bz2 or xz
+    """
+    def __init__(self, path, compression=None, **kwargs):
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError('Unsupported compression: {}'.format(compression))
+        self._file = None
+        self._written = 0
+        super().__init__(path, compression=compression, **kwargs)
+
+    def _open_file(self, raw):
+        self._file = COMPRESSORS[self.compression](raw) if self.compression else raw
+        self._written = 0
+
+    def _write_chunk(self, records):
+        data = self._serialize(records)
+        self._file.write(data)
+        self._written += len(data)
+
+    def _file_size(self):
+        # compressors buffer their output, so the size before compression is the only accurate one
+        return self._written
+
+    def _flush_file(self):
+        self._file.flush()
+        if self._file is not self._raw:
+            self._raw.flush()
+
+    def _close_file(self):
+        if self._file is not self._raw:
+            self._file.close()
+        self._file = None
+
+    def _serialize(self, records):
+        raise NotImplementedError
+
+
+class JsonLinesSink(_StreamSink):
+    """
+    Writes records as json lines
+    """
+    def _serialize(self, records):
+        return ''.join((r.data if isinstance(r, RawRecord) else json.dumps(r, default=str)) + '\n'
+                       for r in records).encode('utf-8')
+
+
+class MsgpackSink(_StreamSink):
+    """
+    Writes records as a stream of msgpack maps
+    """
+    def __init__(self, path, **kwargs):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError('MsgpackSink requires msgpack library')
+        self._packer = msgpack.Packer(default=str)
+        super().__init__(path, **kwargs)
+
+    def _serialize(self, records):
+        return b''.join(self._packer.pack(r.decode() if isinstance(r, RawRecord) else r) for r in records)
+
+
+class _ArrowSink(_Sink):
+    """
+    Base of pyarrow based sinks. Each chunk of records is converted to a record batch with the given schema, or
+    with the one inferred from the first chunk. Fields not in the schema are dropped, and missing ones are null.
+    """
+    def __init__(self, path, schema=None, chunk_size=10000, **kwargs):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('{} requires pyarrow library'.format(type(self).__name__))
+        self._pa = pyarrow
+        self.schema = schema
+        self._writer = None
+        super().__init__(path, chunk_size=chunk_size, **kwargs)
+
+    def _write_chunk(self, records):
+        records = [r.decode() if isinstance(r, RawRecord) else r for r in records]
+        table = self._pa.Table.from_pylist(records, schema=self.schema)
+        if self.schema is None:
+            self.schema = table.schema
+        if self._writer is None:
+            self._writer = self._new_writer(self._raw, self.schema)
+        self._writer.write_table(table)
+
+    def _open_file(self, raw):
+        pass
+
+    def _close_file(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _new_writer(self, raw, schema):
+        raise NotImplementedError
+
+
+class ParquetSink(_ArrowSink):
+    """
+    Writes records as parquet files, a row group per chunk. compression is the parquet codec (snappy by default).
+    """
+    def _new_writer(self, raw, schema):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(raw, schema, compression=self.compression or 'snappy')
+
+
+class ArrowSink(_ArrowSink):
+    """
+    Writes records as arrow ipc files. compression is the ipc buffers codec (lz4 or zstd), none by default.
+    """
+    def _new_writer(self, raw, schema):
+        options = self._pa.ipc.IpcWriteOptions(compression=self.compression)
+        return self._pa.ipc.new_file(raw, schema, options=options)
@@ -0,0 +1,190 @@
+"""
+Multi process key range parallel collection scanner
+
+Basic usage:
+
+from collection_scanner import ParallelCollectionScanner
+
+scanner = ParallelCollectionScanner(<collection name>, processes=8, **kwargs)
+for batch in scanner.scan_collection_batches(ordered=False):
+    for record in batch:
+        ...
+
+The key space is split into disjoint ranges, either at given split points or at key prefixes discovered
+in the collection, and each range is scanned by its own CollectionScanner in a pool of processes.
+"""
+import logging
+import multiprocessing
+
+from .scanner import CollectionScanner
+from .counter import CollectionCounter
+from .columnar import num_rows
+from .utils import get_project_id, PrefixSet
+
+
+__all__ = ['ParallelCollectionScanner']
+
+# max length of prefixes tried in order to discover split points
+MAX_SPLIT_CODELEN = 8
+
+log = logging.getLogger(__name__)
+
+# worker process side queues, set by _init_worker
+_queues = None
+
+
+def _init_worker(queues):
+    global _queues
+    _queues = queues
+
+
+def _scan_range(index, scanner_class, collection_name, kwargs, batch_kwargs):
+    queue = _queues[index % len(_queues)]
+    try:
+        scanner = scanner_class(collection_name, **kwargs)
+        for batch in scanner.scan_collection_batches(**batch_kwargs):
+            queue.put((index, batch))
+        scanner.close()
+    except Exception as e:
+        queue.put((index, e))
+    else:
+        queue.put((index, None))
+
+
+def find_split_points(collection_name, splits, kwargs, split_points=None, split_codelen=None):
+    """
+    Returns the sorted list of keys where to split the key space of a scan into the given number of ranges.
+    collection_name - target collection
+    splits - number of ranges
+    kwargs - the scanner arguments. startafter, start, stopbefore, exclude_prefixes and prefix limit the key space.
+    split_points - candidate split points. If not given, they are selected among the key prefixes found in the
+            collection.
+    split_codelen - length of the key prefixes used for discovering split points. If not given, it is increased
+            from 1 until enough prefixes are found.
+    """
+    if split_points is not None:
+        split_points = sorted(split_points)
+    else:
+        split_points = _discover_split_points(collection_name, splits, kwargs, split_codelen)
+    lower = max(kwargs.get('startafter') or '', kwargs.get('start') or '')
+    upper = kwargs.get('stopbefore')
+    exclude_prefixes = PrefixSet(kwargs.get('exclude_prefixes') or [])
+    # a split point inside an excluded prefix may be skipped by the exclusion jump
+    return [p for p in split_points if p > lower and (upper is None or p < upper)
+            and exclude_prefixes.match(p) is None]
+
+
+def _discover_split_points(collection_name, splits, kwargs, split_codelen):
+    counter = CollectionCounter(collection_name, project_id=kwargs.get('project_id'), apikey=kwargs.get('apikey'),
+                                autodetect_partitions=kwargs.get('autodetect_partitions', True))
+    prefix_kwargs = {'prefix': kwargs['prefix']} if 'prefix' in kwargs else {}
+    codelens = [split_codelen] if split_codelen else range(1, MAX_SPLIT_CODELEN + 1)
+    prefixes = []
+    level = None
+    for codelen in codelens:
+        # each try goes on from the level discovered by the previous one
+        prefixes = counter.discover_prefixes(codelen, level=level, startafter=kwargs.get('startafter'),
+                                             **prefix_kwargs)
+        if len(prefixes) >= splits:
+            break
+        level = (codelen, prefixes)
+    counter.close()
+    selected = []
+    for i in range(1, splits):
+        prefix = prefixes[len(prefixes) * i // splits] if prefixes else None
+        if prefix and prefix not in selected:
+            selected.append(prefix)
+    return selected
+
+
+class ParallelCollectionScanner(object):
+    def __init__(self, collection_name, processes=None, splits=None, split_points=None, split_codelen=None,
+                 scanner_class=CollectionScanner, queue_size=4, mp_context=None, **kwargs):
+        """
+        collection_name - target collection
+        processes - number of worker processes. If None, use the number of cpus.
+        splits - number of key ranges to split the key space into. By default, the number of processes.
+        split_points - sorted list of keys (or key prefixes) where to split the key space. If not given, they are
+                selected among the key prefixes found in the collection.
+        split_codelen - length of the key prefixes used for discovering split points. If not given, it is increased
+                from 1 until enough prefixes are found.
+        scanner_class - the CollectionScanner class (or subclass) to run on each range
+        queue_size - max number of batches waiting in each queue for being consumed
+        mp_context - multiprocessing context to use. If None, use the default one.
+        **kwargs - the same arguments accepted by scanner_class, except count. startafter, start and stopbefore
+                define the limits of the full scan.
+        """
+        if kwargs.get('count'):
+            raise ValueError('count is not supported on parallel scans')
+        self.collection_name = collection_name
+        self.mp_context = mp_context or multiprocessing.get_context()
+        self.processes = processes or self.mp_context.cpu_count()
+        self.splits = splits or self.processes
+        self.split_points = split_points
+        self.split_codelen = split_codelen
+        self.scanner_class = scanner_class
+        self.queue_size = queue_size
+        kwargs['project_id'] = kwargs.get('project_id') or get_project_id()
+        self.kwargs = kwargs
+        self.__scanned_count = 0
+
+    def get_split_points(self):
+        """
+        Returns the sorted list of keys where the key space is split
+        """
+        return find_split_points(self.collection_name, self.splits, self.kwargs, self.split_points,
+                                 self.split_codelen)
+
+    def get_ranges(self):
+        """
+        Returns the list of scanner kwargs of each key range, sorted by key
+        """
+        split_points = self.get_split_points()
+        ranges = []
+        for index in range(len(split_points) + 1):
+            kwargs = self.kwargs.copy()
+            if index > 0:
+                kwargs.pop('startafter', None)
+                kwargs['start'] = split_points[index - 1]
+            if index < len(split_points):
+                kwargs['stopbefore'] = split_points[index]
+            ranges.append(kwargs)
+        return ranges
+
+    def scan_collection_batches(self, ordered=False, columnar=False, fields=None):
+        """
+        Scan all ranges in parallel. If ordered is True, batches are generated in key order. Otherwise,
+        they are generated as soon as they are available. columnar and fields are passed to the scanners
+        (see columnar.py); columnar batches are also cheaper to pass between processes.
+        """
+        batch_kwargs = {'columnar': columnar, 'fields': fields}
+        ranges = self.get_ranges()
+        log.info("Scanning %d key ranges with %d processes", len(ranges), self.processes)
+        if ordered:
+            queues = [self.mp_context.Queue(self.queue_size) for _ in ranges]
+        else:
+            queues = [self.mp_context.Queue(self.queue_size * self.processes)]
+        pool = self.mp_context.Pool(self.processes, initializer=_init_worker, initargs=(queues,))
+        try:
+            for index, kwargs in enumerate(ranges):
+                pool.apply_async(_scan_range, (index, self.scanner_class, self.collection_name, kwargs, batch_kwargs))
+            pool.close()
+            pending = len(ranges)
+            while pending:
+                queue = queues[len(ranges) - pending] if ordered else queues[0]
+                index, item = queue.get()
+                if item is None:
+                    pending -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    self.__scanned_count += num_rows(item)
+                    yield item
+            pool.join()
+        finally:
+            pool.terminate()
+        log.info("Total scanned: %d", self.__scanned_count)
+
+    @property
+    def scanned_count(self):
+        return self.__scanned_count
@@ -0,0 +1,218 @@
+"""
+Profiling of scans
+
+Basic usage:
+
+from collection_scanner import CollectionScanner
+
+scanner = CollectionScanner(<collection name>, profile='sampling', profile_path='/tmp/scan-{pid}.stacks', **kwargs)
+for batch in scanner.scan_collection_batches():
+    ...
+scanner.close()
+print(scanner.stats.as_dict()['stage_seconds'])
+
+or, without changing code, run the job with COLLECTION_SCANNER_PROFILE=<mode> (and optionally
+COLLECTION_SCANNER_PROFILE_PATH=<path>) in the environment.
+
+Profile modes:
+- 'stages' (or True, or 1 in the environment): times the scan pipeline stages, in stats stage_seconds:
+    - fetch: reads of principal collection blocks from hubstorage (in the fetch or read ahead threads, if any)
+    - merge: merge of partition blocks and cache management, excluding fetch
+    - read: time waiting for the next merged record (fetch plus merge when there is no read ahead)
+    - join: joins of secondary collections, including their reads
+    - filter: stopbefore, exclude prefixes, endts and meta filtering
+    - consumer: time spent by the consumer between generated records
+- 'cprofile': stages, plus a cProfile of the thread that creates the scanner, from creation until close. The
+  profile is dumped to the path (readable with pstats or snakeviz), and a text report sorted by cumulative time to
+  the same path plus .txt
+- 'sampling': stages, plus a sampling profiler of all threads, from creation until close. The report is written to
+  the path in collapsed stacks format (one line per stack with its sample count), as read by flamegraph.pl and
+  speedscope.
+
+The path may contain a {pid} placeholder. By default, it is collection-scanner-<pid>.prof or .stacks in the system
+temporary directory. Stage timings cost a few clock reads per record, and nothing when profiling is off.
+"""
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import tempfile
+import threading
+from collections import Counter
+
+from .stats import ScanHook
+
+
+__all__ = ['StageTimer', 'CProfiler', 'SamplingProfiler', 'get_profile_mode', 'get_profiler']
+
+PROFILE_ENV = 'COLLECTION_SCANNER_PROFILE'
+PROFILE_PATH_ENV = 'COLLECTION_SCANNER_PROFILE_PATH'
+PROFILE_MODES = ('stages', 'cprofile', 'sampling')
+
+log = logging.getLogger(__name__)
+
+
+def get_profile_mode(profile=None):
+    """
+    Returns the profile mode (one of PROFILE_MODES) for the given scanner profile argument, or None if profiling
+    is off. If profile is None, it is read from the environment.
+    """
+    if profile is None:
+        profile = os.environ.get(PROFILE_ENV, '').strip().lower()
+        if profile in ('0', 'false', 'off'):
+            return None
+        if profile in ('1', 'true', 'on'):
+            return 'stages'
+    if profile is True:
+        return 'stages'
+    if not profile:
+        return None
+    if profile not in PROFILE_MODES:
+        raise ValueError('Unsupported profile mode: {}'.format(profile))
+    return profile
+
+
+def get_profiler(mode, path=None):
+    """
+    Returns a started profiler hook for the given profile mode, or None if the mode has no profiler.
+    If path is None, it is read from the environment.
+    """
+    if mode not in ('cprofile', 'sampling'):
+        return None
+    path = path or os.environ.get(PROFILE_PATH_ENV)
+    profiler = CProfiler(path) if mode == 'cprofile' else SamplingProfiler(path)
+    profiler.start()
+    return profiler
+
+
+class StageTimer(object):
+    """
+    Lap timer that adds the time elapsed since the previous mark to the given stage
+    """
+    def __init__(self, stage_seconds):
+        """
+        stage_seconds - a dict of accumulated seconds by stage, i.e. a defaultdict(float)
+        """
+        self.stage_seconds = stage_seconds
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stage_seconds[stage] += now - self.last
+        self.last = now
+
+    def restart(self):
+        """
+        Starts a new lap without accounting the elapsed time to any stage
+        """
+        self.last = time.perf_counter()
+
+
+class _Profiler(ScanHook):
+    """
+    Base of profilers. They are started explicitly, and stopped on scanner close, when the report is written.
+    """
+    extension = None
+
+    def __init__(self, path=None):
+        """
+        path - report path. May contain a {pid} placeholder.
+        """
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'collection-scanner-{pid}.' + self.extension)
+        self.path = path.format(pid=os.getpid())
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        """
+        Stops the profiler and writes the report
+        """
+        if self.running:
+            self.running = False
+            self._write_report()
+            log.info('Profile report written to %s', self.path)
+
+    def on_close(self, stats):
+        self.stop()
+
+    def _write_report(self):
+        raise NotImplementedError
+
+
+class CProfiler(_Profiler):
+    """
+    Runs cProfile on the thread that starts it
+    """
+    extension = 'prof'
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        try:
+            self._profile.enable()
+        except ValueError as e: # another profiler is active
+            log.warning('Could not start cProfile: %s', e)
+            return
+        super().start()
+
+    def _write_report(self):
+        self._profile.disable()
+        self._profile.dump_stats(self.path)
+        with open(self.path + '.txt', 'w') as f:
+            pstats.Stats(self._profile, stream=f).sort_stats('cumulative').print_stats(50)
+
+
+class SamplingProfiler(_Profiler):
+    """
+    Samples the stacks of all threads every interval seconds, from a background thread
+    """
+    extension = 'stacks'
+
+    def __init__(self, path=None, interval=0.005):
+        """
+        path - report path. May contain a {pid} placeholder.
+        interval - seconds between samples
+        """
+        super().__init__(path)
+        self.interval = interval
+        # sample count by collapsed stack
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='collection-scanner-profiler', daemon=True)
+        self._thread.start()
+        super().start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ';'.join(reversed(stack))
+
+    def _write_report(self):
+        self._stop_event.set()
+        self._thread.join()
+        with open(self.path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
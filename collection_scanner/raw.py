@@ -0,0 +1,118 @@
+"""
+Raw records, for pass-through consumers that move records without looking into them
+
+Basic usage:
+
+from collection_scanner import CollectionScanner
+
+scanner = CollectionScanner(<collection name>, raw=True, **kwargs)
+for batch in scanner.scan_collection_batches():
+    for record in batch:
+        output.write(record.data + '\n')
+
+With raw=True, records are read from hubstorage as json lines, and each one is generated as a RawRecord that keeps
+the undecoded json text in its data attribute, with only its _key and _ts parsed out. The merge of partitions,
+the read ahead and the spill work on the keys, so records are never decoded by the scanner. record['_key'] and
+record['_ts'] are available without decoding, and record.decode() returns the record as a dict, including _key and
+_ts whatever the meta argument was. JsonLinesSink (see export.py) writes the data as is.
+
+Secondary collections, block cache and columnar batches are not supported in raw mode.
+"""
+import re
+import json
+
+from requests.exceptions import HTTPError
+
+
+__all__ = ['RawRecord', 'iter_raw_records', 'record_size']
+
+KEY_RE = re.compile(r'"_key":\s*"([^"\\]*)"')
+TS_RE = re.compile(r'"_ts":\s*(\d+)')
+
+
+class RawRecord(object):
+    __slots__ = ('key', 'ts', 'data')
+
+    def __init__(self, key, ts, data):
+        """
+        key - record _key
+        ts - record _ts, or None if unknown
+        data - the record as json text
+        """
+        self.key = key
+        self.ts = ts
+        self.data = data
+
+    @classmethod
+    def from_json(cls, line):
+        """
+        Builds a RawRecord from a json line. _key and _ts are searched in the text, and the line is only decoded
+        when they are ambiguous (i.e. nested objects with the same fields) or the key has escaped chars.
+        """
+        keys = KEY_RE.findall(line)
+        timestamps = TS_RE.findall(line)
+        if len(keys) == 1 and len(timestamps) == 1:
+            return cls(keys[0], int(timestamps[0]), line)
+        record = json.loads(line)
+        return cls(record['_key'], record.get('_ts'), line)
+
+    def decode(self):
+        """
+        Returns a new dict with the decoded record
+        """
+        return json.loads(self.data)
+
+    def __getitem__(self, name):
+        if name == '_key':
+            return self.key
+        if name == '_ts':
+            return self.ts
+        return self.decode()[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return 'RawRecord({!r}, {!r}, {!r})'.format(self.key, self.ts, self.data)
+
+
+def iter_raw_records(collection, **kwargs):
+    """
+    Generates the records of a collection read with the given parameters as RawRecord instances. As with
+    collection.get(), KeyError is raised if the collection does not exist or is empty, and ValueError on bad
+    parameters.
+    """
+    try:
+        for line in _iter_json_lines(collection, **kwargs):
+            yield RawRecord.from_json(line)
+    except HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            raise KeyError(None)
+        if e.response is not None and e.response.status_code == 400:
+            raise ValueError(e.response.text)
+        raise
+
+
+def _iter_json_lines(collection, **kwargs):
+    """
+    Generates the json lines of a collection read. Hubstorage collections are read with a single request, instead
+    of collection.iter_json(), which retries failed reads for hours and ends silently when it gives up, so errors
+    reach the scanner retries.
+    """
+    collections = getattr(collection, '_collections', None)
+    if collections is None: # not a hubstorage collection, i.e. a fake one
+        return collection.iter_json(**kwargs)
+    return collections._iter_lines((collection.coltype, collection.colname), params=kwargs, method='GET',
+                                   stream=True, is_idempotent=True)
+
+
+def record_size(record):
+    """
+    Returns the size of a record as json
+    """
+    if isinstance(record, RawRecord):
+        return len(record.data)
+    return len(json.dumps(record, default=str))
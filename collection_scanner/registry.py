@@ -0,0 +1,156 @@
+"""
+Process wide registry of collection metadata, shared by all scanners and counters
+
+The collections listing of each project is requested once every ttl seconds, and the partition map of all its
+collections is computed from it. Store handles are also reused, but only by the client that created them, as they
+hold its http session. The registry is reset in forked child processes.
+
+Basic usage:
+
+from collection_scanner.registry import registry
+
+registry.ttl = 60
+registry.invalidate()  # forget everything, i.e. after creating new collections
+
+Collections created after a listing is cached are not seen until the listing expires or is invalidated.
+"""
+import os
+import re
+import time
+import weakref
+import logging
+import threading
+from collections import defaultdict
+
+
+__all__ = ['CollectionRegistry', 'registry']
+
+DEFAULT_TTL = 300
+
+PARTITION_RE = re.compile(r'^(.+)_(\d+)$')
+
+log = logging.getLogger(__name__)
+
+
+class _ProjectEntry(object):
+    def __init__(self, client, listing):
+        self.client_ref = weakref.ref(client) if client is not None else None
+        self.created = time.time()
+        self.listing = listing
+        self.names = set(entry['name'] for entry in listing)
+        indexes = defaultdict(set)
+        for name in self.names:
+            m = PARTITION_RE.match(name)
+            if m:
+                indexes[m.group(1)].add(int(m.group(2)))
+        # number of partitions by collection name, for complete partition sets only
+        self.partitions = {name: len(found) for name, found in indexes.items() if len(found) == max(found) + 1}
+
+
+class CollectionRegistry(object):
+    def __init__(self, ttl=DEFAULT_TTL):
+        """
+        ttl - seconds a project collections listing is reused
+        """
+        self.ttl = ttl
+        self._reset()
+
+    def _reset(self):
+        self._entries = {}
+        # store handles by client and (projectid, collection name)
+        self._stores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _project_key(hsp):
+        """
+        Returns the key of the project, and the client whose identity the key depends on (or None)
+        """
+        client = getattr(hsp, 'client', None)
+        endpoint = getattr(client, 'endpoint', None)
+        projectid = getattr(hsp, 'projectid', None)
+        if endpoint is not None and projectid is not None:
+            return (endpoint, projectid, repr(getattr(hsp, 'auth', None))), None
+        # clients without endpoint (i.e. fakes) are only shared by projects of the same client instance
+        return ('client', id(client), projectid), client
+
+    def _get_entry(self, hsp):
+        key, client = self._project_key(hsp)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (time.time() - entry.created > self.ttl or
+                                      (entry.client_ref is not None and entry.client_ref() is not client)):
+                entry = None
+            if entry is None:
+                listing = list(hsp.collections.apiget('list'))
+                log.debug('Listed %d collections', len(listing))
+                entry = self._entries[key] = _ProjectEntry(client, listing)
+            return entry
+
+    def list_collections(self, hsp):
+        """
+        Returns the collections listing of the project
+        """
+        return self._get_entry(hsp).listing
+
+    def get_num_partitions(self, hsp, collection_name):
+        """
+        Returns the number of partitions of a partitioned collection, or None if it is not partitioned
+        """
+        return self._get_entry(hsp).partitions.get(collection_name)
+
+    def filter_collections_exist(self, hsp, collection_names):
+        """
+        Filters a list of collections to return only those that do exist, in listing order
+        """
+        names = set(collection_names)
+        return [entry['name'] for entry in self._get_entry(hsp).listing if entry['name'] in names]
+
+    def get_store(self, hsp, collection_name):
+        """
+        Returns the store handle of the given collection. Handles are not shared between clients, even of the same
+        endpoint and auth, as they use the session of the client.
+        """
+        client = getattr(hsp, 'client', None)
+        key = (getattr(hsp, 'projectid', None), collection_name)
+        with self._lock:
+            try:
+                stores = self._stores.setdefault(client, {})
+            except TypeError: # no client, or not weak referenceable
+                return hsp.collections.new_store(collection_name)
+            store = stores.get(key)
+            if store is None:
+                store = stores[key] = hsp.collections.new_store(collection_name)
+            return store
+
+    def invalidate(self, hsp=None):
+        """
+        Forgets the metadata of the given project, or of all projects
+        """
+        with self._lock:
+            if hsp is None:
+                self._entries.clear()
+                self._stores.clear()
+            else:
+                self._entries.pop(self._project_key(hsp)[0], None)
+                try:
+                    stores = self._stores.get(getattr(hsp, 'client', None), {})
+                except TypeError:
+                    stores = {}
+                projectid = getattr(hsp, 'projectid', None)
+                for key in [key for key in stores if key[0] == projectid]:
+                    del stores[key]
+
+    def after_fork(self):
+        """
+        Forgets everything in a forked child process, so it does not reuse the connections of the parent client
+        through its store handles. The lock is recreated, as it may have been held by another thread of the parent.
+        """
+        self._reset()
+
+
+# the process wide registry
+registry = CollectionRegistry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry.after_fork)
@@ -14,30 +14,53 @@ for record in batch:
 Before getting a new batch you can set a new startafter value with set_startafter() method.
 
 """
+import math
 import time
+import queue
+import string
+import heapq
+import bisect
 import random
 import logging
-from collections import defaultdict
+import itertools
+import threading
+from collections import defaultdict, deque
 from operator import itemgetter
 
 import dateparser
 
-from retrying import retry
-
 from scrapinghub import ScrapinghubClient
 
 from .utils import (
-    retry_on_exception,
+    is_transient_error,
     get_num_partitions,
     filter_collections_exist,
     LIMIT_KEY_CHAR,
     get_project_id,
+    PrefixSet,
+    discover_prefixes,
+    restrict_prefixes,
+    WorkerPool,
 )
+from .stats import ScanStats
+from .adaptive import AdaptiveNextRecords
+from .spill import SpillStore
+from .columnar import COLUMNAR_FORMATS, ColumnBuilder, num_rows
+from .raw import iter_raw_records, record_size
+from .profiling import StageTimer, get_profile_mode, get_profiler
+from .registry import registry
 
 
 __all__ = ['CollectionScanner']
 
 DEFAULT_BATCHSIZE = 10000
+# default margin of incremental scans watermarks, in millisecs
+WATERMARK_MARGIN = 60000
+# number of random characters appended to a prefix in order to generate a random key position for sampling
+SAMPLE_SUFFIX_LEN = 8
+# number of blocks, and records per block, read by sample() to find the characters of the keys
+SAMPLE_ALPHABET_READS = 4
+SAMPLE_ALPHABET_BLOCK = 100
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -47,98 +70,562 @@ class _CachedBlocksCollection(object):
     """
     - Gets blocks of records and cache them for fast future gets.
     - Hides partitioning
+    - If fetch_workers is greater than 1, partition blocks are refilled concurrently
+    - Retries failed reads from the last received key
+    - If memory_budget is given, keeps the estimated size of the cached records under it, by lowering the number
+      of records fetched per partition, and by spilling the entries with greatest keys to a temporary on-disk store
+    - If raw is True, records are read as RawRecord instances (see raw.py), never decoded
     """
-    def __init__(self, hsp, colname, partitions=None):
+    # retry policy of reads: max consecutive failed attempts per partition, and exponential backoff base and limit,
+    # in seconds
+    RETRY_MAX_ATTEMPTS = 10
+    RETRY_WAIT = 1.0
+    RETRY_MAX_WAIT = 120.0
+    # min number of records fetched per partition under a memory budget, and number of records of each block whose
+    # size is measured in order to estimate the size of cached records
+    MIN_FETCH_RECORDS = 10
+    SIZE_SAMPLES = 8
+
+    def __init__(self, hsp, colname, partitions=None, fetch_workers=0, block_cache=None, memory_budget=None,
+                 spill_dir=None, raw=False):
         self.hsp = hsp
         self.colname = colname
         self.collections = []
-        self.cache = defaultdict(list)
-        self.return_cache = []
-        self.max_in_return_cache = ''
+        self._pool = WorkerPool(fetch_workers)
+        self.block_cache = block_cache
+        self.raw = raw
+        # ScanHook instances notified of read calls and retries
+        self.hooks = []
+        # consecutive and total retries, per partition
+        self.retries = defaultdict(int)
+        self.total_retries = defaultdict(int)
+        self.cache = defaultdict(deque)
+        self.memory_budget = memory_budget
+        self.spill = SpillStore(spill_dir) if memory_budget else None
+        # number of spilled entries, per partition
+        self.spilled = defaultdict(int)
+        self._sampled_bytes = 0
+        self._sampled_records = 0
+        # per partition startts pushed down to reads (see CollectionScanner watermarks), and max _ts of the
+        # generated records
+        self.startts = {}
+        self.max_ts = {}
+        # if given, dict where fetch and merge seconds are accumulated (see profiling.py)
+        self.stage_seconds = None
         self.__last_requested_startafter = ''
 
         if not partitions:
-            self.collections.append(hsp.collections.new_store(colname))
+            self.collections.append(registry.get_store(hsp, colname))
         else:
             for p in range(partitions):
-                self.collections.append(hsp.collections.new_store("{}_{}".format(colname, p)))
+                self.collections.append(registry.get_store(hsp, "{}_{}".format(colname, p)))
+        self._parts = {col: index for index, col in enumerate(self.collections)}
+
+    @property
+    def fetch_workers(self):
+        return self._pool.workers
+
+    @fetch_workers.setter
+    def fetch_workers(self, fetch_workers):
+        self._pool.workers = fetch_workers
 
     def get(self, random_mode=False, **kwargs):
         """
         if random_mode is True, optimize for random generation of samples.
+
+        Records are generated in key order, as a k-way merge of the per partition cached blocks.
         """
-        collections = set([random.choice(self.collections)] if random_mode else self.collections)
+        timer = StageTimer(self.stage_seconds) if self.stage_seconds is not None else None
+        collections = [random.choice(self.collections)] if random_mode else self.collections
         max_next_records = kwargs.pop('count')[0] # must always be used with count parameter
         assert max_next_records
         requested_startafter = kwargs.pop('startafter', None)
         if isinstance(requested_startafter, list):
             requested_startafter = requested_startafter[0]
+        # start must be only applied on the first read of each partition, as HS nulifies startafter if start is given
+        start = kwargs.pop('start', None)
 
         if not requested_startafter:
-            self.cache = defaultdict(list)
-            self.return_cache = []
+            self._clear_caches()
         else: # remove all entries in cache below the given startafter
             assert requested_startafter > self.__last_requested_startafter, \
                    'startafter series must be strictly increasing. Previous startafter: %s Last startafter: %s' \
                    % (self.__last_requested_startafter, requested_startafter)
             self.__last_requested_startafter = requested_startafter
-            for col in self.cache.keys():
-                index = -1
-                for index, (key, _) in enumerate(self.cache[col]):
-                    if key > requested_startafter:
-                        break
-                else:
-                    index += 1
-                self.cache[col] = self.cache[col][index:]
-
-            index = -1
-            for index, (key, _) in enumerate(self.return_cache):
-                if key > requested_startafter:
-                    break
-            else:
-                index += 1
-            self.return_cache = self.return_cache[index:]
+            for col, pcache in self.cache.items():
+                self._trim_cache(pcache, requested_startafter)
+                if self.spilled[col]:
+                    self.spilled[col] -= self.spill.trim(self._parts[col], requested_startafter)
 
         finished_collections = set()
-        if self.return_cache:
-            requested_startafter = self.return_cache[-1][0]
-
         startafter = {}
         for col in collections:
-            startafter[col] = max(requested_startafter, self.cache[col][-1][0]) if self.cache[col] else requested_startafter
-
-        if self.return_cache:
-            self.return_cache[0][0], self.return_cache[-1][0]
-
-        while collections.difference(finished_collections):
-            for col in collections.difference(finished_collections):
-                pcache = self.cache[col]
-                if not pcache:
-                    data = False
-                    for record in self._read_from_collection(col, count=[max_next_records], startafter=[startafter[col]], **kwargs):
-                        data = True
-                        startafter[col] = record['_key']
-                        pcache.append((record['_key'], record))
-                    if not data:
-                        finished_collections.add(col)
-                if pcache and (len(self.return_cache) < max_next_records or pcache[0][0] < self.max_in_return_cache):
-                    key, record = pcache.pop(0)
-                    self.return_cache.append((key, record))
-                    self.max_in_return_cache = max(self.max_in_return_cache, key)
-                else:
-                    finished_collections.add(col)
-        self.return_cache = sorted(self.return_cache, key=itemgetter(0))
-        to_return_now, self.return_cache = self.return_cache[:max_next_records], self.return_cache[max_next_records:]
-        for key, record in to_return_now:
+            if self.spilled[col]:
+                startafter[col] = self.spill.last_key(self._parts[col])
+            else:
+                startafter[col] = self.cache[col][-1][0] if self.cache[col] else requested_startafter
+
+        fetch_count = self._get_fetch_count(max_next_records, len(collections))
+        to_fetch = [col for col in collections if not self.cache[col] and not self._unspill(col, fetch_count)]
+        first_kwargs = dict(kwargs, start=start) if start else kwargs
+        self._fill_caches(to_fetch, startafter, finished_collections, count=[fetch_count], **first_kwargs)
+
+        heap = [(self.cache[col][0][0], index) for index, col in enumerate(collections) if self.cache[col]]
+        heapq.heapify(heap)
+        returned = 0
+        while heap and returned < max_next_records:
+            _, index = heap[0]
+            col = collections[index]
+            pcache = self.cache[col]
+            _, record = pcache.popleft()
+            returned += 1
+            ts = record.get('_ts')
+            if ts is not None and ts > self.max_ts.get(col.colname, 0):
+                self.max_ts[col.colname] = ts
+            if not pcache and returned < max_next_records and not self._unspill(col, fetch_count):
+                self._refill_caches(col, collections, startafter, finished_collections, count=[fetch_count],
+                                    **kwargs)
+            if pcache:
+                heapq.heapreplace(heap, (pcache[0][0], index))
+            else:
+                heapq.heappop(heap)
+            if timer:
+                timer.mark('merge')
             yield record
+            if timer:
+                timer.restart()
+        if timer:
+            timer.mark('merge')
+
+    @property
+    def cached_records(self):
+        return sum(len(pcache) for pcache in self.cache.values())
+
+    @property
+    def spilled_records(self):
+        return sum(self.spilled.values())
+
+    @property
+    def cache_bytes(self):
+        """
+        Estimated size of the records held in memory by the partition caches, as json
+        """
+        if not self._sampled_records:
+            return 0
+        return int(self.cached_records * self._sampled_bytes / self._sampled_records)
+
+    def reset(self):
+        """
+        Drops all cached blocks and the startafter series, so a new get() series can start from any key
+        """
+        self._clear_caches()
+        self.__last_requested_startafter = ''
+
+    def _clear_caches(self):
+        self.cache = defaultdict(deque)
+        if self.spilled_records:
+            self.spill.clear()
+        self.spilled.clear()
+
+    def _get_fetch_count(self, max_next_records, partitions):
+        """
+        Number of records to fetch on each partition read. Under a memory budget, it is lowered so the caches of
+        all partitions fit in it.
+        """
+        if not self.memory_budget or not self._sampled_records:
+            return max_next_records
+        fit = int(self.memory_budget * self._sampled_records / (self._sampled_bytes * partitions))
+        return max(self.MIN_FETCH_RECORDS, min(max_next_records, fit))
+
+    def _measure(self, block):
+        for _, record in block[::max(1, len(block) // self.SIZE_SAMPLES)]:
+            self._sampled_bytes += record_size(record)
+            self._sampled_records += 1
+
+    def _enforce_budget(self):
+        """
+        Spills cache entries while the memory budget is exceeded. Entries with greatest keys go first, as they are
+        the last ones to be generated. The first entry of each partition stays in memory, as the merge relies on it.
+        """
+        record_bytes = self._sampled_bytes / self._sampled_records
+        excess = self.cache_bytes - self.memory_budget
+        while excess > 0:
+            col = max((c for c, pcache in self.cache.items() if len(pcache) > 1),
+                      key=lambda c: self.cache[c][-1][0], default=None)
+            if col is None:
+                break
+            pcache = self.cache[col]
+            # entries above the greatest key of the other partitions are the last ones of all
+            others = [p[-1][0] for c, p in self.cache.items() if p and c is not col]
+            above = len(pcache) - bisect.bisect_right(pcache, max(others), key=itemgetter(0)) if others else len(pcache)
+            count = min(len(pcache) - 1, math.ceil(excess / record_bytes), max(above, 1))
+            entries = [pcache.pop() for _ in range(count)]
+            entries.reverse()
+            self.spill.put(self._parts[col], entries)
+            self.spilled[col] += count
+            excess -= count * record_bytes
+            log.debug('Spilled %d records of %s', count, col.colname)
+
+    def _unspill(self, col, count):
+        """
+        Loads into the depleted cache of col up to count spilled entries. Returns True if any was loaded.
+        """
+        if not self.spilled[col]:
+            return False
+        entries = self.spill.take(self._parts[col], count)
+        self.spilled[col] -= len(entries)
+        self.cache[col].extend(entries)
+        return bool(entries)
+
+    @staticmethod
+    def _trim_cache(pcache, startafter):
+        """
+        Removes from a partition cache all entries with key not above startafter
+        """
+        if pcache and pcache[-1][0] <= startafter:
+            pcache.clear()
+        else:
+            for _ in range(bisect.bisect_right(pcache, startafter, key=itemgetter(0))):
+                pcache.popleft()
+
+    def _refill_caches(self, col, collections, startafter, finished_collections, **kwargs):
+        """
+        Refills the depleted cache of col. On concurrent mode, take the chance to also refill
+        the caches of the partitions that are about to be depleted.
+        """
+        to_fetch = [col]
+        if self.fetch_workers > 1:
+            low_mark = kwargs['count'][0] // 2
+            to_fetch.extend(c for c in collections if c is not col and c not in finished_collections and
+                            not self.spilled[c] and len(self.cache[c]) < low_mark)
+        self._fill_caches(to_fetch, startafter, finished_collections, **kwargs)
+
+    def _fill_caches(self, to_fetch, startafter, finished_collections, **kwargs):
+        started = time.perf_counter() if self.stage_seconds is not None else None
+        blocks = self._read_blocks(to_fetch, startafter, **kwargs)
+        if started is not None:
+            # fills are always done within get(), whose time is accounted as merge
+            seconds = time.perf_counter() - started
+            self.stage_seconds['fetch'] += seconds
+            self.stage_seconds['merge'] -= seconds
+        for col, block in zip(to_fetch, blocks):
+            if block:
+                startafter[col] = block[-1][0]
+                self.cache[col].extend(block)
+                if self.memory_budget:
+                    self._measure(block)
+            else:
+                finished_collections.add(col)
+        if self.memory_budget and self.cache_bytes > self.memory_budget:
+            self._enforce_budget()
+
+    def _read_blocks(self, collections, startafter, **kwargs):
+        """
+        Reads one block from each given collection, starting after startafter[col].
+        Returns a list of blocks of (key, record) in the same order as collections.
+        """
+        def _read_block(col):
+            col_kwargs = kwargs
+            if col.colname in self.startts:
+                startts = kwargs.get('startts')
+                if isinstance(startts, list):
+                    startts = startts[0]
+                col_kwargs = dict(kwargs, startts=max(startts or 0, self.startts[col.colname]))
+            return [(r['_key'], r) for r in self._read_block(col, startafter[col], **col_kwargs)]
+        return self._pool.map(_read_block, collections)
+
+    def _read_block(self, collection, startafter, sampling=False, **kwargs):
+        """
+        Reads a block of records from collection, through the block cache if there is one, and notifies the hooks.
+        If sampling is True, the block cache is not used, and the adaptive controller of the number of records per
+        read is not notified, as short sampling reads are not representative of scan reads.
+        """
+        started = time.time()
+        if self.block_cache is None or sampling:
+            records = list(self._read_from_collection(collection, startafter=[startafter], **kwargs))
+        else:
+            records = self._read_cached_block(collection, startafter, **kwargs)
+        if self.hooks:
+            seconds = time.time() - started
+            for hook in self.hooks:
+                if not sampling or not isinstance(hook, AdaptiveNextRecords):
+                    hook.on_request(collection.colname, kwargs['count'][0], records, seconds)
+        return records
+
+    def _read_cached_block(self, collection, startafter, **kwargs):
+        cached = self.block_cache.get(collection.colname, startafter, kwargs)
+        if cached is None:
+            fetched_at = self.block_cache.snapshot_time()
+            records = list(self._read_from_collection(collection, startafter=[startafter], **kwargs))
+        else:
+            records, fetched_at = cached
+            if not self.block_cache.needs_refresh(fetched_at):
+                return records
+            records, fetched_at = self._refresh_block(collection, startafter, records, fetched_at, **kwargs)
+        self.block_cache.put(collection.colname, startafter, kwargs, records, fetched_at)
+        return records
+
+    def _refresh_block(self, collection, startafter, records, fetched_at, **kwargs):
+        """
+        Updates a cached block with the records of its key range written after fetched_at
+        """
+        refreshed_at = self.block_cache.snapshot_time()
+        count = kwargs['count'][0]
+        # an incomplete block is the last one of the collection, so it also gets the new records at the end
+        last_key = records[-1]['_key'] if len(records) >= count else None
+        startts = kwargs.get('startts')
+        if isinstance(startts, list):
+            startts = startts[0]
+        delta_kwargs = dict(kwargs, startts=max(startts or 0, fetched_at))
+        records = {r['_key']: r for r in records}
+        while True:
+            page = list(self._read_from_collection(collection, startafter=[startafter], **delta_kwargs))
+            delta_kwargs.pop('start', None)
+            records.update((r['_key'], r) for r in page if last_key is None or r['_key'] <= last_key)
+            if last_key is None or len(page) < count or page[-1]['_key'] > last_key:
+                break
+            startafter = page[-1]['_key']
+        return [records[key] for key in sorted(records)], refreshed_at
+
+    def close(self):
+        self._pool.shutdown()
+        if self.spill is not None:
+            self.spill.close()
 
-    @retry(wait_fixed=120000, retry_on_exception=retry_on_exception, stop_max_attempt_number=10)
     def _read_from_collection(self, collection, **kwargs):
-        try:
-            for record in collection.get(**kwargs):
-                yield record
-        except KeyError: # HS raises KeyError on empty collections
+        """
+        Reads records from collection. On transient errors, the read is reopened after the last received key,
+        with exponential backoff and jitter. Each partition gets up to RETRY_MAX_ATTEMPTS consecutive attempts
+        without receiving any record.
+        """
+        count = kwargs['count'][0]
+        colname = collection.colname
+        received = 0
+        while True:
+            received_before = received
+            try:
+                records = iter_raw_records(collection, **kwargs) if self.raw else collection.get(**kwargs)
+                for record in records:
+                    received += 1
+                    yield record
+                self.retries[colname] = 0
+                return
+            except KeyError: # HS raises KeyError on empty collections
+                return
+            except Exception as e:
+                if received > received_before:
+                    self.retries[colname] = 0
+                if not is_transient_error(e) or self.retries[colname] >= self.RETRY_MAX_ATTEMPTS - 1:
+                    raise
+                error = e
+            if received >= count:
+                return
+            self.retries[colname] += 1
+            self.total_retries[colname] += 1
+            delay = random.uniform(0, min(self.RETRY_MAX_WAIT, self.RETRY_WAIT * 2 ** self.retries[colname]))
+            log.warning("Read from %s failed (attempt %d). Retrying in %.1f secs.", colname, self.retries[colname], delay)
+            for hook in self.hooks:
+                hook.on_retry(colname, self.retries[colname], error, delay)
+            time.sleep(delay)
+            if received:
+                kwargs = dict(kwargs, startafter=[record['_key']], count=[count - received])
+                kwargs.pop('start', None)
+
+
+class _ReadAheadCollection(object):
+    """
+    Wraps a _CachedBlocksCollection with a producer thread that keeps reading the next blocks
+    into a bounded queue, while the caller processes the current ones.
+    - get() has the same interface as _CachedBlocksCollection.get()
+    - A get() with a startafter above the last generated key (i.e. a jump over an excluded prefix) drops the
+      prefetched records up to it and keeps the pipeline running. Only if the new startafter is past all the
+      prefetched records, or is not above the last generated key, or get arguments change, the pipeline is
+      restarted from it. The partition caches are only reset if the restart goes back.
+    """
+    def __init__(self, col, prefetch, get_blocksize):
+        self.col = col
+        self.colname = col.colname
+        self.prefetch = prefetch
+        self.get_blocksize = get_blocksize
+        self._thread = None
+        self._stop_event = None
+        self._queue = None
+        self._buffer = deque()
+        self._exhausted = False
+        self._last_key = None
+        # last key of the blocks read by the producer
+        self._produced_key = None
+        self._kwargs = None
+        self.__last_requested_startafter = ''
+
+    def get(self, random_mode=False, **kwargs):
+        if random_mode:
+            self._stop()
+            self.col.reset()
+            yield from self.col.get(random_mode, **kwargs)
             return
+        max_next_records = kwargs.pop('count')[0]
+        assert max_next_records
+        requested_startafter = kwargs.pop('startafter', None)
+        if isinstance(requested_startafter, list):
+            requested_startafter = requested_startafter[0]
+        start = kwargs.pop('start', None)
+
+        if requested_startafter:
+            assert requested_startafter > self.__last_requested_startafter, \
+                   'startafter series must be strictly increasing. Previous startafter: %s Last startafter: %s' \
+                   % (self.__last_requested_startafter, requested_startafter)
+            self.__last_requested_startafter = requested_startafter
+        if self._thread is None or start or kwargs != self._kwargs or requested_startafter != self._last_key and \
+                not self._skip_to(requested_startafter):
+            self._restart(requested_startafter, start, kwargs)
+
+        while max_next_records:
+            if not self._buffer:
+                if self._exhausted:
+                    return
+                item = self._queue.get()
+                if item is None:
+                    self._exhausted = True
+                    return
+                if isinstance(item, Exception):
+                    self._exhausted = True
+                    raise item
+                self._buffer = deque(item)
+            record = self._buffer.popleft()
+            self._last_key = record['_key']
+            max_next_records -= 1
+            yield record
+
+    @property
+    def cached_records(self):
+        queued = sum(len(item) for item in list(self._queue.queue) if isinstance(item, list)) if self._queue else 0
+        return len(self._buffer) + queued + self.col.cached_records
+
+    def _skip_to(self, startafter):
+        """
+        Drops the prefetched records with key not above startafter, without waiting for the producer. Returns False
+        if startafter is not above the last generated key, or is past all the prefetched records.
+        """
+        if not startafter or self._last_key is not None and startafter <= self._last_key:
+            return False
+        while not self._buffer or self._buffer[-1]['_key'] <= startafter:
+            self._buffer.clear()
+            if self._exhausted:
+                break
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return False
+            if isinstance(item, Exception):
+                return False
+            if item is None:
+                self._exhausted = True
+                break
+            self._buffer = deque(item)
+        for _ in range(bisect.bisect_right(self._buffer, startafter, key=itemgetter('_key'))):
+            self._buffer.popleft()
+        self._last_key = startafter
+        return True
+
+    def _restart(self, startafter, start, kwargs):
+        self._stop()
+        # going forward with the same arguments, the partition caches are still valid
+        if start or not startafter or kwargs != self._kwargs or self._produced_key is None or \
+                startafter <= self._produced_key:
+            self.col.reset()
+        self._produced_key = None
+        self._queue = queue.Queue(maxsize=self.prefetch)
+        self._stop_event = threading.Event()
+        self._buffer = deque()
+        self._exhausted = False
+        self._last_key = startafter
+        self._kwargs = kwargs
+        self._thread = threading.Thread(target=self._produce, args=(startafter, start, kwargs.copy(), self._queue,
+                                        self._stop_event), daemon=True)
+        self._thread.start()
+
+    def _produce(self, startafter, start, kwargs, blocks, stop_event):
+        def _put(item):
+            while not stop_event.is_set():
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            while True:
+                blocksize = self.get_blocksize()
+                block = list(self.col.get(count=[blocksize], startafter=[startafter], start=start, **kwargs))
+                start = None
+                if block:
+                    # the block records are already out of the partition caches, even if the block is discarded
+                    startafter = self._produced_key = block[-1]['_key']
+                    if not _put(block):
+                        return
+                if len(block) < blocksize:
+                    _put(None)
+                    return
+        except Exception as e:
+            _put(e)
+
+    def _stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self._stop()
+        self.col.close()
+
+
+class _SecondaryCursor(object):
+    """
+    Cursor over a secondary collection, that advances in step with the principal one.
+    Keeps in memory at most one block of records.
+    """
+    def __init__(self, col):
+        self.col = col
+        self.colname = col.colname
+        self.buffer = deque()
+        self.depleted = False
+
+    def seek(self, key):
+        """
+        Drops buffered records with key below the given one. Returns True if a new block must be read
+        in order to reach key.
+        """
+        if self.buffer and self.buffer[-1][0] < key:
+            self.buffer.clear()
+        while self.buffer and self.buffer[0][0] < key:
+            self.buffer.popleft()
+        return not self.buffer and not self.depleted
+
+    def fill(self, key, count, meta):
+        """
+        Reads a block of records starting at key
+        """
+        records = 0
+        for r in self.col.get(count=[count], start=key, meta=meta):
+            records += 1
+            self.buffer.append((r.pop('_key'), r))
+        if records < count:
+            self.depleted = True
+            log.info('Secondary collection %s is depleted', self.colname)
+
+    def pop(self, key):
+        """
+        Returns the record with given key, if it is the next one in the cursor
+        """
+        if self.buffer and self.buffer[0][0] == key:
+            return self.buffer.popleft()[1]
+
+    def reset(self):
+        self.buffer.clear()
+        self.depleted = False
 
 
 class CollectionScanner(object):
@@ -156,7 +643,10 @@ class CollectionScanner(object):
     def __init__(self, collection_name, project_id=None, apikey=None, batchsize=DEFAULT_BATCHSIZE, count=0,
                  max_next_records=1000, startafter=None, stopbefore=None, exclude_prefixes=None,
                  secondary_collections=None,
-                 autodetect_partitions=True, **kwargs):
+                 autodetect_partitions=True, fetch_workers=0, prefetch=0, checkpoint_store=None, checkpoint_name=None,
+                 checkpoint_interval=1, adaptive_next_records=None, block_cache=None, hooks=None, cache_memory=None,
+                 spill_dir=None, watermark_store=None, watermark_name=None, watermark_margin=WATERMARK_MARGIN,
+                 raw=False, profile=None, profile_path=None, measure_bytes=False, **kwargs):
         """
         collection_name - target collection
         project_id - target project id. If none, autodetect from SHUB_JOBKEY environment variable.
@@ -166,11 +656,53 @@ class CollectionScanner(object):
         count - total count of records to retrieve
         max_next_records - how many records get on each call to hubstorage server
         startafter - start to scan after given hs key prefix
-        stopbefore - stop once found given hs key prefix
+        stopbefore - stop once found given hs key prefix, or any key above it
         exclude_prefix - a list of key prefixes to exclude from scanning
         secondary_collections - a list of secondary collections that updates the class default one.
         autodetect_partitions - If provided, autodetect partitioned collection. By default is True. If you want instead to force to read a non-partitioned
                 collection when partitioned version also exists under the same name, use False.
+        fetch_workers - if greater than 1, blocks from the partitions of a partitioned collection, and blocks from the
+                secondary collections, are fetched concurrently using thread pools of this size. By default (0) they
+                are read one after another.
+        prefetch - if greater than 0, a background thread reads ahead up to this number of blocks of max_next_records
+                while the caller processes the current batch. A forward jump with set_startafter() (or over an
+                excluded prefix) only drops the prefetched records up to the new key, and the read ahead is only
+                restarted when the key is beyond the prefetched blocks, or on backward jumps.
+        checkpoint_store - a checkpoint store (see checkpoint.py). If given, scanner state is saved there after the
+                consumer processes each checkpoint_interval batches, and restored on creation if a checkpoint exists.
+        checkpoint_name - name of the checkpoint in the store. By default, the collection name.
+        checkpoint_interval - number of batches between checkpoints.
+        adaptive_next_records - an AdaptiveNextRecords instance (see adaptive.py). If given, the number of records got
+                on each call to hubstorage server is adjusted within its bounds in order to hit its target latency
+                or throughput, starting from max_next_records.
+        block_cache - a local block cache (see blockcache.py). If given, blocks read from principal and secondary
+                collections are cached there, and reused by later scans that request the same blocks.
+        hooks - a list of ScanHook instances (see stats.py) to be notified of scan events. Scan metrics are always
+                collected in the stats attribute.
+        measure_bytes - if True, the stats also measure the size of read records, as json (it has a cpu cost).
+        cache_memory - if given, budget in bytes for the records held by the partition caches (estimated as their json
+                size). The records fetched per partition are lowered to fit in it, and when it is exceeded, the cached
+                records that will be generated last are spilled to a temporary SQLite database (see spill.py).
+                Read ahead blocks are not included.
+        spill_dir - directory of the spill database. If None, the system temporary directory.
+        watermark_store - a store of scan state (see checkpoint.py) where to keep _ts watermarks, for incremental
+                scans. If given, the scan only requests records with _ts not below the watermark of each partition,
+                minus watermark_margin. Once the consumer has processed the last batch of a complete scan, watermarks
+                are advanced to the max _ts of the scanned records of each partition. Scans limited by count, by startts
+                or by key range (startafter, stopbefore, start, prefix, exclude_prefixes, or a set_startafter() or
+                set_stopbefore() call that skips keys) never advance them. Changes in secondary collections alone
+                are not detected.
+        watermark_name - name of the watermarks in the store. By default, the collection name. Must not be shared
+                with a checkpoint in the same store.
+        watermark_margin - millisecs substracted from watermarks, in order to cover records written while the
+                previous scan was running but not yet visible to it. Records in the margin are delivered again.
+        raw - if True, records are generated as RawRecord instances, with the undecoded json text and the parsed
+                _key and _ts (see raw.py). Not supported along with secondary collections or block_cache.
+        profile - profile mode: True or 'stages' to time the scan pipeline stages in stats, 'cprofile' or 'sampling'
+                to also run a profiler from creation until close, that writes a report (see profiling.py). If None,
+                read from COLLECTION_SCANNER_PROFILE environment variable.
+        profile_path - path of the profiler report. If None, read from COLLECTION_SCANNER_PROFILE_PATH environment
+                variable, or a temporary file by default.
         **kwargs - other extras arguments you want to pass to hubstorage collection, i.e.:
                 - prefix (list of key prefixes to include in the scan)
                 - startts and endts, either in epoch millisecs (as accepted by hubstorage) or a date string (support is added here)
@@ -187,18 +719,51 @@ class CollectionScanner(object):
             if num_partitions:
                 log.info("Partitioned collection detected: %d total partitions.", num_partitions)
 
-        self.col = _CachedBlocksCollection(self.hsp, collection_name, num_partitions)
+        self.stats = ScanStats(measure_bytes)
+        self.__profile = get_profile_mode(profile)
+        profiler = get_profiler(self.__profile, profile_path)
+        self.__hooks = [self.stats] + list(hooks or []) + ([profiler] if profiler is not None else [])
+        if raw and block_cache is not None:
+            raise ValueError('block_cache is not supported in raw mode')
+        self.raw = raw
+        self.col = _CachedBlocksCollection(self.hsp, collection_name, num_partitions, fetch_workers, block_cache,
+                                           cache_memory, spill_dir, raw)
+        self.col.hooks.extend(self.__hooks)
+        self.__max_next_records = max_next_records
+        self.__adaptive_next_records = adaptive_next_records
+        if adaptive_next_records is not None:
+            adaptive_next_records.start(max_next_records)
+            self.col.hooks.append(adaptive_next_records)
+        # the underlying block reader, also when wrapped by the read ahead
+        self.__blocks_col = self.col
+        if self.__profile:
+            self.col.stage_seconds = self.stats.stage_seconds
+        self.__watermark_store = watermark_store
+        self.__watermark_name = watermark_name or collection_name
+        self.__watermarks = {}
+        if watermark_store is not None:
+            self.__watermarks = (watermark_store.load(self.__watermark_name) or {}).get('partitions', {})
+            self.col.startts = {colname: max(0, ts - watermark_margin) for colname, ts in self.__watermarks.items()}
+            if self.__watermarks:
+                log.info("Incremental scan from watermark %s", min(self.__watermarks.values()))
+        if prefetch:
+            self.col = _ReadAheadCollection(self.col, prefetch, self._get_next_records)
         self.__scanned_count = 0
         self.__totalcount = count
         self.lastkey = None
         self.__startafter = startafter
         self.__stopbefore = stopbefore
-        self.__exclude_prefixes = exclude_prefixes or []
-        self.secondary_collections.extend(secondary_collections or [])
-        self.secondary = [_CachedBlocksCollection(self.hsp, name) for name in filter_collections_exist(self.hsp, self.secondary_collections)]
-        self.__secondary_is_empty = defaultdict(bool)
+        self.__exclude_prefixes = PrefixSet(exclude_prefixes or [])
+        self.secondary_collections = list(self.secondary_collections) + list(secondary_collections or [])
+        self.secondary = [_SecondaryCursor(_CachedBlocksCollection(self.hsp, name, block_cache=block_cache))
+                          for name in filter_collections_exist(self.hsp, self.secondary_collections)]
+        if raw and self.secondary:
+            raise ValueError('Secondary collections are not supported in raw mode')
+        for cursor in self.secondary:
+            cursor.col.hooks.extend(self.__hooks)
         self.__batchsize = batchsize
-        self.__max_next_records = max_next_records
+        self.__fetch_workers = fetch_workers
+        self._pool = WorkerPool(fetch_workers)
         self.__enabled = True
 
         self.__start = kwargs.pop('start', '')
@@ -207,6 +772,21 @@ class CollectionScanner(object):
         kwargs['endts'] = self.__endts
         kwargs['startts'] = self.convert_ts(kwargs.get('startts', None))
         self.__get_kwargs = kwargs
+        # scans limited by key range (or by a user startts) only see part of each partition, so they must not
+        # advance watermarks
+        self.__range_limited = bool(startafter or stopbefore is not None or exclude_prefixes or self.__start or
+                                    kwargs.get('prefix') or kwargs['startts'])
+
+        self.__checkpoint_store = checkpoint_store
+        self.__checkpoint_name = checkpoint_name or collection_name
+        self.__checkpoint_interval = checkpoint_interval
+        self.__unsaved_batches = 0
+        if checkpoint_store is not None:
+            state = checkpoint_store.load(self.__checkpoint_name)
+            if state is not None:
+                self.set_state(state)
+                log.info("Resumed from checkpoint %s. Last key: %s, Scanned %d", self.__checkpoint_name,
+                         self.lastkey, self.__scanned_count)
 
     def reset(self):
         """
@@ -216,30 +796,112 @@ class CollectionScanner(object):
         self.__totalcount = 0
         self.lastkey = None
         self.__startafter = None
-        self.__secondary_is_empty = defaultdict(bool)
+        for cursor in self.secondary:
+            cursor.reset()
+        self.__blocks_col.max_ts = {}
         self.__enabled = True
 
-    def get_secondary_data(self, start, meta):
-        secondary_data = defaultdict(dict)
-        last = None
-        max_next_records = self._get_max_next_records(self.__batchsize)
-        for col in self.secondary:
-            if not self.__secondary_is_empty[col.colname]:
-                count = 0
-                try:
-                    for r in col.get(count=[max_next_records], start=start, meta=meta):
-                        count += 1
-                        last = key = r.pop('_key')
-                        ts = r.pop('_ts')
-                        secondary_data[key].update(r)
-                        if '_ts' not in secondary_data[key] or ts > secondary_data[key]['_ts']:
-                            secondary_data[key]['_ts'] = ts
-                except KeyError:
-                    pass
-                if count < max_next_records:
-                    self.__secondary_is_empty[col.colname] = True
-                    log.info('Secondary collection %s is depleted', col.colname)
-        return last, dict(secondary_data)
+    def get_state(self):
+        """
+        Returns the scanner state, as a json serializable dict
+        """
+        return {
+            'startafter': self.__startafter,
+            'lastkey': self.lastkey,
+            'scanned_count': self.__scanned_count,
+            'totalcount': self.__totalcount,
+            'enabled': self.__enabled,
+            'secondary_is_empty': {cursor.colname: cursor.depleted for cursor in self.secondary},
+            'max_ts': dict(self.__blocks_col.max_ts),
+            'range_limited': self.__range_limited,
+        }
+
+    def set_state(self, state):
+        """
+        Restores a scanner state returned by get_state()
+        """
+        self.__startafter = state['startafter']
+        self.lastkey = state['lastkey']
+        self.__scanned_count = state['scanned_count']
+        self.__totalcount = state['totalcount']
+        self.__enabled = state['enabled']
+        self.__blocks_col.max_ts = dict(state.get('max_ts', {}))
+        self.__range_limited = self.__range_limited or state.get('range_limited', False)
+        for cursor in self.secondary:
+            cursor.reset()
+            cursor.depleted = state['secondary_is_empty'].get(cursor.colname, False)
+        if self.__startafter:
+            # HS nulifies startafter if start is given
+            self.__start = ''
+
+    def save_checkpoint(self):
+        """
+        Saves current state in the checkpoint store
+        """
+        if self.__checkpoint_store is not None:
+            self.__checkpoint_store.save(self.__checkpoint_name, self.get_state())
+            self.__unsaved_batches = 0
+
+    def _batch_done(self, defer=None):
+        """
+        Called once the consumer has processed a batch. Saves a checkpoint if it is time to.
+        defer - if given, the state is captured now but the save is passed to it as a callable, i.e. to be run once
+                the batch records are durably written.
+        """
+        self.__unsaved_batches += 1
+        if self.__unsaved_batches >= self.__checkpoint_interval or not self.__enabled:
+            if defer is None or self.__checkpoint_store is None:
+                self.save_checkpoint()
+            else:
+                store, name, state = self.__checkpoint_store, self.__checkpoint_name, self.get_state()
+                self.__unsaved_batches = 0
+                defer(lambda: store.save(name, state))
+        if not self.__enabled and self.__watermark_store is not None and not self.__totalcount and \
+                not self.__range_limited:
+            store, name, watermarks = self.__watermark_store, self.__watermark_name, self.get_watermarks()
+            if defer is None:
+                store.save(name, watermarks)
+            else:
+                defer(lambda: store.save(name, watermarks))
+
+    def get_watermarks(self):
+        """
+        Returns the _ts watermarks the scan advances to, as saved in the watermark store: a dict with the watermark
+        of each partition, and the collection one (the lowest of them)
+        """
+        partitions = dict(self.__watermarks)
+        for colname, ts in self.__blocks_col.max_ts.items():
+            if self.__endts:
+                # records above endts are not delivered, so they must be requested again
+                ts = min(ts, self.__endts)
+            partitions[colname] = max(ts, partitions.get(colname, 0))
+        return {'startts': min(partitions.values()) if partitions else None, 'partitions': partitions}
+
+    def join_secondary(self, record, meta):
+        """
+        Merges into record the data with same key from the secondary collections. Secondary cursors that
+        need a new block in order to reach the record key are read concurrently if fetch_workers is greater than 1.
+        """
+        key = record['_key']
+        to_fill = [cursor for cursor in self.secondary if cursor.seek(key)]
+        if to_fill:
+            count = self._get_max_next_records(self.__batchsize)
+            self._map(lambda cursor: cursor.fill(key, count, meta), to_fill)
+        self.stats.secondary_lookups += 1
+        for cursor in self.secondary:
+            srecord = cursor.pop(key)
+            if srecord is not None:
+                self.stats.secondary_hits[cursor.colname] += 1
+                ts = srecord.pop('_ts')
+                record.update(srecord)
+                if ts > record['_ts']:
+                    record['_ts'] = ts
+
+    def _map(self, func, items):
+        """
+        Maps func on items, concurrently if fetch_workers is greater than 1
+        """
+        return self._pool.map(func, items)
 
     def convert_ts(self, timestamp):
         """
@@ -258,73 +920,272 @@ class CollectionScanner(object):
         kwargs = self.__get_kwargs.copy()
         original_meta = kwargs.pop('meta', [])
         meta = {'_key', '_ts'}.union(original_meta)
-        last_secondary_key = None
         batchcount = self.__batchsize
         max_next_records = self._get_max_next_records(batchcount)
         # start used only once, as HS nulifies startafter if start is given
         start = self.__start
         self.__start = ''
+        timer = StageTimer(self.stats.stage_seconds) if self.__profile else None
 
         while max_next_records and self.__enabled:
             count = 0
             jump_prefix = False
+            # never request an excluded range: if startafter falls inside one, jump over it in advance
+            exclude = self.__exclude_prefixes.match(self.__startafter) if self.__startafter else None
+            if exclude is not None:
+                self.__startafter = exclude + LIMIT_KEY_CHAR
+            # end of the current allowed key range
+            next_exclude = self.__exclude_prefixes.next_after(self.__startafter or '')
             for r in self.col.get(random_mode, count=[max_next_records], startafter=[self.__startafter], start=start, meta=meta, **kwargs):
-                if self.__stopbefore is not None and r['_key'].startswith(self.__stopbefore):
+                if timer:
+                    timer.mark('read')
+                if self.__stopbefore is not None and r['_key'] >= self.__stopbefore:
                     self.__enabled = False
                     break
                 count += 1
-                for exclude in self.__exclude_prefixes:
-                    if r['_key'].startswith(exclude):
+                if next_exclude is not None and r['_key'] >= next_exclude:
+                    exclude = self.__exclude_prefixes.match(r['_key'])
+                    if exclude is not None:
                         self.__startafter = exclude + LIMIT_KEY_CHAR
                         jump_prefix = True
+                        self.stats.exclude_jumps += 1
                         break
-                if jump_prefix:
-                    break
+                    next_exclude = self.__exclude_prefixes.next_after(r['_key'])
                 self.__startafter = self.lastkey = r['_key']
-                if last_secondary_key is None or self.__startafter > last_secondary_key:
-                    last_secondary_key, secondary_data = self.get_secondary_data(start=self.__startafter, meta=meta)
-                srecord = secondary_data.pop(r['_key'], None)
-                if srecord is not None:
-                    ts = srecord['_ts']
-                    r.update(srecord)
-                    if ts > r['_ts']:
-                        r['_ts'] = ts
+                if self.secondary:
+                    if timer:
+                        timer.mark('filter')
+                    self.join_secondary(r, meta)
+                    if timer:
+                        timer.mark('join')
 
                 if self.__endts and r['_ts'] > self.__endts:
+                    self.stats.dropped_endts += 1
+                    if timer:
+                        timer.mark('filter')
                     continue
 
-                for m in ['_key', '_ts']:
-                    if m not in original_meta:
-                        r.pop(m)
+                if not self.raw:
+                    for m in ['_key', '_ts']:
+                        if m not in original_meta:
+                            r.pop(m)
 
                 self.__scanned_count += 1
                 batchcount -= 1
                 if self.__scanned_count % 10000 == 0:
                     log.info("Last key: %s, Scanned %d", self.lastkey, self.__scanned_count)
+                if timer:
+                    timer.mark('filter')
                 yield r
+                if timer:
+                    timer.mark('consumer')
+            start = ''
             self.__enabled = count >= max_next_records and (
                 not self.__totalcount or self.__scanned_count < self.__totalcount) or jump_prefix
             max_next_records = self._get_max_next_records(batchcount)
+        self.stats.scanned = self.__scanned_count
+        self.stats.batches += 1
+        self.stats.cached_records = self.col.cached_records
+        self.stats.cache_bytes = self.__blocks_col.cache_bytes
+        self.stats.spilled_records = self.__blocks_col.spilled_records
+        for hook in self.__hooks:
+            hook.on_batch(self.stats)
+
+    def _get_next_records(self):
+        """
+        Number of records to get on each call to hubstorage server, before applying batch and count limits
+        """
+        if self.__adaptive_next_records is not None:
+            return self.__adaptive_next_records.value
+        return self.__max_next_records
 
     def _get_max_next_records(self, batchcount):
-        max_next_records = min(self.__max_next_records, batchcount)
+        max_next_records = min(self._get_next_records(), batchcount)
         if self.__totalcount:
             max_next_records = min(max_next_records, self.__totalcount - self.__scanned_count)
         return max_next_records
 
-    def scan_collection_batches(self):
+    def _read_batch(self, random_mode=False, columnar=False, fields=None):
+        """
+        Reads the next batch, as a list of records or as a columnar batch (see columnar.py)
+        """
+        if not columnar:
+            return list(self.get_new_batch(random_mode))
+        if columnar not in COLUMNAR_FORMATS:
+            raise ValueError('Unsupported columnar format: {}'.format(columnar))
+        if self.raw:
+            raise ValueError('Columnar batches are not supported in raw mode')
+        builder = ColumnBuilder(fields)
+        for record in self.get_new_batch(random_mode):
+            builder.append(record)
+        return builder.build(columnar)
+
+    def scan_collection_batches(self, columnar=False, fields=None):
+        """
+        Generates the batches of the scan, as lists of records.
+        columnar - if True or 'arrow', batches are generated as columns instead (see columnar.py)
+        fields - fields to keep in columnar batches. If None, all are kept.
+        """
         while self.__enabled:
-            batch = list(self.get_new_batch())
-            if batch:
+            batch = self._read_batch(columnar=columnar, fields=fields)
+            if num_rows(batch):
+                yielded = time.time()
                 yield batch
+                seconds = time.time() - yielded
+                self.stats.consumer_seconds += seconds
+                if self.__profile:
+                    self.stats.stage_seconds['consumer'] += seconds
+            self._batch_done()
+
+    def sample(self, n, codelen=2, block=20, oversample=4, prefixes=None, seed=None):
+        """
+        Returns an approximately uniform random sample of up to n records of the scanned key range, sorted by key,
+        without reading the collection end to end. Blocks of records are read concurrently after random key
+        positions of random partitions, and the sample is selected among them by reservoir sampling.
+        codelen - length of the key prefixes the random positions are generated in. Prefixes are discovered and
+                weighted by their number of records on a single random partition.
+        block - number of records read after each random position. Greater blocks reduce the bias towards records
+                that follow big gaps in the key space.
+        oversample - number of records read for each sampled one
+        prefixes - known key prefixes, either a list or a dict of weights (i.e. record counts) by prefix. If given,
+                they are not discovered (and not counted if weights are given).
+        seed - seed of the random generator
+        The scanner state is not modified, and secondary collections are not joined.
+        """
+        rand = random.Random(seed)
+        kwargs = self.__get_kwargs.copy()
+        original_meta = kwargs.pop('meta', [])
+        meta = {'_key', '_ts'}.union(original_meta)
+        partitions = self.__blocks_col.collections
+        lower = self.__start or self.__startafter or ''
+
+        weights = self._get_sample_weights(rand.choice(partitions), prefixes, codelen, kwargs)
+        # discard prefixes outside the scanned key range
+        weights = {p: w for p, w in weights.items() if w > 0 and p + LIMIT_KEY_CHAR > lower and
+                   (self.__stopbefore is None or p < self.__stopbefore) and self.__exclude_prefixes.match(p) is None}
+        if not weights:
+            return []
+        candidates = list(weights)
+        cum_weights = list(itertools.accumulate(weights[p] for p in candidates))
+        alphabet = self._get_sample_alphabet(rand, candidates, partitions, lower, block, kwargs)
+        if len(alphabet) < 2:
+            alphabet = sorted(string.digits + string.ascii_letters)
+
+        def _read_position(position):
+            partition, startafter = position
+            return self.__blocks_col._read_block(partition, startafter, sampling=True, count=[block], meta=meta,
+                                                 **kwargs)
+
+        reservoir = []
+        seen = set()
+        draws = math.ceil(n * oversample / block)
+        chunk = max(1, self.__fetch_workers) * 4
+        while draws > 0:
+            positions = []
+            for prefix in rand.choices(candidates, cum_weights=cum_weights, k=min(chunk, draws)):
+                position = prefix + ''.join(rand.choice(alphabet) for _ in range(SAMPLE_SUFFIX_LEN))
+                positions.append((rand.choice(partitions), max(position, lower)))
+            draws -= len(positions)
+            for records in self._map(_read_position, positions):
+                for r in records:
+                    key = r['_key']
+                    if key in seen or not self._in_scan_range(key) or \
+                            (self.__endts and r['_ts'] > self.__endts):
+                        continue
+                    seen.add(key)
+                    if len(reservoir) < n:
+                        reservoir.append(r)
+                    else:
+                        index = rand.randrange(len(seen))
+                        if index < n:
+                            reservoir[index] = r
+        reservoir.sort(key=itemgetter('_key'))
+        if self.raw:
+            return reservoir
+        for r in reservoir:
+            for m in ['_key', '_ts']:
+                if m not in original_meta:
+                    r.pop(m)
+        return reservoir
+
+    def _get_sample_alphabet(self, rand, prefixes, partitions, lower, block, kwargs):
+        """
+        Returns the sorted characters the random key positions of sample() are generated with: those found after
+        the prefix in the keys of a few blocks read at the start of random prefixes, all digits if any is found
+        (the first keys of a prefix only show the lowest ones), and the letters between the lowest and highest
+        found of each case (i.e. only a-f for hexadecimal keys).
+        """
+        tasks = [(rand.choice(partitions), prefix)
+                 for prefix in rand.sample(prefixes, min(len(prefixes), SAMPLE_ALPHABET_READS))]
+
+        def _read_suffixes(task):
+            partition, prefix = task
+            records = self.__blocks_col._read_block(partition, max(prefix, lower), sampling=True,
+                                                    count=[max(block, SAMPLE_ALPHABET_BLOCK)], meta=['_key'], **kwargs)
+            return [r['_key'][len(prefix):] for r in records if r['_key'].startswith(prefix)]
+
+        found = set(''.join(suffix for suffixes in self._map(_read_suffixes, tasks) for suffix in suffixes))
+        alphabet = set(found)
+        if found.intersection(string.digits):
+            alphabet.update(string.digits)
+        for chars in (string.ascii_lowercase, string.ascii_uppercase):
+            indexes = [chars.index(c) for c in found if c in chars]
+            if indexes:
+                alphabet.update(chars[min(indexes):max(indexes) + 1])
+        return sorted(alphabet)
+
+    def _get_sample_weights(self, partition, prefixes, codelen, kwargs):
+        """
+        Returns a dict of weights by prefix for sample(). Prefixes are discovered and counted on the given partition
+        if not given.
+        """
+        if isinstance(prefixes, dict):
+            return prefixes
+        user_prefixes = kwargs.get('prefix')
+        if isinstance(user_prefixes, str):
+            user_prefixes = [user_prefixes]
+        if prefixes is None:
+            prefixes = discover_prefixes([partition], codelen, map_func=self._map, prefix=user_prefixes)
+        count_kwargs = {k: v for k, v in kwargs.items() if k in ('startts', 'endts') and v}
+        counts = self._map(lambda p: partition.count(prefix=restrict_prefixes(p, user_prefixes) or [p],
+                                                     **count_kwargs), prefixes)
+        return dict(zip(prefixes, counts))
+
+    def _in_scan_range(self, key):
+        if self.__start and key < self.__start or self.__startafter and key <= self.__startafter:
+            return False
+        if self.__stopbefore is not None and key >= self.__stopbefore:
+            return False
+        return self.__exclude_prefixes.match(key) is None
 
     def close(self):
         log.info("Total scanned: %d", self.__scanned_count)
+        if self.__profile:
+            log.info("Seconds by scan stage: %s", ', '.join('{}={:.3f}'.format(stage, seconds)
+                                                           for stage, seconds in self.stats.stage_seconds.items()))
+        for hook in self.__hooks:
+            hook.on_close(self.stats)
+        self.col.close()
+        self._pool.shutdown()
         self.hsc.close()
 
     def set_startafter(self, startafter):
+        """
+        Sets the key to continue the scan after. Jumping past the last scanned key skips records, so the scan no
+        longer advances watermarks.
+        """
+        if startafter and (self.lastkey is None or startafter > self.lastkey):
+            self.__range_limited = True
         self.__startafter = startafter
 
+    def set_stopbefore(self, stopbefore):
+        """
+        Sets a new upper limit of the scan, i.e. when its key range is shrunk while scanning
+        """
+        self.__stopbefore = stopbefore
+        if stopbefore is not None:
+            self.__range_limited = True
+
     @staticmethod
     def str_to_msecs(strtime):
         """
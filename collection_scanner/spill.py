@@ -0,0 +1,95 @@
+"""
+Temporary on-disk store of partition cache entries evicted by the memory budget of the scanner
+
+Basic usage:
+
+from collection_scanner import CollectionScanner
+
+scanner = CollectionScanner(<collection name>, cache_memory=256 * 1024 ** 2, spill_dir='/path/to/tmp', **kwargs)
+
+When the estimated size of the records held in the partition caches exceeds cache_memory, the entries with the
+greatest keys (the last ones to be generated) are moved to a temporary SQLite database, and loaded back in key order
+when their partition cache is depleted. The database file is removed on scanner close.
+"""
+import os
+import pickle
+import sqlite3
+import logging
+import tempfile
+import threading
+
+
+__all__ = ['SpillStore']
+
+log = logging.getLogger(__name__)
+
+
+class SpillStore(object):
+    def __init__(self, directory=None):
+        """
+        directory - directory of the temporary database. If None, the system default one.
+        """
+        self.directory = directory
+        self.path = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            fd, self.path = tempfile.mkstemp(prefix='collection-scanner-', suffix='.db', dir=self.directory)
+            os.close(fd)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode = OFF')
+            self._conn.execute('PRAGMA synchronous = OFF')
+            self._conn.execute('CREATE TABLE entries (part INTEGER, key TEXT, data BLOB, PRIMARY KEY (part, key)) '
+                               'WITHOUT ROWID')
+            log.info('Spilling partition caches to %s', self.path)
+        return self._conn
+
+    def put(self, part, entries):
+        """
+        Stores a list of (key, record) entries of the given partition
+        """
+        with self._lock, self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                             ((part, key, pickle.dumps(record, pickle.HIGHEST_PROTOCOL)) for key, record in entries))
+
+    def take(self, part, limit):
+        """
+        Removes and returns up to limit entries of the given partition, with the lowest keys, in key order
+        """
+        with self._lock, self._connect() as conn:
+            rows = conn.execute('SELECT key, data FROM entries WHERE part = ? ORDER BY key LIMIT ?',
+                                (part, limit)).fetchall()
+            if rows:
+                conn.execute('DELETE FROM entries WHERE part = ? AND key <= ?', (part, rows[-1][0]))
+        return [(key, pickle.loads(data)) for key, data in rows]
+
+    def trim(self, part, startafter):
+        """
+        Removes the entries of the given partition with key not above startafter. Returns the number of removed ones.
+        """
+        if self._conn is None:
+            return 0
+        with self._lock, self._conn as conn:
+            return conn.execute('DELETE FROM entries WHERE part = ? AND key <= ?', (part, startafter)).rowcount
+
+    def last_key(self, part):
+        """
+        Returns the greatest key stored for the given partition, or None
+        """
+        if self._conn is None:
+            return None
+        with self._lock:
+            return self._conn.execute('SELECT MAX(key) FROM entries WHERE part = ?', (part,)).fetchone()[0]
+
+    def clear(self):
+        if self._conn is not None:
+            with self._lock, self._conn as conn:
+                conn.execute('DELETE FROM entries')
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            os.remove(self.path)
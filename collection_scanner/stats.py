@@ -0,0 +1,171 @@
+"""
+Scan metrics and instrumentation hooks
+
+Every CollectionScanner collects a ScanStats instance, available as scanner.stats:
+
+scanner = CollectionScanner(<collection name>, hooks=[MyHook()], **kwargs)
+for batch in scanner.scan_collection_batches():
+    ...
+print(scanner.stats.as_dict())
+
+Hooks are ScanHook subclasses that override the events they are interested in.
+"""
+import time
+import bisect
+import threading
+from collections import defaultdict
+
+from .raw import record_size
+
+
+__all__ = ['ScanHook', 'ScanStats', 'LatencyHistogram']
+
+
+class ScanHook(object):
+    """
+    Base class of scan hooks. All methods are no-op.
+    on_request() and on_retry() may be called from fetch threads.
+    """
+    def on_request(self, colname, requested, records, seconds):
+        """
+        Called after each read call to hubstorage, with the collection (or partition) name, the requested
+        count, the list of records read and the duration of the call.
+        """
+
+    def on_retry(self, colname, attempt, exception, delay):
+        """
+        Called when a read call fails and is going to be retried after delay seconds
+        """
+
+    def on_batch(self, stats):
+        """
+        Called when the scanner finishes the generation of a batch, with the scanner ScanStats
+        """
+
+    def on_close(self, stats):
+        """
+        Called when the scanner is closed
+        """
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of durations, in seconds, with fixed buckets
+    """
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket that contains the given percentile (0-100)
+        """
+        if not self.count:
+            return None
+        threshold = self.count * p / 100
+        accumulated = 0
+        for bucket, count in zip(self.BUCKETS, self.counts):
+            accumulated += count
+            if accumulated >= threshold:
+                return bucket
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {str(bucket): count for bucket, count in zip(self.BUCKETS, self.counts) if count},
+        }
+
+
+class ScanStats(ScanHook):
+    """
+    Collects scan metrics
+    """
+    def __init__(self, measure_bytes=False):
+        """
+        measure_bytes - if True, measure the size of read records as json. It has a cpu cost, so is disabled
+                by default.
+        """
+        self.measure_bytes = measure_bytes
+        self.started = time.time()
+        self.requests = defaultdict(int)
+        self.request_records = defaultdict(int)
+        self.request_seconds = defaultdict(float)
+        self.request_bytes = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.latency = LatencyHistogram()
+        self.scanned = 0
+        self.dropped_endts = 0
+        # number of jumps over excluded key ranges (records in them are never read)
+        self.exclude_jumps = 0
+        self.secondary_lookups = 0
+        self.secondary_hits = defaultdict(int)
+        self.cached_records = 0
+        self.cache_bytes = 0
+        self.spilled_records = 0
+        self.batches = 0
+        self.consumer_seconds = 0.0
+        # seconds by scan pipeline stage, when profiling (see profiling.py)
+        self.stage_seconds = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def on_request(self, colname, requested, records, seconds):
+        size = sum(record_size(r) for r in records) if self.measure_bytes else 0
+        with self._lock:
+            self.requests[colname] += 1
+            self.request_records[colname] += len(records)
+            self.request_seconds[colname] += seconds
+            self.request_bytes[colname] += size
+            self.latency.add(seconds)
+
+    def on_retry(self, colname, attempt, exception, delay):
+        with self._lock:
+            self.retries[colname] += 1
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def as_dict(self):
+        """
+        Returns a snapshot of the metrics as a json serializable dict
+        """
+        elapsed = self.elapsed
+        with self._lock:
+            read_records = sum(self.request_records.values())
+            read_bytes = sum(self.request_bytes.values())
+            return {
+                'elapsed': elapsed,
+                'scanned': self.scanned,
+                'batches': self.batches,
+                'records_per_second': self.scanned / elapsed if elapsed else None,
+                'read_records': read_records,
+                'read_records_per_second': read_records / elapsed if elapsed else None,
+                'read_bytes': read_bytes if self.measure_bytes else None,
+                'read_bytes_per_second': read_bytes / elapsed if elapsed and self.measure_bytes else None,
+                'requests': dict(self.requests),
+                'request_seconds': dict(self.request_seconds),
+                'latency': self.latency.as_dict(),
+                'retries': dict(self.retries),
+                'dropped_endts': self.dropped_endts,
+                'exclude_jumps': self.exclude_jumps,
+                'secondary_lookups': self.secondary_lookups,
+                'secondary_hit_rate': {name: hits / self.secondary_lookups
+                                       for name, hits in self.secondary_hits.items()} if self.secondary_lookups else {},
+                'cached_records': self.cached_records,
+                'cache_bytes': self.cache_bytes,
+                'spilled_records': self.spilled_records,
+                'consumer_seconds': self.consumer_seconds,
+                'stage_seconds': dict(self.stage_seconds),
+            }
@@ -1,6 +1,7 @@
 """
 utils for mocking hubstorage collection
 """
+import json
 from operator import itemgetter
 from copy import deepcopy
 
@@ -35,7 +36,11 @@ class FakeCollection(object):
         if start:
             startafter = ''
         endts = kwargs.get('endts')
-        retval = retval and key >= start and key > startafter and (not endts or self._get_basetime(key) < endts)
+        startts = kwargs.get('startts')
+        if isinstance(startts, list):
+            startts = startts[0]
+        retval = retval and key >= start and key > startafter and (not endts or self._get_basetime(key) < endts) \
+            and (not startts or self._get_basetime(key) >= startts)
         return retval
 
     def _get_basetime(self, key):
@@ -53,8 +58,8 @@ class FakeCollection(object):
         if isinstance(count, list):
             count = count[0] or None
         for key, value in self.samples:
-            rvalue = deepcopy(value)
             if self._must_issue_record(key, **kwargs):
+                rvalue = deepcopy(value)
                 if include_key:
                     rvalue['_key'] = key
                 if include_ts:
@@ -65,14 +70,44 @@ class FakeCollection(object):
                     if count == self.return_less or count == 0:
                         break
 
+    def iter_json(self, requests_params=None, **kwargs):
+        for record in self.get(**kwargs):
+            yield json.dumps(record)
+
+    def count(self, **kwargs):
+        return sum(1 for key, _ in self.samples if self._must_issue_record(key, **kwargs))
+
+class FlakyCollection(FakeCollection):
+    """
+    Raises a connection error (or the given error) in the middle of the first get calls
+    """
+    def __init__(self, name, samples, failures=3, fail_after=30, error=None, **kwargs):
+        super().__init__(name, samples, **kwargs)
+        self.failures = failures
+        self.fail_after = fail_after
+        self.error = error
+        self.calls = []
+
+    def get(self, **kwargs):
+        self.calls.append(kwargs)
+        for issued, record in enumerate(super().get(**kwargs)):
+            if issued == self.fail_after and self.failures:
+                self.failures -= 1
+                raise self.error or ConnectionError('Connection reset by peer')
+            yield record
+
 class FakeCollections(object):
     def __init__(self, project, **kwargs):
         self.project = project
         self.kwargs = kwargs
         self.collection_list = [{'name': n, 'type': 's'} for n in self.project.client.samples.keys()]
+        self.stores = {}
 
     def new_store(self, name):
-        return FakeCollection(name, self.project.client.samples[name], **self.kwargs)
+        if name not in self.stores:
+            self.stores[name] = self.project.client.collection_class(name, self.project.client.samples[name],
+                                                                     **self.kwargs)
+        return self.stores[name]
 
     def apiget(self, call):
         if call == 'list':
@@ -85,9 +120,17 @@ class FakeProject(object):
         self.collections = FakeCollections(self, **kwargs)
 
 class FakeClient(object):
+    collection_class = FakeCollection
+
     def __init__(self, samples, **kwargs):
         self.samples = samples
         self.kwargs = kwargs
+        self.project = None
 
     def get_project(self, *args):
-        return FakeProject(self, **self.kwargs)
+        if self.project is None:
+            self.project = FakeProject(self, **self.kwargs)
+        return self.project
+
+    def close(self):
+        pass
@@ -0,0 +1,152 @@
+"""
+Indexed fake hubstorage collection backend, able to simulate large collections
+
+Basic usage:
+
+from collection_scanner.tests.indexed import IndexedFakeClient, generate_samples, partition_samples
+
+samples = partition_samples('test', generate_samples(10 ** 6, record_size=200), partitions=4)
+client = IndexedFakeClient(samples, latency=0.05)
+
+Unlike FakeCollection, seeks are done by bisection on the sorted keys, so each get call only visits the
+records it issues, and records are copied shallowly.
+"""
+import json
+import time
+import bisect
+import random
+import zlib
+
+from . import FakeClient
+from ..utils import PrefixSet
+
+
+__all__ = ['IndexedFakeCollection', 'IndexedFakeClient', 'generate_samples', 'partition_samples']
+
+BASE_TIME = 1441940400000 # 2015-09-11
+TS_STEP = 3600000 # one hour
+
+
+def _first(value):
+    if isinstance(value, (list, tuple)):
+        return value[0] if value else None
+    return value
+
+
+def generate_samples(num_records, record_size=100, keylen=16, seed=0):
+    """
+    Returns a list of num_records tuples (key, record dict), with random hex keys of length keylen and
+    records with a single text field of approximately record_size bytes
+    """
+    rand = random.Random(seed)
+    keys = set()
+    while len(keys) < num_records:
+        keys.add('%0*x' % (keylen, rand.getrandbits(keylen * 4)))
+    filler = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(record_size))
+    return [(key, {'field': filler}) for key in keys]
+
+
+def partition_samples(name, samples, partitions):
+    """
+    Distributes samples by key hash into a dict of partitioned collections name_0..name_N. If partitions is 0,
+    returns a dict with the single collection name.
+    """
+    if not partitions:
+        return {name: samples}
+    result = {'{}_{}'.format(name, p): [] for p in range(partitions)}
+    for key, value in samples:
+        result['{}_{}'.format(name, zlib.crc32(key.encode()) % partitions)].append((key, value))
+    return result
+
+
+class IndexedFakeCollection(object):
+    def __init__(self, name, samples, return_less=0, latency=0, timestamps=None):
+        """
+        name is the collection name
+        samples is a list of tuples (key, record dict).
+        return_less - see FakeCollection
+        latency - seconds slept on each get and count call, before the first record is issued
+        timestamps - an optional dict of record _ts by key. By default, each record _ts is one hour after
+                the previous key one.
+        """
+        self.colname = name
+        self.samples = sorted(samples, key=lambda s: s[0])
+        self.keys = [key for key, _ in self.samples]
+        self.timestamps = [timestamps[key] for key in self.keys] if timestamps is not None else None
+        self.return_less = return_less
+        self.latency = latency
+        self.calls = 0
+
+    def _get_ts(self, index):
+        if self.timestamps is not None:
+            return self.timestamps[index]
+        return BASE_TIME + index * TS_STEP
+
+    def _iter_indexes(self, **kwargs):
+        """
+        Generates the indexes of the samples matching the key and timestamp filters
+        """
+        start = _first(kwargs.get('start'))
+        startafter = _first(kwargs.get('startafter'))
+        # start nulifies startafter
+        if start:
+            index = bisect.bisect_left(self.keys, start)
+        elif startafter:
+            index = bisect.bisect_right(self.keys, startafter)
+        else:
+            index = 0
+        prefix = kwargs.get('prefix')
+        prefixes = PrefixSet([prefix] if isinstance(prefix, str) else prefix) if prefix else None
+        startts = _first(kwargs.get('startts'))
+        endts = _first(kwargs.get('endts'))
+        while index < len(self.keys):
+            key = self.keys[index]
+            if prefixes is not None and prefixes.match(key) is None:
+                next_prefix = prefixes.next_after(key)
+                if next_prefix is None:
+                    return
+                index = bisect.bisect_left(self.keys, next_prefix, index)
+                continue
+            ts = self._get_ts(index)
+            if (not startts or ts >= startts) and (not endts or ts < endts):
+                yield index
+            index += 1
+
+    def get(self, **kwargs):
+        if not self.samples:
+            raise KeyError(None)
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        meta = kwargs.get('meta') or ()
+        nodata = kwargs.get('nodata')
+        count = _first(kwargs.get('count')) or None
+        for index in self._iter_indexes(**kwargs):
+            key, value = self.samples[index]
+            rvalue = {} if nodata else dict(value)
+            if '_key' in meta:
+                rvalue['_key'] = key
+            if '_ts' in meta:
+                rvalue['_ts'] = self._get_ts(index)
+            yield rvalue
+            if count is not None:
+                count -= 1
+                if count == self.return_less or count == 0:
+                    break
+
+    def iter_json(self, requests_params=None, **kwargs):
+        for record in self.get(**kwargs):
+            yield json.dumps(record)
+
+    def count(self, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return sum(1 for _ in self._iter_indexes(**kwargs))
+
+
+class IndexedFakeClient(FakeClient):
+    """
+    FakeClient on IndexedFakeCollection. Extra kwargs (return_less, latency) are passed to each collection.
+    """
+    collection_class = IndexedFakeCollection
@@ -0,0 +1,240 @@
+"""
+Local HTTP stand-in for the hubstorage collections API, for end to end load tests
+
+Basic usage:
+
+python -m collection_scanner.tests.server <data directory> --port 8002 --latency 0.05 --error-rate 0.01
+
+SH_APIKEY=any SHUB_STORAGE=http://127.0.0.1:8002/ python my_scan_script.py
+
+or, from python:
+
+with CollectionsServer.from_directory(<data directory>, latency=0.05) as server:
+    os.environ['SHUB_STORAGE'] = server.url
+    scanner = CollectionScanner(<collection name>, project_id=<any>, apikey=<any>)
+
+The data directory contains a json lines file per collection, named <collection name>.jl, with a record per line.
+Each record must contain a _key field, and may contain a _ts one. Partitioned collections are files named
+<collection name>_0.jl, ..., <collection name>_N.jl. write_collection() writes them from a list of samples.
+
+Implemented endpoints, for any project and store type:
+- GET collections/<project>/list
+- GET collections/<project>/<type>/<name>, with startafter, start, prefix, count, meta, startts, endts, nodata
+- GET collections/<project>/<type>/<name>/count, with the same filters
+- GET collections/<project>/<type>/<name>/<key>
+
+Responses are json lines, or msgpack if requested by the client and msgpack lib is available.
+"""
+import os
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .indexed import IndexedFakeCollection, partition_samples
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ['CollectionsServer', 'write_collection']
+
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+INT_PARAMS = ('count', 'startts', 'endts', 'nodata')
+
+log = logging.getLogger(__name__)
+
+
+def write_collection(directory, name, samples, partitions=0):
+    """
+    Writes samples (a list of tuples (key, record dict)) as collection files in the given directory,
+    distributed by key hash into the given number of partitions
+    """
+    os.makedirs(directory, exist_ok=True)
+    for colname, colsamples in partition_samples(name, samples, partitions).items():
+        with open(os.path.join(directory, colname + '.jl'), 'w') as f:
+            for key, value in colsamples:
+                f.write(json.dumps(dict(value, _key=key)) + '\n')
+
+
+def read_collection(path):
+    """
+    Returns the collection name, samples and timestamps read from a collection file
+    """
+    samples = []
+    timestamps = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = record.pop('_key')
+            ts = record.pop('_ts', None)
+            if ts is not None:
+                timestamps[key] = ts
+            samples.append((key, record))
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name, samples, timestamps
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt, *args)
+
+    def do_GET(self):
+        server = self.server.collections_server
+        url = urlsplit(self.path)
+        path = [unquote(p) for p in url.path.strip('/').split('/')]
+        params = parse_qs(url.query)
+        for name in INT_PARAMS:
+            if name in params:
+                params[name] = [int(v) for v in params[name]]
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random.random() < server.error_rate:
+            return self._send_error(503, 'Injected fault')
+
+        if len(path) < 3 or path[0] != 'collections':
+            return self._send_error(404, 'Not found')
+        if path[2] == 'list' and len(path) == 3:
+            return self._send_records([{'name': name, 'type': 's'} for name in sorted(server.collections)])
+        if len(path) < 4 or path[3] not in server.collections:
+            return self._send_error(404, 'Collection not found')
+        collection = server.collections[path[3]]
+        if len(path) == 4:
+            return self._send_records(collection.get(**params), msgpack_allowed=True)
+        if path[4] == 'count':
+            return self._send_records([{'count': collection.count(**params)}])
+        # a single key read ignores any start or count of the query
+        params.pop('start', None)
+        params.pop('count', None)
+        records = list(collection.get(start=path[4], count=1, **params))
+        if not records or records[0].get('_key', path[4]) != path[4]:
+            return self._send_error(404, 'Key not found')
+        return self._send_records(records, msgpack_allowed=True)
+
+    def _send_error(self, status, message):
+        body = message.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_records(self, records, msgpack_allowed=False):
+        server = self.server.collections_server
+        if msgpack_allowed and msgpack is not None and MSGPACK_CONTENT_TYPE in self.headers.get('Accept', ''):
+            content_type = MSGPACK_CONTENT_TYPE
+            body = b''.join(msgpack.packb(r) for r in records)
+        else:
+            content_type = 'application/x-jsonlines'
+            body = ''.join(json.dumps(r) + '\n' for r in records).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.disconnect_rate and server.random.random() < server.disconnect_rate:
+            # cut the connection in the middle of the response
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class CollectionsServer(object):
+    def __init__(self, collections, host='127.0.0.1', port=0, latency=0, error_rate=0, disconnect_rate=0,
+                 seed=None):
+        """
+        collections - a dict of collections by name. Values are either IndexedFakeCollection instances, or lists
+                of tuples (key, record dict).
+        host, port - address to listen on. With port 0, a free port is picked.
+        latency - seconds slept before each response
+        error_rate - probability of each request to fail with a 503 error
+        disconnect_rate - probability of each response to be cut in the middle
+        seed - seed of the fault injection random generator
+        """
+        self.collections = {}
+        for name, collection in collections.items():
+            if not isinstance(collection, IndexedFakeCollection):
+                collection = IndexedFakeCollection(name, collection)
+            self.collections[name] = collection
+        self.latency = latency
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.collections_server = self
+        self._thread = None
+
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        """
+        Creates a server of the collection files (*.jl) in the given directory
+        """
+        collections = {}
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.jl'):
+                name, samples, timestamps = read_collection(os.path.join(directory, filename))
+                collections[name] = IndexedFakeCollection(name, samples, timestamps=timestamps or None)
+        return cls(collections, **kwargs)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self):
+        """
+        Serves in a background thread
+        """
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local HTTP stand-in for the hubstorage collections API')
+    parser.add_argument('directory', help='directory of collection files (<collection name>.jl)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--latency', type=float, default=0, help='seconds slept before each response')
+    parser.add_argument('--error-rate', type=float, default=0, help='probability of 503 errors')
+    parser.add_argument('--disconnect-rate', type=float, default=0, help='probability of responses cut in the middle')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server = CollectionsServer.from_directory(args.directory, host=args.host, port=args.port, latency=args.latency,
+                                              error_rate=args.error_rate, disconnect_rate=args.disconnect_rate)
+    log.info('Serving %d collections at %s', len(server.collections), server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,206 @@
-import re
 import os
-import traceback
+import json
+import bisect
+import tempfile
 import collections.abc
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import exceptions as rexc
+
+from .registry import registry
 
 
 LIMIT_KEY_CHAR = '~'
 
 
-def retry_on_exception(exception):
-    print(f"Retried: {traceback.format_exc()}")
-    return not isinstance(exception, KeyboardInterrupt)
+def is_transient_error(exception):
+    """
+    Returns True if exception is a transient read error, worth a retry: connection errors, timeouts, and http
+    errors with status 429 or 5xx
+    """
+    if isinstance(exception, rexc.HTTPError):
+        status = exception.response.status_code if exception.response is not None else None
+        return status is not None and (status == 429 or status >= 500)
+    return isinstance(exception, (ConnectionError, TimeoutError, rexc.ConnectionError, rexc.Timeout,
+                                  rexc.ChunkedEncodingError))
 
 
 def get_num_partitions(hsp, collection_name):
     """Gets number of partitions of a partitioned collection.
     Returns None if collection is not partitioned
     """
-    partitions = []
-    partitions_re = re.compile(r'%s_(\d+)' % collection_name)
-    for entry in hsp.collections.apiget('list'):
-        m = partitions_re.match(entry['name'])
-        if m:
-            partitions.append(int(m.groups()[0]))
-    if partitions:
-        if len(partitions) == max(partitions) + 1:
-            return len(partitions)
+    return registry.get_num_partitions(hsp, collection_name)
 
 def filter_collections_exist(hsp, collection_names):
     """
     Filters a list of collections to return only those that do exist
     """
-    filtered = []
-    for entry in hsp.collections.apiget('list'):
-        if entry['name'] in collection_names:
-            filtered.append(entry['name'])
-    return filtered
+    return registry.filter_collections_exist(hsp, collection_names)
 
-def generate_prefixes(col, codelen, startafter=None, **kwargs):
+def generate_prefixes(col, codelen, startafter=None, block=1, **kwargs):
+    """
+    Generates the distinct key prefixes of given codelen found in col, in key order. Each request reads up to
+    block keys, and the next one jumps after the last prefix found.
+    """
     data = True
     while data:
         data = False
-        for r in col.get(nodata=1, meta=['_key'], startafter=startafter, count=1, **kwargs):
+        code = None
+        for r in col.get(nodata=1, meta=['_key'], startafter=startafter, count=block, **kwargs):
             data = True
-            code = r['_key'][:codelen]
+            rcode = r['_key'][:codelen]
+            if rcode != code:
+                code = rcode
+                yield code
+        if data:
             startafter = code + LIMIT_KEY_CHAR
-            yield code
+
+
+def restrict_prefixes(parent, prefixes):
+    """
+    Returns the list of prefixes that restrict a search inside the parent prefix to the given prefixes (None for
+    no restriction)
+    """
+    if not prefixes:
+        return [parent] if parent else None
+    restricted = []
+    for prefix in prefixes:
+        if prefix.startswith(parent):
+            restricted.append(prefix)
+        elif parent.startswith(prefix):
+            restricted.append(parent)
+    return sorted(set(restricted))
+
+
+def discover_prefixes(collections, codelen, block=1, map_func=None, level=None, on_level=None, **kwargs):
+    """
+    Returns the sorted list of all key prefixes of given codelen in the given collections (i.e. the partitions of
+    a collection), discovered level by level: the prefixes of each length are searched inside each prefix of the
+    previous length and each collection, with map_func(func, tasks) (by default, one after another).
+    block - number of keys read on each request
+    level - a tuple (length, prefixes) of an already known level to start from
+    on_level - a callable called with each discovered level length and prefixes
+    """
+    if map_func is None:
+        map_func = lambda func, tasks: [func(task) for task in tasks]
+    length, prefixes = level or (0, [''])
+    user_prefixes = kwargs.pop('prefix', None)
+    if isinstance(user_prefixes, str):
+        user_prefixes = [user_prefixes]
+    while length < codelen:
+        length += 1
+        tasks = []
+        for parent in prefixes:
+            parent_prefixes = restrict_prefixes(parent, user_prefixes)
+            if parent_prefixes is None or parent_prefixes:
+                tasks.extend((col, parent_prefixes) for col in collections)
+        results = map_func(lambda task: list(generate_prefixes(task[0], length, block=block, prefix=task[1],
+                                                               **kwargs)), tasks)
+        prefixes = sorted(set(prefix for result in results for prefix in result))
+        if on_level is not None:
+            on_level(length, prefixes)
+        # keys shorter than length can't be expanded
+        if all(len(prefix) < length for prefix in prefixes):
+            break
+    return prefixes
+
+
+class PrefixSet(object):
+    """
+    Sorted set of key prefixes, for fast lookup of the prefix a key starts with.
+    Prefixes that start with another prefix of the set are redundant and discarded, so the
+    key ranges covered by the remaining ones are disjoint.
+
+    >>> prefixes = PrefixSet(['AD4', 'AD1', 'AD12', 'B'])
+    >>> prefixes.match('AD123'), prefixes.match('AD2'), prefixes.next_after('AD2')
+    ('AD1', None, 'AD4')
+    """
+    def __init__(self, prefixes):
+        self.prefixes = []
+        for prefix in sorted(set(prefixes)):
+            if not self.prefixes or not prefix.startswith(self.prefixes[-1]):
+                self.prefixes.append(prefix)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def match(self, key):
+        """
+        Returns the prefix the given key starts with, or None
+        """
+        index = bisect.bisect_right(self.prefixes, key)
+        if index and key.startswith(self.prefixes[index - 1]):
+            return self.prefixes[index - 1]
+
+    def next_after(self, key):
+        """
+        Returns the lowest prefix above the given key, or None
+        """
+        index = bisect.bisect_right(self.prefixes, key)
+        if index < len(self.prefixes):
+            return self.prefixes[index]
+
+
+class WorkerPool(object):
+    """
+    Maps functions on lists of items with a thread pool of the given number of workers, created on first use.
+    With 1 worker or less, or a single item, items are mapped one after another in the calling thread.
+    """
+    def __init__(self, workers=0):
+        self.workers = workers
+        self._executor = None
+
+    def map(self, func, items):
+        if self.workers > 1 and len(items) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            return list(self._executor.map(func, items))
+        return [func(item) for item in items]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def read_json_file(path):
+    """
+    Returns the content of a json file, or an empty dict if it does not exist
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_json_file(path, data, tmp_prefix='.tmp'):
+    """
+    Replaces a json file atomically: data is durably written to a temporary file in the same directory, that is
+    then renamed to path
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=tmp_prefix)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+
+def normalize_kwargs(kwargs):
+    """
+    Returns a canonical json string of the given get arguments
+    """
+    normalized = {}
+    for key, value in kwargs.items():
+        if isinstance(value, (list, tuple, set)):
+            value = sorted(value) if key in ('meta', 'prefix') else list(value)
+            if len(value) == 1:
+                value = value[0]
+        if value not in (None, '', []):
+            normalized[key] = value
+    return json.dumps(normalized, sort_keys=True)
 
 
 def get_project_id():
@@ -8,12 +8,16 @@ setup(
     license='BSD',
     url= 'https://github.com/scrapinghub/collection-scanner',
     maintainer='Scrapinghub',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     install_requires = [
         'dateparser',
-        'retrying',
         'scrapinghub>=2.4.0',
     ],
+    extras_require = {
+        'msgpack': ['msgpack'],
+        'parquet': ['pyarrow'],
+        'arrow': ['pyarrow'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
@@ -0,0 +1,88 @@
+import os
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner
+from collection_scanner.adaptive import AdaptiveNextRecords
+from collection_scanner.tests import FakeClient
+
+
+class AdaptiveNextRecordsTest(TestCase):
+
+    def test_target_latency(self):
+        adaptive = AdaptiveNextRecords(100, 10000, target_latency=1.0, smoothing=1.0)
+        adaptive.start(1000)
+        self.assertEqual(adaptive.value, 1000)
+        adaptive.update(1000, 1000, 0.8)
+        self.assertEqual(adaptive.value, 1250)
+        # change is bounded on each step
+        adaptive.update(1000, 1000, 0.01)
+        self.assertEqual(adaptive.value, 2000)
+        adaptive.update(2000, 2000, 4)
+        self.assertEqual(adaptive.value, 1000)
+        # incomplete reads are not taken into account
+        adaptive.update(1000, 10, 0.01)
+        self.assertEqual(adaptive.value, 1000)
+
+    def test_target_rate(self):
+        adaptive = AdaptiveNextRecords(100, 10000, target_rate=2000, smoothing=1.0)
+        adaptive.start(1000)
+        adaptive.update(1000, 1000, 1)
+        self.assertEqual(adaptive.value, 2000)
+        adaptive.update(2000, 2000, 0.5)
+        self.assertEqual(adaptive.value, 1000)
+
+    def test_bounds_and_smoothing(self):
+        adaptive = AdaptiveNextRecords(100, 1500, target_latency=1.0, smoothing=0.5)
+        adaptive.start(50)
+        self.assertEqual(adaptive.value, 100)
+        adaptive.update(100, 100, 0.25)
+        self.assertEqual(adaptive.value, 150)
+        for _ in range(10):
+            adaptive.update(adaptive.value, adaptive.value, 0.1)
+        self.assertEqual(adaptive.value, 1500)
+
+    def test_single_target(self):
+        with self.assertRaises(ValueError):
+            AdaptiveNextRecords(target_latency=1, target_rate=1000)
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class AdaptiveScannerTest(TestCase):
+
+    samples = {
+        'test': [('AD%.4d' % i, {'field1': 'value 1-%.4d' % i}) for i in range(5000)],
+    }
+
+    def setUp(self):
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+
+    def _scan(self, client_mock, **kwargs):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        adaptive = AdaptiveNextRecords(10, 800, target_rate=10 ** 12)
+        scanner = CollectionScanner('test', meta=['_key'], batchsize=1000, max_next_records=10,
+                                    adaptive_next_records=adaptive, **kwargs)
+        col = scanner.col.col if kwargs.get('prefetch') else scanner.col
+        requested = []
+        original_get = col.collections[0].get
+        col.collections[0].get = lambda **kw: requested.append(kw['count'][0]) or original_get(**kw)
+        keys = [r['_key'] for batch in scanner.scan_collection_batches() for r in batch]
+        scanner.col.close()
+        return keys, requested
+
+    def test_grow(self, client_mock):
+        keys, requested = self._scan(client_mock)
+        self.assertEqual(keys, ['AD%.4d' % i for i in range(5000)])
+        self.assertEqual(requested[:4], [10, 15, 22, 33])
+        self.assertEqual(max(requested), 800)
+
+    def test_grow_prefetch(self, client_mock):
+        keys, requested = self._scan(client_mock, prefetch=2)
+        self.assertEqual(keys, ['AD%.4d' % i for i in range(5000)])
+        self.assertEqual(max(requested), 800)
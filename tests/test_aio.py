@@ -0,0 +1,124 @@
+import os
+import asyncio
+
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner, AsyncCollectionScanner, AsyncCollectionCounter
+from collection_scanner.tests import FakeClient, FakeCollection
+
+
+class BaseAsyncTest(IsolatedAsyncioTestCase):
+
+    samples = {
+        'test': [('AD%.3d' % i, {'field1': 'value 1-%.3d' % i}) for i in range(1000)],
+        'test2': [('AD%.3d' % i, {'field3': 'value 1-%.3d' % i}) for i in range(1000)],
+        'test3': [('AD%.3d' % i, {'field4': 'value 2-%.3d' % i}) for i in range(0, 1000, 2)],
+    }
+    for partition in range(4):
+        samples['testp_%d' % partition] = []
+    for i in range(4000):
+        samples['testp_%d' % (i % 4)].append(('AD%.4d' % i, {'field1': 'value 1-%.4d' % i}))
+
+    def setUp(self):
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class AsyncCollectionScannerTest(BaseAsyncTest):
+
+    async def _get_scanner_records(self, client_mock, **kwargs):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanner = AsyncCollectionScanner(**kwargs)
+        records = []
+        batch_count = 0
+        async for batch in scanner.scan_collection_batches():
+            batch_count += 1
+            records.extend(batch)
+        return scanner, records, batch_count
+
+    async def test_get(self, client_mock):
+        scanner, records, batch_count = \
+            await self._get_scanner_records(client_mock, collection_name='test', meta=['_key'], batchsize=300)
+        self.assertEqual(batch_count, 4)
+        self.assertEqual([r['_key'] for r in records], ['AD%.3d' % i for i in range(1000)])
+
+    async def test_columnar(self, client_mock):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanner = AsyncCollectionScanner('test', meta=['_key'], batchsize=300)
+        keys = []
+        async for batch in scanner.scan_collection_batches(columnar=True, fields=['_key']):
+            self.assertEqual(list(batch), ['_key'])
+            keys.extend(batch['_key'])
+        self.assertEqual(keys, ['AD%.3d' % i for i in range(1000)])
+
+    async def test_startafter_stopbefore_exclude_prefixes(self, client_mock):
+        scanner, records, batch_count = \
+            await self._get_scanner_records(client_mock, collection_name='test', meta=['_key'], startafter='AD3',
+                                            stopbefore='AD8', exclude_prefixes=['AD5'])
+        self.assertEqual(len(records), 400)
+        self.assertFalse(any(r['_key'].startswith('AD5') for r in records))
+
+    async def test_endts(self, client_mock):
+        scanner, records, batch_count = \
+            await self._get_scanner_records(client_mock, collection_name='test', meta=['_key'],
+                                            endts='2015-10-01 23:00:00')
+        self.assertEqual(len(records), 500)
+
+    async def test_partitioned(self, client_mock):
+        scanner, records, batch_count = \
+            await self._get_scanner_records(client_mock, collection_name='testp', meta=['_key'], batchsize=100)
+        self.assertEqual(batch_count, 40)
+        self.assertEqual([r['_key'] for r in records], ['AD%.4d' % i for i in range(4000)])
+
+    async def test_secondary_collections(self, client_mock):
+        class MyCollectionScanner(CollectionScanner):
+            secondary_collections = ['test2', 'test3']
+
+        scanner, records, batch_count = \
+            await self._get_scanner_records(client_mock, collection_name='test', meta=['_key'],
+                                            scanner_class=MyCollectionScanner)
+        self.assertEqual(len(records), 1000)
+        for i, record in enumerate(records):
+            self.assertEqual(record['field1'], record['field3'])
+            self.assertEqual('field4' in record, i % 2 == 0)
+
+    async def test_concurrent_scans(self, client_mock):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanners = [AsyncCollectionScanner('testp', meta=['_key'], batchsize=100, startafter='AD%d' % i)
+                    for i in range(4)]
+
+        async def _scan(scanner):
+            return [r['_key'] async for batch in scanner.scan_collection_batches() for r in batch]
+
+        results = await asyncio.gather(*[_scan(s) for s in scanners])
+        self.assertEqual([len(r) for r in results], [4000, 3000, 2000, 1000])
+
+
+@patch('collection_scanner.counter.ScrapinghubClient')
+class AsyncCollectionCounterTest(BaseAsyncTest):
+
+    async def test_count(self, client_mock):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        counter = AsyncCollectionCounter('testp')
+        self.assertEqual(await counter.count(), 4000)
+        self.assertEqual(await counter.count(prefix=['AD1']), 1000)
+        self.assertEqual(await counter.fast_count(), 4000)
+
+    async def test_count_cache(self, client_mock):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        counter = AsyncCollectionCounter('testp', cache_ttl=60)
+        self.assertEqual(await counter.count(prefix=['AD1']), 1000)
+        with patch.object(FakeCollection, 'count', side_effect=AssertionError('not cached')):
+            self.assertEqual(await counter.count(prefix=['AD1']), 1000)
+
+    async def test_get_prefixes(self, client_mock):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        counter = AsyncCollectionCounter('testp')
+        prefixes = [p async for p in counter.get_prefixes(3)]
+        self.assertEqual(sorted(prefixes), ['AD%d' % i for i in range(4)])
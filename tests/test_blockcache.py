@@ -0,0 +1,86 @@
+import os
+import time
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner
+from collection_scanner.blockcache import SQLiteBlockCache
+from collection_scanner.tests import FakeClient
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class BlockCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+        self.samples = {}
+        for partition in range(3):
+            self.samples['testp_%d' % partition] = []
+        for i in range(900):
+            self.samples['testp_%d' % (i % 3)].append(('AD%.3d' % i, {'field1': 'value 1-%.3d' % i}))
+
+    def tearDown(self):
+        os.environ = self.prev_env
+        self.tmpdir.cleanup()
+
+    def _get_cache(self, **kwargs):
+        return SQLiteBlockCache(os.path.join(self.tmpdir.name, 'blocks.db'), **kwargs)
+
+    def _scan(self, client, cache, **kwargs):
+        scanner = CollectionScanner('testp', meta=['_key'], batchsize=200, max_next_records=100, block_cache=cache,
+                                    **kwargs)
+        calls = []
+        for store in scanner.col.collections:
+            original_get = store.get
+            store.get = lambda original_get=original_get, **kw: calls.append(kw) or original_get(**kw)
+        records = [r for batch in scanner.scan_collection_batches() for r in batch]
+        for store in scanner.col.collections:
+            del store.get
+        return records, calls
+
+    def test_cached_scan(self, client_mock):
+        client_mock.return_value._hsclient = client = FakeClient(self.samples)
+        cache = self._get_cache()
+        records, calls = self._scan(client, cache)
+        self.assertEqual([r['_key'] for r in records], ['AD%.3d' % i for i in range(900)])
+        self.assertTrue(calls)
+        self.assertTrue(cache.size > 0)
+        cached_records, calls = self._scan(client, cache)
+        self.assertEqual(cached_records, records)
+        self.assertEqual(calls, [])
+        # different get arguments do not share blocks
+        _, calls = self._scan(client, cache, prefix=['AD1'])
+        self.assertTrue(calls)
+
+    def test_refresh(self, client_mock):
+        client_mock.return_value._hsclient = client = FakeClient(self.samples)
+        cache = self._get_cache(refresh_after=0)
+        self._scan(client, cache)
+        store = client.get_project().collections.new_store('testp_1')
+        store.samples[10] = ('AD031', {'field1': 'updated'})
+        store.timestamps['AD031'] = int(time.time() * 1000)
+        records, calls = self._scan(client, cache)
+        self.assertEqual(len(records), 900)
+        self.assertEqual(records[31], {'_key': 'AD031', 'field1': 'updated'})
+        # only records newer than the snapshots are requested
+        self.assertTrue(all(c['startts'] > 0 for c in calls))
+
+    def test_ttl(self, client_mock):
+        client_mock.return_value._hsclient = client = FakeClient(self.samples)
+        cache = self._get_cache(ttl=0)
+        self._scan(client, cache)
+        time.sleep(0.01)
+        _, calls = self._scan(client, cache)
+        self.assertTrue(calls)
+        self.assertFalse(any(c.get('startts') for c in calls))
+
+    def test_eviction(self, client_mock):
+        client_mock.return_value._hsclient = client = FakeClient(self.samples)
+        cache = self._get_cache(max_bytes=5000)
+        self._scan(client, cache)
+        self.assertTrue(0 < cache.size <= 5000)
@@ -0,0 +1,199 @@
+import os
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner
+from collection_scanner.checkpoint import FileCheckpointStore, SQLiteCheckpointStore
+from collection_scanner.tests import FakeClient
+from collection_scanner.tests.indexed import IndexedFakeClient, generate_samples, partition_samples
+
+
+class BaseCheckpointTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+        self.tmpdir.cleanup()
+
+    def get_store(self):
+        return FileCheckpointStore(os.path.join(self.tmpdir.name, 'checkpoints.json'))
+
+
+class FileCheckpointStoreTest(BaseCheckpointTest):
+
+    def test_store(self):
+        store = self.get_store()
+        self.assertIsNone(store.load('test'))
+        store.save('test', {'lastkey': 'AD001'})
+        store.save('other', {'lastkey': 'AD002'})
+        self.assertEqual(self.get_store().load('test'), {'lastkey': 'AD001'})
+        store.delete('test')
+        self.assertIsNone(store.load('test'))
+        self.assertEqual(store.load('other'), {'lastkey': 'AD002'})
+
+
+class SQLiteCheckpointStoreTest(FileCheckpointStoreTest):
+
+    def get_store(self):
+        return SQLiteCheckpointStore(os.path.join(self.tmpdir.name, 'checkpoints.db'))
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class ResumeScanTest(BaseCheckpointTest):
+
+    samples = {
+        'test': [('AD%.3d' % i, {'field1': 'value 1-%.3d' % i}) for i in range(1000)],
+        'test2': [('AD%.3d' % i, {'field3': 'value 1-%.3d' % i}) for i in range(300)],
+    }
+
+    class MyCollectionScanner(CollectionScanner):
+        secondary_collections = ['test2']
+
+    def _scan(self, client_mock, max_batches=None, scanner_class=CollectionScanner, **kwargs):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanner = scanner_class('test', meta=['_key'], batchsize=100, **kwargs)
+        keys = []
+        for batch in scanner.scan_collection_batches():
+            keys.extend(r['_key'] for r in batch)
+            if max_batches is not None and len(keys) >= max_batches * 100:
+                break
+        return scanner, keys
+
+    def test_resume(self, client_mock):
+        store = self.get_store()
+        # crash while processing the fourth batch
+        _, keys = self._scan(client_mock, max_batches=4, checkpoint_store=store)
+        self.assertEqual(len(keys), 400)
+        self.assertEqual(store.load('test')['lastkey'], 'AD299')
+        scanner, resumed_keys = self._scan(client_mock, checkpoint_store=store)
+        self.assertEqual(resumed_keys, ['AD%.3d' % i for i in range(300, 1000)])
+        self.assertEqual(scanner.scanned_count, 1000)
+        self.assertFalse(store.load('test')['enabled'])
+        # a finished scan stays finished
+        _, keys = self._scan(client_mock, checkpoint_store=store)
+        self.assertEqual(keys, [])
+
+    def test_resume_count(self, client_mock):
+        store = self.get_store()
+        self._scan(client_mock, max_batches=2, checkpoint_store=store, checkpoint_name='counted', count=450,
+                   checkpoint_interval=1)
+        scanner, keys = self._scan(client_mock, checkpoint_store=store, checkpoint_name='counted', count=450)
+        self.assertEqual(keys, ['AD%.3d' % i for i in range(100, 450)])
+
+    def test_resume_secondary(self, client_mock):
+        store = self.get_store()
+        self._scan(client_mock, max_batches=5, checkpoint_store=store, scanner_class=self.MyCollectionScanner)
+        state = store.load('test')
+        self.assertEqual(state['secondary_is_empty'], {'test2': True})
+        scanner, keys = self._scan(client_mock, checkpoint_store=store, scanner_class=self.MyCollectionScanner)
+        self.assertEqual(keys, ['AD%.3d' % i for i in range(400, 1000)])
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class IncrementalScanTest(BaseCheckpointTest):
+
+    all_samples = generate_samples(400, keylen=6)
+    samples = partition_samples('testp', all_samples, 4)
+
+    def _scan(self, client_mock, timestamps, max_batches=None, **kwargs):
+        client_mock.return_value._hsclient = IndexedFakeClient(self.samples, timestamps=timestamps)
+        kwargs.setdefault('watermark_margin', 0)
+        kwargs.setdefault('batchsize', 100)
+        scanner = CollectionScanner('testp', meta=['_key'], **kwargs)
+        keys = []
+        for batches, batch in enumerate(scanner.scan_collection_batches(), 1):
+            keys.extend(r['_key'] for r in batch)
+            if batches == max_batches:
+                break
+        return scanner, keys
+
+    def _expected(self, timestamps, watermarks, margin=0):
+        """
+        Keys with _ts not below the watermark of their partition
+        """
+        return sorted(key for name, samples in self.samples.items() for key, _ in samples
+                      if timestamps[key] >= watermarks[name] - margin)
+
+    def test_incremental(self, client_mock):
+        store = self.get_store()
+        timestamps = {key: 1000 + i for i, (key, _) in enumerate(self.all_samples)}
+        _, keys = self._scan(client_mock, timestamps, watermark_store=store)
+        self.assertEqual(len(keys), 400)
+        watermarks = store.load('testp')
+        self.assertEqual(watermarks['partitions'], {name: max(timestamps[key] for key, _ in samples)
+                                                    for name, samples in self.samples.items()})
+        self.assertEqual(watermarks['startts'], min(watermarks['partitions'].values()))
+
+        # only updated records (and the ones at the watermarks) are read
+        updated = sorted(key for key, _ in self.all_samples[:10])
+        for key in updated:
+            timestamps[key] = 5000
+        expected = self._expected(timestamps, watermarks['partitions'])
+        self.assertLess(len(expected), 20)
+        scanner, keys = self._scan(client_mock, timestamps, watermark_store=store)
+        self.assertEqual(keys, expected)
+        self.assertTrue(set(updated) <= set(keys))
+        self.assertEqual(scanner.stats.as_dict()['read_records'], len(expected))
+        watermarks = store.load('testp')
+        self.assertEqual(max(watermarks['partitions'].values()), 5000)
+
+        # unfinished scans and scans limited by count don't advance watermarks
+        timestamps[updated[0]] = 6000
+        self._scan(client_mock, timestamps, watermark_store=store, max_batches=1, batchsize=1)
+        self._scan(client_mock, timestamps, watermark_store=store, count=50)
+        self.assertEqual(store.load('testp'), watermarks)
+        _, keys = self._scan(client_mock, timestamps, watermark_store=store)
+        self.assertEqual(keys, self._expected(timestamps, watermarks['partitions']))
+        self.assertEqual(max(store.load('testp')['partitions'].values()), 6000)
+
+    def test_range_limited_scans(self, client_mock):
+        store = self.get_store()
+        timestamps = {key: 1000 + i for i, (key, _) in enumerate(self.all_samples)}
+        keys = sorted(key for key, _ in self.all_samples)
+        middle = keys[200]
+        # scans limited by key range don't save watermarks, so a later full scan still reads the rest of the keys
+        for kwargs in ({'stopbefore': middle}, {'startafter': middle}, {'start': middle}, {'prefix': [keys[0][0]]},
+                       {'exclude_prefixes': [keys[0][0]]}, {'startts': 1100}):
+            _, scanned = self._scan(client_mock, timestamps, watermark_store=store, **kwargs)
+            self.assertTrue(scanned)
+            self.assertIsNone(store.load('testp'))
+        _, scanned = self._scan(client_mock, timestamps, watermark_store=store)
+        self.assertEqual(scanned, keys)
+        self.assertIsNotNone(store.load('testp'))
+
+    def test_set_startafter_jump(self, client_mock):
+        store = self.get_store()
+        timestamps = {key: 1000 + i for i, (key, _) in enumerate(self.all_samples)}
+        keys = sorted(key for key, _ in self.all_samples)
+        client_mock.return_value._hsclient = IndexedFakeClient(self.samples, timestamps=timestamps)
+        scanner = CollectionScanner('testp', meta=['_key'], batchsize=50, watermark_store=store, watermark_margin=0)
+        scanned = []
+        for batch in scanner.scan_collection_batches():
+            scanned.extend(r['_key'] for r in batch)
+            if len(scanned) == 50:
+                # setting the last key again skips nothing
+                scanner.set_startafter(scanner.lastkey)
+            elif len(scanned) == 100:
+                scanner.set_startafter(keys[200])
+        self.assertEqual(scanned, keys[:100] + keys[201:])
+        self.assertIsNone(store.load('testp'))
+        _, scanned = self._scan(client_mock, timestamps, watermark_store=store)
+        self.assertEqual(scanned, keys)
+
+    def test_margin_and_endts(self, client_mock):
+        store = self.get_store()
+        timestamps = {key: 100000 + 1000 * i for i, (key, _) in enumerate(self.all_samples)}
+        _, keys = self._scan(client_mock, timestamps, watermark_store=store, endts=200000)
+        self.assertEqual(len(keys), 100)
+        watermarks = store.load('testp')['partitions']
+        self.assertEqual(max(watermarks.values()), 199000)
+        _, keys = self._scan(client_mock, timestamps, watermark_store=store, watermark_margin=10000)
+        self.assertEqual(keys, self._expected(timestamps, watermarks, margin=10000))
+        self.assertGreater(len(keys), 300)
@@ -1,13 +1,23 @@
 import os
+import time
+import bisect
 
 from unittest import TestCase
 from hashlib import sha256
 
 from unittest.mock import patch
 
+from requests import Response
+from requests.exceptions import HTTPError
+
 
 from collection_scanner import CollectionScanner
-from collection_scanner.tests import FakeClient
+from collection_scanner.scanner import _CachedBlocksCollection
+from collection_scanner.tests import FakeClient, FakeCollection, FlakyCollection
+from collection_scanner.utils import PrefixSet
+from collection_scanner.raw import RawRecord
+from collection_scanner.adaptive import AdaptiveNextRecords
+from collection_scanner.tests.indexed import IndexedFakeClient, generate_samples, partition_samples
 
 
 class BaseCollectionScannerTest(TestCase):
@@ -74,6 +84,26 @@ class CollectionScannerTest(BaseCollectionScannerTest):
         self.assertEqual(len(keys), 800)
         self.assertEqual(batch_count, 1)
 
+    def test_many_exclude_prefixes(self, client_mock):
+        exclude_prefixes = ['AD%.2d' % i for i in range(0, 100, 3)] + ['AD12', 'AD5', 'AD51', 'AD9']
+        scanner, records, keys, batch_count = \
+            self._get_scanner_records(client_mock, collection_name='test', exclude_prefixes=exclude_prefixes,
+                                      meta=['_key'], batchsize=100, max_next_records=40)
+        expected = ['AD%.3d' % i for i in range(1000)
+                    if not ('AD%.3d' % i).startswith(tuple(exclude_prefixes))]
+        self.assertEqual(records, [{'_key': k, 'field1': 'value 1-%s' % k[2:], 'field2': 'value 2-%s' % k[2:]}
+                                   for k in expected])
+
+    def test_exclude_prefixes_not_requested(self, client_mock):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanner = CollectionScanner('test', startafter='AD1', exclude_prefixes=['AD1', 'AD3'], meta=['_key'])
+        requested = []
+        original_get = scanner.col.get
+        scanner.col.get = lambda *args, **kwargs: requested.append(kwargs['startafter'][0]) or original_get(*args, **kwargs)
+        keys = [r['_key'] for batch in scanner.scan_collection_batches() for r in batch]
+        self.assertEqual(keys, ['AD%.3d' % i for i in range(200, 300)] + ['AD%.3d' % i for i in range(400, 1000)])
+        self.assertEqual(requested, ['AD1~', 'AD3~'])
+
     def test_startafter(self, client_mock):
         scanner, records, keys, batch_count = \
             self._get_scanner_records(client_mock, collection_name='test', startafter='AD8', meta=['_key'])
@@ -152,9 +182,11 @@ class CollectionScannerTest(BaseCollectionScannerTest):
 
     def test_start(self, client_mock):
         scanner, records, keys, batch_count = \
-            self._get_scanner_records(client_mock, collection_name='test', start='AD3', meta=['_key'], batchsize=100)
+            self._get_scanner_records(client_mock, collection_name='test', start='AD3', meta=['_key'], batchsize=100,
+                                      max_next_records=30)
         self.assertEqual(len(set(keys)), 700)
         self.assertEqual(len(keys), 700)
+        self.assertEqual(len(records), 700)
 
     def test_get_from_empty_collection(self, client_mock):
         scanner, records, keys, batch_count = \
@@ -163,6 +195,49 @@ class CollectionScannerTest(BaseCollectionScannerTest):
         self.assertEqual(batch_count, 0)
 
 
+class ReadAheadCollectionScannerTest(CollectionScannerTest):
+    """
+    Same tests as CollectionScannerTest, with read ahead enabled
+    """
+    def _get_scanner_records(self, client_mock, startafter_list=None, **kwargs):
+        kwargs.setdefault('prefetch', 2)
+        result = super()._get_scanner_records(client_mock, startafter_list, **kwargs)
+        result[0].col.close()
+        return result
+
+    @patch('collection_scanner.scanner.ScrapinghubClient')
+    def test_set_startafter_restarts_pipeline(self, client_mock):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanner = CollectionScanner('test', meta=['_key'], batchsize=100, max_next_records=50, prefetch=3)
+        batches = scanner.scan_collection_batches()
+        self.assertEqual(next(batches)[-1]['_key'], 'AD099')
+        scanner.set_startafter('AD150')
+        batch = next(batches)
+        self.assertEqual(batch[0]['_key'], 'AD151')
+        self.assertEqual(batch[-1]['_key'], 'AD250')
+        scanner.col.close()
+
+    @patch('collection_scanner.scanner.ScrapinghubClient')
+    def test_exclude_jump_keeps_pipeline(self, client_mock):
+        """
+        Jumps over excluded prefixes within the prefetched records don't restart the read ahead
+        """
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanner = CollectionScanner('test', meta=['_key'], batchsize=50, max_next_records=50, prefetch=4,
+                                    exclude_prefixes=['AD06', 'AD07'])
+        restarts = []
+        restart = scanner.col._restart
+        scanner.col._restart = lambda *args: restarts.append(args) or restart(*args)
+        batches = scanner.scan_collection_batches()
+        self.assertEqual(next(batches)[-1]['_key'], 'AD049')
+        while not scanner.col._queue.full():
+            time.sleep(0.01)
+        keys = [r['_key'] for batch in batches for r in batch]
+        self.assertEqual(keys, ['AD%.3d' % i for i in range(50, 1000) if not 60 <= i < 80])
+        self.assertEqual(len(restarts), 1)
+        scanner.col.close()
+
+
 @patch('collection_scanner.scanner.ScrapinghubClient')
 class CollectionScannerPartitionedTest(BaseCollectionScannerTest):
     samples = {}
@@ -223,6 +298,27 @@ class CollectionScannerPartitionedTest(BaseCollectionScannerTest):
         self.assertEqual(records[0]['_key'], 'AD0000')
         self.assertEqual(records[-1]['_key'], 'AD2499')
 
+    def test_partitioned_concurrent_fetch(self, client_mock):
+        _, expected, _, expected_batch_count = \
+            self._get_scanner_records(client_mock, collection_name='bigtestp', meta=['_key'], batchsize=1000)
+        scanner, records, keys, batch_count = \
+            self._get_scanner_records(client_mock, collection_name='bigtestp', meta=['_key'], batchsize=1000,
+                                      fetch_workers=4)
+        self.assertEqual(batch_count, expected_batch_count)
+        self.assertEqual(records, expected)
+        self.assertEqual(keys, [r['_key'] for r in records])
+
+    def test_partitioned_concurrent_fetch_startafter_per_batch(self, client_mock):
+        scanner, records, keys, batch_count = \
+            self._get_scanner_records(client_mock, collection_name='testp', meta=['_key'], batchsize=100,
+                                      startafter_list=['AD0099', 'AD1399', 'AD2799'], fetch_workers=4)
+        self.assertEqual(batch_count, 14)
+        self.assertEqual(records[0]['_key'], 'AD0100')
+        self.assertEqual(records[100]['_key'], 'AD1400')
+        self.assertEqual(records[200]['_key'], 'AD2800')
+        self.assertEqual(records[-1]['_key'], 'AD3999')
+        self.assertEqual(keys, [r['_key'] for r in records])
+
     def test_partitioned_count(self, client_mock):
         scanner, records, keys, batch_count = \
             self._get_scanner_records(client_mock, collection_name='testp', meta=['_key'], batchsize=100,
@@ -272,6 +368,219 @@ class SecondaryCollectionScannerTest(BaseCollectionScannerTest):
             self.assertEqual(record['field1'], record['field3'])
 
 
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class MultipleSecondaryCollectionScannerTest(BaseCollectionScannerTest):
+    samples = dict(BaseCollectionScannerTest.samples)
+    samples['test4'] = [('AD%.3d' % i, {'field4': 'value 4-%.3d' % i}) for i in range(0, 1000, 3)]
+    samples['test5'] = [('AD%.3d' % i, {'field5': 'value 5-%.3d' % i}) for i in range(700, 1000)]
+
+    class MyCollectionScanner(CollectionScanner):
+        secondary_collections = ['test2', 'test4', 'test5']
+
+    scanner_class = MyCollectionScanner
+
+    def _check_records(self, records):
+        for record in records:
+            i = int(record['_key'][2:])
+            self.assertEqual(record['field3'], record['field1'])
+            self.assertEqual(record.get('field4'), 'value 4-%.3d' % i if i % 3 == 0 else None)
+            self.assertEqual(record.get('field5'), 'value 5-%.3d' % i if i >= 700 else None)
+
+    def test_get(self, client_mock):
+        scanner, records, keys, batch_count = \
+            self._get_scanner_records(client_mock, collection_name='test', meta=['_key'], batchsize=100,
+                                      max_next_records=70)
+        self.assertEqual(len(records), 1000)
+        self._check_records(records)
+
+    def test_exclude_prefixes(self, client_mock):
+        scanner, records, keys, batch_count = \
+            self._get_scanner_records(client_mock, collection_name='test', meta=['_key'], batchsize=100,
+                                      max_next_records=70, exclude_prefixes=['AD1', 'AD2', 'AD3', 'AD8'])
+        self.assertEqual(len(records), 600)
+        self._check_records(records)
+
+    def test_concurrent_fetch(self, client_mock):
+        scanner, records, keys, batch_count = \
+            self._get_scanner_records(client_mock, collection_name='test', meta=['_key'], max_next_records=70,
+                                      fetch_workers=3)
+        self.assertEqual(len(records), 1000)
+        self._check_records(records)
+
+    def test_secondary_reads(self, client_mock):
+        """
+        Each secondary record is read only once
+        """
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanner = self.scanner_class('test', meta=['_key'], max_next_records=100)
+        gets = []
+        for cursor in scanner.secondary:
+            original_get = cursor.col.get
+            cursor.col.get = lambda original_get=original_get, **kwargs: gets.append(kwargs) or original_get(**kwargs)
+        records = [r for batch in scanner.scan_collection_batches() for r in batch]
+        self.assertEqual(len(records), 1000)
+        # test2: 10 blocks, test4: 4 blocks, test5: 3 blocks
+        self.assertEqual(len(gets), 17)
+
+
+class CachedBlocksCollectionTest(TestCase):
+    """
+    The merge must generate the same sequence of records as a plain sorted scan over all partitions
+    """
+    keys = sorted('AD%.4d' % (i * 7 % 10000) for i in range(3000))
+    samples = {}
+    for partition in range(5):
+        samples['merge_%d' % partition] = []
+    for i, key in enumerate(keys):
+        # uneven distribution among partitions
+        samples['merge_%d' % (i * i % 5)].append((key, {'_key': key, 'field': i}))
+
+    def _get_collection(self, **kwargs):
+        hsp = FakeClient(self.samples, **kwargs).get_project()
+        return _CachedBlocksCollection(hsp, 'merge', partitions=5)
+
+    def _expected(self, startafter, count):
+        return [k for k in self.keys if not startafter or k > startafter][:count]
+
+    def test_merge_order(self):
+        for return_less in (0, 7):
+            col = self._get_collection(return_less=return_less)
+            startafter = None
+            while True:
+                keys = [r['_key'] for r in col.get(count=[113], startafter=[startafter], meta=['_key'])]
+                self.assertEqual(keys, self._expected(startafter, 113))
+                if not keys:
+                    break
+                startafter = keys[-1]
+
+    def test_merge_order_with_jumps(self):
+        col = self._get_collection()
+        for startafter in [None, 'AD0500', 'AD0700', 'AD3000', 'AD7777', 'AD9990']:
+            keys = [r['_key'] for r in col.get(count=[50], startafter=[startafter], meta=['_key'])]
+            self.assertEqual(keys, self._expected(startafter, 50))
+
+    def test_merge_order_partial_consume(self):
+        col = self._get_collection()
+        startafter = None
+        for _ in range(10):
+            gen = col.get(count=[200], startafter=[startafter], meta=['_key'])
+            keys = [next(gen)['_key'] for _ in range(37)]
+            self.assertEqual(keys, self._expected(startafter, 37))
+            startafter = keys[-1]
+
+    def test_merge_order_concurrent(self):
+        col = self._get_collection()
+        col.fetch_workers = 3
+        startafter = None
+        while True:
+            keys = [r['_key'] for r in col.get(count=[97], startafter=[startafter], meta=['_key'])]
+            self.assertEqual(keys, self._expected(startafter, 97))
+            if not keys:
+                break
+            startafter = keys[-1]
+        col.close()
+
+
+class MemoryBudgetCachedBlocksCollectionTest(CachedBlocksCollectionTest):
+    """
+    Same merge tests, with partition caches constantly spilled to disk
+    """
+    def _get_collection(self, **kwargs):
+        hsp = FakeClient(self.samples, **kwargs).get_project()
+        return _CachedBlocksCollection(hsp, 'merge', partitions=5, memory_budget=1500)
+
+    def test_spill(self):
+        col = self._get_collection()
+        gen = col.get(count=[500], startafter=[None], meta=['_key'])
+        keys = [next(gen)['_key'] for _ in range(10)]
+        self.assertEqual(keys, self._expected(None, 10))
+        self.assertGreater(col.spilled_records, 0)
+        self.assertLessEqual(col.cache_bytes, 1500)
+        # lowered fetch size on next reads
+        self.assertLess(col._get_fetch_count(500, 5), 500)
+        self.assertTrue(os.path.exists(col.spill.path))
+        col.reset()
+        self.assertEqual(col.spilled_records, 0)
+        col.close()
+        self.assertFalse(os.path.exists(col.spill.path))
+
+
+@patch.object(_CachedBlocksCollection, 'RETRY_WAIT', 0)
+class ReadRetryTest(TestCase):
+    samples = [('AD%.3d' % i, {'_key': 'AD%.3d' % i}) for i in range(300)]
+
+    def _get_collection(self, collection):
+        col = _CachedBlocksCollection(FakeClient({'test': self.samples}).get_project(), 'test')
+        col.collections = [collection]
+        return col
+
+    def test_resume_from_last_key(self):
+        flaky = FlakyCollection('test', self.samples)
+        col = self._get_collection(flaky)
+        keys = [r['_key'] for r in col.get(count=[100], startafter=[None], meta=['_key'])]
+        self.assertEqual(keys, ['AD%.3d' % i for i in range(100)])
+        self.assertEqual([(c['startafter'], c['count']) for c in flaky.calls],
+                         [([None], [100]), (['AD029'], [70]), (['AD059'], [40]), (['AD089'], [10])])
+        self.assertEqual(col.total_retries['test'], 3)
+
+    def test_retry_budget(self):
+        flaky = FlakyCollection('test', self.samples, failures=20, fail_after=0)
+        col = self._get_collection(flaky)
+        with self.assertRaises(ConnectionError):
+            list(col.get(count=[100], startafter=[None], meta=['_key']))
+        self.assertEqual(len(flaky.calls), _CachedBlocksCollection.RETRY_MAX_ATTEMPTS)
+
+    def test_progress_resets_budget(self):
+        flaky = FlakyCollection('test', self.samples, failures=15, fail_after=5)
+        col = self._get_collection(flaky)
+        keys = [r['_key'] for r in col.get(count=[100], startafter=[None], meta=['_key'])]
+        self.assertEqual(keys, ['AD%.3d' % i for i in range(100)])
+        self.assertEqual(col.total_retries['test'], 15)
+
+    def test_permanent_errors_not_retried(self):
+        for error in (ValueError('Bad request'), self._http_error(404)):
+            flaky = FlakyCollection('test', self.samples, failures=1, fail_after=0, error=error)
+            col = self._get_collection(flaky)
+            with self.assertRaises(type(error)):
+                list(col.get(count=[100], startafter=[None], meta=['_key']))
+            self.assertEqual(len(flaky.calls), 1)
+
+    def test_transient_http_errors_retried(self):
+        for status in (429, 503):
+            flaky = FlakyCollection('test', self.samples, failures=2, fail_after=10, error=self._http_error(status))
+            col = self._get_collection(flaky)
+            self.assertEqual(len(list(col.get(count=[100], startafter=[None], meta=['_key']))), 100)
+            self.assertEqual(col.total_retries['test'], 2)
+
+    @staticmethod
+    def _http_error(status):
+        response = Response()
+        response.status_code = status
+        return HTTPError(response=response)
+
+
+class PrefixSetTest(TestCase):
+    def test_match(self):
+        prefixes = PrefixSet(['AD4', 'AD1', 'AD12', 'B', 'AD1'])
+        self.assertEqual(prefixes.prefixes, ['AD1', 'AD4', 'B'])
+        self.assertEqual(prefixes.match('AD1'), 'AD1')
+        self.assertEqual(prefixes.match('AD123'), 'AD1')
+        self.assertEqual(prefixes.match('AD2'), None)
+        self.assertEqual(prefixes.match('AD'), None)
+        self.assertEqual(prefixes.match('BZZ'), 'B')
+        self.assertEqual(prefixes.match('A'), None)
+        self.assertEqual(prefixes.match('C'), None)
+
+    def test_next_after(self):
+        prefixes = PrefixSet(['AD4', 'AD1', 'B'])
+        self.assertEqual(prefixes.next_after(''), 'AD1')
+        self.assertEqual(prefixes.next_after('AD1'), 'AD4')
+        self.assertEqual(prefixes.next_after('AD1~'), 'AD4')
+        self.assertEqual(prefixes.next_after('AD5'), 'B')
+        self.assertEqual(prefixes.next_after('B'), None)
+        self.assertEqual(PrefixSet([]).next_after(''), None)
+
+
 class MiscelaneousTest(TestCase):
     def test_str_to_msecs(self):
         self.assertEqual(CollectionScanner.str_to_msecs(100), 100)
@@ -280,3 +589,171 @@ class MiscelaneousTest(TestCase):
         self.assertEqual(CollectionScanner.str_to_msecs('2015-09-08 20:00:00'), 1441742400000)
         self.assertEqual(CollectionScanner.str_to_msecs('2015-09-08T20:00:00'), 1441742400000)
         self.assertEqual(CollectionScanner.str_to_msecs(None), 0)
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class SampleTest(TestCase):
+    samples = partition_samples('test', generate_samples(20000, keylen=8), 4)
+    all_keys = sorted(key for partition in samples.values() for key, _ in partition)
+
+    def setUp(self):
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+
+    def _get_scanner(self, client_mock, **kwargs):
+        self.client = IndexedFakeClient(self.samples)
+        client_mock.return_value._hsclient = self.client
+        return CollectionScanner('test', fetch_workers=4, **kwargs)
+
+    def test_sample(self, client_mock):
+        scanner = self._get_scanner(client_mock, meta=['_key'])
+        sample = scanner.sample(500, seed=1)
+        keys = [r['_key'] for r in sample]
+        self.assertEqual(len(keys), 500)
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertTrue(set(keys) <= set(self.all_keys))
+        self.assertNotIn('_ts', sample[0])
+        self.assertLess(scanner.stats.as_dict()['read_records'], len(self.all_keys) / 5)
+        # roughly uniform: each quarter of the key space gets about a quarter of the sample
+        ranks = [bisect.bisect_left(self.all_keys, key) * 4 // len(self.all_keys) for key in keys]
+        for quarter in range(4):
+            self.assertGreater(ranks.count(quarter), 80)
+        self.assertEqual(scanner.scanned_count, 0)
+        self.assertEqual([r['_key'] for r in self._get_scanner(client_mock, meta=['_key']).sample(500, seed=1)],
+                         keys)
+
+    def test_sample_key_range(self, client_mock):
+        scanner = self._get_scanner(client_mock, startafter='4', stopbefore='c', exclude_prefixes=['6', '7a'])
+        sample = scanner.sample(300, seed=2)
+        self.assertEqual(len(sample), 300)
+        self.assertNotIn('_key', sample[0])
+        scanner = self._get_scanner(client_mock, startafter='4', stopbefore='c', exclude_prefixes=['6', '7a'],
+                                    meta=['_key', '_ts'], prefix=['5', '7', 'b'])
+        keys = [r['_key'] for r in scanner.sample(300, seed=2)]
+        self.assertEqual(len(keys), 300)
+        self.assertTrue(all(key[0] in '57b' and not key.startswith('7a') for key in keys))
+
+    def test_sample_known_prefixes(self, client_mock):
+        scanner = self._get_scanner(client_mock, meta=['_key'])
+        prefixes = {'%x' % i: 1 for i in range(16)}
+        keys = [r['_key'] for r in scanner.sample(100, prefixes=prefixes, seed=3)]
+        self.assertEqual(len(keys), 100)
+        calls = sum(store.calls for store in self.client.get_project().collections.stores.values())
+        # 4 reads to find the key characters, and 20 sample reads
+        self.assertEqual(calls, 24)
+
+    def test_sample_digit_keys(self, client_mock):
+        samples = {'testd': [('AD%.3d' % i, {'field1': i}) for i in range(1000)]}
+        keys = ['AD%.3d' % i for i in range(1000)]
+        for codelen in (2, 3):
+            client_mock.return_value._hsclient = FakeClient(samples)
+            scanner = CollectionScanner('testd', meta=['_key'])
+            sample = [r['_key'] for r in scanner.sample(50, codelen=codelen, block=5, seed=4)]
+            self.assertEqual(len(sample), 50)
+            # random positions are made of digits, so the sample is not biased to the first keys of each prefix
+            ranks = [keys.index(key) for key in sample]
+            self.assertGreater(sum(rank >= 500 for rank in ranks), 15)
+            self.assertGreater(sum(rank % 100 >= 50 for rank in ranks), 15)
+
+    def test_sample_not_notified_to_adaptive(self, client_mock):
+        adaptive = AdaptiveNextRecords(min_next_records=100, max_next_records=5000, target_latency=1)
+        scanner = self._get_scanner(client_mock, meta=['_key'], max_next_records=2000,
+                                    adaptive_next_records=adaptive)
+        scanner.sample(100, seed=3)
+        self.assertEqual(adaptive.value, 2000)
+        self.assertGreater(scanner.stats.as_dict()['read_records'], 0)
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class ColumnarTest(TestCase):
+    samples = {
+        'test': [('AD%.3d' % i, {'field1': i, 'field2': 'value 2-%.3d' % i}) for i in range(1000)],
+        'test2': [('AD%.3d' % i, {'field3': i}) for i in range(0, 1000, 2)],
+    }
+
+    def setUp(self):
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+
+    def _get_scanner(self, client_mock, **kwargs):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        return CollectionScanner('test', batchsize=300, **kwargs)
+
+    def test_columns(self, client_mock):
+        scanner = self._get_scanner(client_mock, meta=['_key', '_ts'], secondary_collections=['test2'])
+        batches = list(scanner.scan_collection_batches(columnar=True))
+        self.assertEqual([len(batch['_key']) for batch in batches], [300, 300, 300, 100])
+        batch = batches[0]
+        self.assertEqual(list(batch), ['field1', 'field2', '_key', '_ts', 'field3'])
+        self.assertEqual(batch['_ts'].typecode, 'q')
+        self.assertEqual(batch['_key'][:2], ['AD000', 'AD001'])
+        self.assertEqual(batch['field1'][:2], [0, 1])
+        self.assertEqual(batch['field3'][:3], [0, None, 2])
+        self.assertEqual(scanner.scanned_count, 1000)
+
+    def test_projection(self, client_mock):
+        scanner = self._get_scanner(client_mock, meta=['_ts'])
+        batches = list(scanner.scan_collection_batches(columnar=True, fields=['_ts', 'field2', 'missing']))
+        self.assertEqual(list(batches[-1]), ['_ts', 'field2', 'missing'])
+        self.assertEqual(batches[-1]['field2'][-1], 'value 2-999')
+        self.assertEqual(batches[-1]['missing'], [None] * 100)
+        self.assertTrue(all(ts > 0 for batch in batches for ts in batch['_ts']))
+
+    def test_unsupported_format(self, client_mock):
+        scanner = self._get_scanner(client_mock)
+        with self.assertRaises(ValueError):
+            next(scanner.scan_collection_batches(columnar='numpy'))
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class RawTest(TestCase):
+    samples = {
+        'raw_%d' % p: [('AD%.3d' % i, {'field1': i, 'nested': {'_key': 'x'} if i % 10 == 0 else None})
+                       for i in range(p, 1000, 3)]
+        for p in range(3)
+    }
+
+    def setUp(self):
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+
+    def _get_scanner(self, client_mock, samples=None, **kwargs):
+        client_mock.return_value._hsclient = FakeClient(samples or self.samples)
+        return CollectionScanner('raw', batchsize=300, raw=True, **kwargs)
+
+    def test_raw_records(self, client_mock):
+        scanner = self._get_scanner(client_mock, cache_memory=2000, prefetch=2)
+        records = [r for batch in scanner.scan_collection_batches() for r in batch]
+        self.assertTrue(all(isinstance(r, RawRecord) for r in records))
+        self.assertEqual([r.key for r in records], ['AD%.3d' % i for i in range(1000)])
+        self.assertTrue(all(r.ts > 0 for r in records))
+        self.assertEqual(records[10]['_key'], 'AD010')
+        self.assertEqual(records[10]['nested'], {'_key': 'x'})
+        decoded = records[11].decode()
+        self.assertEqual(decoded, {'field1': 11, 'nested': None, '_key': 'AD011', '_ts': records[11].ts})
+        self.assertEqual(scanner.scanned_count, 1000)
+
+    def test_from_json(self, client_mock):
+        record = RawRecord.from_json('{"_key": "a\\"b", "_ts": 12, "f": "\\"_key\\": \\"c\\""}')
+        self.assertEqual((record.key, record.ts), ('a"b', 12))
+        record = RawRecord.from_json('{"sub": {"_ts": 5}, "_ts": 12, "_key": "k"}')
+        self.assertEqual((record.key, record.ts), ('k', 12))
+
+    def test_unsupported(self, client_mock):
+        samples = dict(self.samples, raw2=[('AD000', {'field': 1})])
+        with self.assertRaises(ValueError):
+            self._get_scanner(client_mock, samples, secondary_collections=['raw2'])
+        with self.assertRaises(ValueError):
+            next(self._get_scanner(client_mock).scan_collection_batches(columnar=True))
@@ -0,0 +1,134 @@
+import os
+import time
+import tempfile
+import threading
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner.coordinator import ScanCoordinator, FileLeaseBackend, SQLiteLeaseBackend
+from collection_scanner.tests import FakeClient
+
+
+class FileLeaseBackendTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_backend(self):
+        return FileLeaseBackend(self.tmpdir.name)
+
+    def test_leases(self):
+        backend = self.get_backend()
+        self.assertTrue(backend.init('scan', [None, 'B'], ['A', 'B', 'C']))
+        self.assertFalse(backend.init('scan', [None], []))
+        first = backend.claim('scan', 'w1', ttl=60)
+        self.assertEqual((first['start'], first['stop']), (None, 'B'))
+        second = backend.claim('scan', 'w2', ttl=60)
+        self.assertEqual((second['start'], second['stop']), ('B', None))
+        self.assertIsNone(backend.claim('scan', 'w3', ttl=60))
+        self.assertEqual(backend.renew('scan', first['id'], 'w1', 60, {'lastkey': 'A0'})['state'], {'lastkey': 'A0'})
+        self.assertIsNone(backend.renew('scan', first['id'], 'w2', 60, {}))
+        # expired leases are claimed again, with their progress
+        with patch('collection_scanner.coordinator.time.time', return_value=10 ** 11):
+            lease = backend.claim('scan', 'w3', ttl=60)
+        self.assertEqual((lease['id'], lease['state']), (first['id'], {'lastkey': 'A0'}))
+        self.assertIsNone(backend.renew('scan', first['id'], 'w1', 60, {}))
+        self.assertFalse(backend.complete('scan', first['id'], 'w1'))
+        self.assertTrue(backend.complete('scan', first['id'], 'w3'))
+        self.assertFalse(backend.is_done('scan'))
+        self.assertTrue(backend.complete('scan', second['id'], 'w2'))
+        self.assertTrue(backend.is_done('scan'))
+        backend.delete('scan')
+        self.assertEqual(backend.get_ranges('scan'), [])
+
+    def test_split(self):
+        backend = self.get_backend()
+        backend.init('scan', [None], ['A', 'B', 'C', 'D', 'E'])
+        lease = backend.claim('scan', 'w1', ttl=60)
+        self.assertFalse(backend.request_split('scan', 'w1'))
+        self.assertTrue(backend.request_split('scan', 'w2'))
+        self.assertIsNone(backend.claim('scan', 'w2', ttl=60))
+        # split on renewal, ahead of the owner progress
+        self.assertEqual(backend.renew('scan', lease['id'], 'w1', 60, {'lastkey': 'B5'})['stop'], 'D')
+        self.assertEqual(backend.renew('scan', lease['id'], 'w1', 60, {'lastkey': 'B6'})['stop'], 'D')
+        claimed = backend.claim('scan', 'w2', ttl=60)
+        self.assertEqual((claimed['start'], claimed['stop']), ('D', None))
+        self.assertTrue(backend.request_split('scan', 'w3'))
+        backend.renew('scan', lease['id'], 'w1', 60, {'lastkey': 'B7'})
+        self.assertEqual(backend.claim('scan', 'w3', ttl=60)['start'], 'C')
+        self.assertEqual([(r['start'], r['stop']) for r in backend.get_ranges('scan')],
+                         [(None, 'C'), ('C', 'D'), ('D', None)])
+        # no split points ahead of progress
+        backend.renew('scan', lease['id'], 'w1', 60, {'lastkey': 'B8'})
+        backend.renew('scan', claimed['id'], 'w2', 60, {'lastkey': 'E1'})
+        self.assertFalse(backend.request_split('scan', 'w4'))
+
+
+class SQLiteLeaseBackendTest(FileLeaseBackendTest):
+
+    def get_backend(self):
+        return SQLiteLeaseBackend(os.path.join(self.tmpdir.name, 'leases.db'))
+
+
+@patch('collection_scanner.counter.ScrapinghubClient')
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class ScanCoordinatorTest(TestCase):
+
+    samples = {}
+    for partition in range(4):
+        samples['testp_%d' % partition] = []
+    for i in range(4000):
+        samples['testp_%d' % (i % 4)].append(('AD%.4d' % i, {'field1': 'value 1-%.4d' % i}))
+
+    all_keys = ['AD%.4d' % i for i in range(4000)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prev_env = os.environ
+        os.environ = dict(os.environ, SH_APIKEY='apikey', SHUB_JOBKEY='10/1/1')
+
+    def tearDown(self):
+        os.environ = self.prev_env
+        self.tmpdir.cleanup()
+
+    def _get_coordinator(self, scanner_mock, counter_mock, **kwargs):
+        scanner_mock.return_value._hsclient = counter_mock.return_value._hsclient = FakeClient(self.samples)
+        backend = SQLiteLeaseBackend(os.path.join(self.tmpdir.name, 'leases.db'))
+        return ScanCoordinator('testp', backend, meta=['_key'], batchsize=100, poll_interval=0.01, **kwargs)
+
+    def test_workers(self, scanner_mock, counter_mock):
+        coordinator = self._get_coordinator(scanner_mock, counter_mock, ranges=2, split_codelen=4)
+        keys = []
+
+        def _work(worker):
+            for batch in coordinator.scan_collection_batches(worker=worker):
+                keys.extend(r['_key'] for r in batch)
+                time.sleep(0.001)
+        workers = [threading.Thread(target=_work, args=('w%d' % i,)) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sorted(keys), self.all_keys)
+        ranges = coordinator.backend.get_ranges('testp')
+        # idle workers got work by splitting ranges
+        self.assertGreater(len(ranges), 2)
+        self.assertTrue(coordinator.backend.is_done('testp'))
+
+    def test_resume_expired(self, scanner_mock, counter_mock):
+        split_points = ['AD%.4d' % i for i in range(500, 4000, 500)]
+        coordinator = self._get_coordinator(scanner_mock, counter_mock, ranges=1, split_points=split_points,
+                                            lease_ttl=60, startafter='AD0099', stopbefore='AD3900')
+        crashed = coordinator.scan_collection_batches(worker='crashed')
+        keys = [r['_key'] for _ in range(3) for r in next(crashed)]
+        self.assertEqual(keys, ['AD%.4d' % i for i in range(100, 400)])
+        with patch('collection_scanner.coordinator.time.time', return_value=10 ** 11):
+            # expired range resumes after the last processed batch. Third one was not acknowledged.
+            keys = [r['_key'] for batch in coordinator.scan_collection_batches(worker='other') for r in batch]
+        self.assertEqual(keys, ['AD%.4d' % i for i in range(300, 3900)])
+        # crashed worker lost its lease
+        self.assertEqual(next(crashed, None), None)
@@ -0,0 +1,149 @@
+import os
+import random
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionCounter
+from collection_scanner.counter import PrefixIndex
+from collection_scanner.tests.indexed import IndexedFakeClient
+
+
+@patch('collection_scanner.counter.ScrapinghubClient')
+class CollectionCounterTest(TestCase):
+
+    samples = {'testp_%d' % p: [('AD%.5d' % i, {'field': i}) for i in range(p, 16000, 16)] for p in range(16)}
+    # uneven partitions
+    for p in range(16):
+        samples['testu_%d' % p] = [('AD%.4d' % i, {'field': i}) for i in range(100 * (p + 1))]
+
+    def setUp(self):
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+
+    def _get_counter(self, client_mock, name='testp', **kwargs):
+        client_mock.return_value._hsclient = IndexedFakeClient(self.samples)
+        return CollectionCounter(name, **kwargs)
+
+    def test_count(self, client_mock):
+        for fetch_workers in (0, 8):
+            counter = self._get_counter(client_mock, fetch_workers=fetch_workers)
+            self.assertEqual(len(counter.collections), 16)
+            self.assertEqual(counter.count(), 16000)
+            self.assertEqual(counter.count(prefix=['AD01']), 1000)
+            self.assertEqual(counter.fast_count(), 16000)
+            counter.close()
+
+    def test_count_positional_args(self, client_mock):
+        counter = self._get_counter(client_mock)
+        with patch.object(type(counter.collections[0]), 'count', return_value=1) as count:
+            self.assertEqual(counter.count({'prefix': ['AD01']}), 16)
+        count.assert_called_with({'prefix': ['AD01']})
+        counter.close()
+
+    def test_estimate_count(self, client_mock):
+        counter = self._get_counter(client_mock)
+        self.assertEqual(tuple(counter.estimate_count(samples=16)), (16000, 16000, 16000, 16, 16))
+        self.assertEqual(tuple(counter.estimate_count(samples=4)), (16000, 16000, 16000, 4, 16))
+        self.assertEqual(tuple(counter.estimate_count(samples=1)), (16000, None, None, 1, 16))
+        counter.close()
+
+    def test_estimate_count_uneven(self, client_mock):
+        counter = self._get_counter(client_mock, 'testu')
+        total = counter.count()
+        self.assertEqual(total, 13600)
+        random.seed(0)
+        hits = 0
+        for _ in range(100):
+            result = counter.estimate_count(samples=8, confidence=0.95)
+            self.assertEqual(result.sampled, 8)
+            self.assertLessEqual(result.low, result.estimate)
+            self.assertLessEqual(result.estimate, result.high)
+            hits += result.low <= total <= result.high
+        self.assertGreater(hits, 85)
+        counter.close()
+
+    def test_cache(self, client_mock):
+        counter = self._get_counter(client_mock, cache_ttl=60)
+        calls = lambda: sum(col.calls for col in counter.collections)
+        self.assertEqual(counter.count(prefix=['AD01']), 1000)
+        self.assertEqual(calls(), 16)
+        self.assertEqual(counter.count(prefix='AD01'), 1000)
+        self.assertEqual(calls(), 16)
+        self.assertEqual(counter.count(), 16000)
+        self.assertEqual(calls(), 32)
+        with patch('collection_scanner.counter.time.time', return_value=10 ** 11):
+            self.assertEqual(counter.count(), 16000)
+        self.assertEqual(calls(), 48)
+        counter.clear_cache()
+        counter.count()
+        self.assertEqual(calls(), 64)
+        counter.close()
+
+    def _expected_histogram(self, name, codelen, prefixes=()):
+        histogram = {}
+        for colname, samples in self.samples.items():
+            if colname.startswith(name + '_'):
+                for key, _ in samples:
+                    if not prefixes or key.startswith(tuple(prefixes)):
+                        histogram[key[:codelen]] = histogram.get(key[:codelen], 0) + 1
+        return histogram
+
+    def test_discover_prefixes(self, client_mock):
+        counter = self._get_counter(client_mock)
+        for codelen in (1, 3, 5):
+            self.assertEqual(counter.discover_prefixes(codelen), sorted(self._expected_histogram('testp', codelen)))
+        self.assertEqual(counter.discover_prefixes(5, prefix=['AD012', 'AD1']),
+                         sorted(self._expected_histogram('testp', 5, ['AD012', 'AD1'])))
+        self.assertEqual(list(counter.get_prefixes(3)), ['AD0', 'AD1'])
+        counter.close()
+
+    def test_discover_prefixes_block(self, client_mock):
+        counter = self._get_counter(client_mock, 'testu')
+        calls = lambda: sum(col.calls for col in counter.collections)
+        expected = sorted(self._expected_histogram('testu', 5))
+        self.assertEqual(counter.discover_prefixes(5), expected)
+        single_calls = calls()
+        self.assertEqual(counter.discover_prefixes(5, block=50), expected)
+        self.assertLess(calls() - single_calls, single_calls / 2)
+        counter.close()
+
+    def test_count_by_prefix(self, client_mock):
+        counter = self._get_counter(client_mock, 'testu')
+        histogram = counter.count_by_prefix(4)
+        self.assertEqual(list(histogram), sorted(histogram))
+        self.assertEqual(dict(histogram), self._expected_histogram('testu', 4))
+        self.assertEqual(dict(counter.count_by_prefix(5, prefix=['AD00'])),
+                         self._expected_histogram('testu', 5, ['AD00']))
+        # prefixes longer than codelen restrict the counts
+        self.assertEqual(dict(counter.count_by_prefix(3, prefix=['AD001', 'AD1'])),
+                         self._expected_histogram('testu', 3, ['AD001', 'AD1']))
+        counter.close()
+
+    def test_prefix_index(self, client_mock):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = PrefixIndex(os.path.join(tmpdir, 'prefixes.json'))
+            counter = self._get_counter(client_mock)
+            calls = lambda: sum(col.calls for col in counter.collections)
+            prefixes = counter.discover_prefixes(4, index=index)
+            first_calls = calls()
+            # reuses the saved level
+            self.assertEqual(counter.discover_prefixes(4, index=index), prefixes)
+            self.assertEqual(calls(), first_calls)
+            # starts from the saved level 4
+            self.assertEqual(counter.discover_prefixes(5, index=index), sorted(self._expected_histogram('testp', 5)))
+            self.assertEqual(index.load('testp', 5, {})[0], 5)
+            self.assertEqual(index.load('testp', 3, {}), (3, ['AD0', 'AD1']))
+            self.assertIsNone(index.load('testp', 3, {'prefix': ['AD1']}))
+            self.assertIsNone(index.load('testu', 3, {}))
+            counter.close()
+            # saves are durable, as checkpoint saves
+            with patch('collection_scanner.utils.os.fsync') as fsync:
+                index.save('testu', 1, {}, ['A'])
+            self.assertEqual(fsync.call_count, 1)
+            self.assertEqual(os.listdir(tmpdir), ['prefixes.json'])
@@ -0,0 +1,131 @@
+import os
+import gzip
+import json
+import tempfile
+import unittest
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner
+from collection_scanner.checkpoint import FileCheckpointStore
+from collection_scanner.export import JsonLinesSink, MsgpackSink, ParquetSink, export
+from collection_scanner.tests import FakeClient
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class FailingSink(JsonLinesSink):
+    def _write_chunk(self, records):
+        raise IOError('disk full')
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class ExportTest(TestCase):
+
+    samples = {
+        'test': [('AD%.3d' % i, {'field1': 'value 1-%.3d' % i}) for i in range(1000)],
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prev_env = os.environ
+        os.environ = dict(os.environ, SH_APIKEY='apikey', SHUB_JOBKEY='10/1/1')
+
+    def tearDown(self):
+        os.environ = self.prev_env
+        self.tmpdir.cleanup()
+
+    def _scanner(self, client_mock, **kwargs):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        return CollectionScanner('test', meta=['_key'], batchsize=100, **kwargs)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_jsonlines(self, client_mock):
+        with JsonLinesSink(self._path('export.jl'), chunk_size=64, queue_size=2) as sink:
+            self.assertEqual(export(self._scanner(client_mock), sink), 1000)
+        self.assertEqual(sink.files, [self._path('export.jl')])
+        self.assertEqual(sink.records, 1000)
+        with open(sink.files[0]) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0], {'_key': 'AD000', 'field1': 'value 1-000'})
+        self.assertEqual([r['_key'] for r in records], ['AD%.3d' % i for i in range(1000)])
+
+    def test_raw(self, client_mock):
+        with JsonLinesSink(self._path('export.jl')) as sink:
+            export(self._scanner(client_mock, raw=True), sink)
+        with open(sink.files[0]) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1000)
+        self.assertEqual(records[-1]['_key'], 'AD999')
+        self.assertEqual(records[-1]['field1'], 'value 1-999')
+
+    def test_compression_and_rotation(self, client_mock):
+        with self.assertRaises(ValueError):
+            JsonLinesSink(self._path('export.jl'), max_bytes=1000)
+        with self.assertRaises(ValueError):
+            JsonLinesSink(self._path('export.jl'), compression='rar')
+        with JsonLinesSink(self._path('export-{part:03d}.jl.gz'), compression='gzip', max_bytes=20000,
+                           chunk_size=100) as sink:
+            export(self._scanner(client_mock), sink)
+        self.assertGreater(len(sink.files), 1)
+        self.assertEqual(sink.files[1], self._path('export-001.jl.gz'))
+        keys = []
+        for path in sink.files:
+            with gzip.open(path, 'rt') as f:
+                keys.extend(json.loads(line)['_key'] for line in f)
+        self.assertEqual(keys, ['AD%.3d' % i for i in range(1000)])
+
+    def test_checkpoints_saved_after_write(self, client_mock):
+        store = FileCheckpointStore(self._path('checkpoints.json'))
+        saved = []
+        save = store.save
+
+        def checking_save(name, state):
+            # records up to the checkpointed key must be already in the file
+            with open(self._path('export.jl')) as f:
+                keys = [json.loads(line)['_key'] for line in f]
+            saved.append(state['lastkey'])
+            self.assertEqual(keys[-1], state['lastkey'])
+            save(name, state)
+        store.save = checking_save
+        scanner = self._scanner(client_mock, checkpoint_store=store, checkpoint_interval=3)
+        with JsonLinesSink(self._path('export.jl'), chunk_size=1000) as sink:
+            export(scanner, sink)
+        self.assertEqual(saved, ['AD299', 'AD599', 'AD899', 'AD999'])
+        self.assertFalse(store.load('test')['enabled'])
+
+    def test_writer_error(self, client_mock):
+        sink = FailingSink(self._path('export.jl'), chunk_size=10, queue_size=1)
+        with self.assertRaisesRegex(IOError, 'disk full'):
+            export(self._scanner(client_mock), sink)
+        with self.assertRaises(IOError):
+            sink.close()
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    def test_msgpack(self, client_mock):
+        with MsgpackSink(self._path('export.mp.xz'), compression='xz') as sink:
+            export(self._scanner(client_mock), sink)
+        import lzma
+        with lzma.open(sink.files[0]) as f:
+            records = list(msgpack.Unpacker(f, raw=False))
+        self.assertEqual(len(records), 1000)
+        self.assertEqual(records[-1], {'_key': 'AD999', 'field1': 'value 1-999'})
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow not installed')
+    def test_parquet(self, client_mock):
+        with ParquetSink(self._path('export.parquet'), chunk_size=300) as sink:
+            export(self._scanner(client_mock), sink)
+        table = pyarrow.parquet.read_table(sink.files[0])
+        self.assertEqual(table.num_rows, 1000)
+        self.assertEqual(table.column('_key').to_pylist()[-1], 'AD999')
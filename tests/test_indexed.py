@@ -0,0 +1,52 @@
+import random
+
+from unittest import TestCase
+
+from collection_scanner.tests import FakeCollection
+from collection_scanner.tests.indexed import IndexedFakeCollection, generate_samples, partition_samples
+
+
+class IndexedFakeCollectionTest(TestCase):
+    """
+    IndexedFakeCollection must issue the same records as FakeCollection
+    """
+    samples = generate_samples(500, record_size=10, keylen=4)
+
+    def _compare(self, **kwargs):
+        expected = list(FakeCollection('test', self.samples).get(**kwargs))
+        result = list(IndexedFakeCollection('test', self.samples).get(**kwargs))
+        self.assertEqual(result, expected, kwargs)
+
+    def test_get(self):
+        keys = sorted(key for key, _ in self.samples)
+        rand = random.Random(1)
+        self._compare(meta=['_key', '_ts'])
+        self._compare(meta=['_key'], count=[0])
+        for _ in range(50):
+            kwargs = {'meta': ['_key', '_ts'], 'count': [rand.randint(1, 100)]}
+            if rand.random() < 0.5:
+                kwargs['startafter'] = [rand.choice(keys)]
+            if rand.random() < 0.3:
+                kwargs['start'] = rand.choice(keys)
+            if rand.random() < 0.5:
+                kwargs['prefix'] = sorted(rand.sample('0123456789abcdef', 3))
+            if rand.random() < 0.3:
+                kwargs['startts'] = 1441940400000 + rand.randint(0, 500) * 3600000
+            if rand.random() < 0.3:
+                kwargs['endts'] = 1441940400000 + rand.randint(0, 500) * 3600000
+            self._compare(**kwargs)
+
+    def test_count(self):
+        indexed = IndexedFakeCollection('test', self.samples)
+        fake = FakeCollection('test', self.samples)
+        self.assertEqual(indexed.count(), 500)
+        self.assertEqual(indexed.count(prefix=['a', 'f']), fake.count(prefix=['a', 'f']))
+
+    def test_nodata(self):
+        records = list(IndexedFakeCollection('test', self.samples).get(nodata=1, meta=['_key'], count=1))
+        self.assertEqual(list(records[0]), ['_key'])
+
+    def test_partition_samples(self):
+        partitions = partition_samples('test', self.samples, 3)
+        self.assertEqual(sorted(partitions), ['test_0', 'test_1', 'test_2'])
+        self.assertEqual(sorted(s for p in partitions.values() for s in p), sorted(self.samples))
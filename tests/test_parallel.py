@@ -0,0 +1,81 @@
+import os
+import multiprocessing
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import ParallelCollectionScanner, CollectionCounter
+from collection_scanner.tests import FakeClient
+from collection_scanner.tests.indexed import IndexedFakeClient
+
+
+@patch('collection_scanner.counter.ScrapinghubClient')
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class ParallelCollectionScannerTest(TestCase):
+
+    samples = {
+        'test': [('%s%.3d' % (c, i), {'field1': 'value 1-%.3d' % i}) for c in 'ABCD' for i in range(250)],
+    }
+    for partition in range(4):
+        samples['testp_%d' % partition] = []
+    for i in range(4000):
+        samples['testp_%d' % (i % 4)].append(('AD%.4d' % i, {'field1': 'value 1-%.4d' % i}))
+
+    all_keys = ['AD%.4d' % i for i in range(4000)]
+
+    def setUp(self):
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+
+    def _get_scanner(self, scanner_mock, counter_mock, collection_name, **kwargs):
+        scanner_mock.return_value._hsclient = counter_mock.return_value._hsclient = FakeClient(self.samples)
+        return ParallelCollectionScanner(collection_name, mp_context=multiprocessing.get_context('fork'), **kwargs)
+
+    def test_discover_split_points(self, scanner_mock, counter_mock):
+        scanner = self._get_scanner(scanner_mock, counter_mock, 'test', processes=2, splits=4)
+        self.assertEqual(scanner.get_split_points(), ['B', 'C', 'D'])
+        scanner = self._get_scanner(scanner_mock, counter_mock, 'testp', processes=2, splits=4)
+        self.assertEqual(scanner.get_split_points(), ['AD1', 'AD2', 'AD3'])
+
+    def test_discover_split_points_incrementally(self, scanner_mock, counter_mock):
+        """
+        Each prefix length tried goes on from the previous one, so the discovery costs as much as a single one of
+        the final length
+        """
+        client = IndexedFakeClient(self.samples)
+        scanner_mock.return_value._hsclient = counter_mock.return_value._hsclient = client
+        calls = lambda: sum(store.calls for store in client.get_project().collections.stores.values())
+        scanner = ParallelCollectionScanner('testp', processes=2, splits=4)
+        self.assertEqual(scanner.get_split_points(), ['AD1', 'AD2', 'AD3'])
+        discovery_calls = calls()
+        CollectionCounter('testp').discover_prefixes(3)
+        self.assertEqual(discovery_calls, calls() - discovery_calls)
+
+    def test_ordered(self, scanner_mock, counter_mock):
+        scanner = self._get_scanner(scanner_mock, counter_mock, 'testp', processes=2, splits=4, meta=['_key'],
+                                    batchsize=300)
+        keys = [r['_key'] for batch in scanner.scan_collection_batches(ordered=True) for r in batch]
+        self.assertEqual(keys, self.all_keys)
+        self.assertEqual(scanner.scanned_count, 4000)
+
+    def test_unordered(self, scanner_mock, counter_mock):
+        scanner = self._get_scanner(scanner_mock, counter_mock, 'testp', processes=3, splits=5, meta=['_key'],
+                                    split_points=['AD0500', 'AD1234', 'AD2000', 'AD3999'])
+        keys = [r['_key'] for batch in scanner.scan_collection_batches() for r in batch]
+        self.assertEqual(len(keys), 4000)
+        self.assertEqual(sorted(keys), self.all_keys)
+
+    def test_limits(self, scanner_mock, counter_mock):
+        scanner = self._get_scanner(scanner_mock, counter_mock, 'testp', processes=2, splits=4, meta=['_key'],
+                                    split_codelen=4, startafter='AD0999', stopbefore='AD3500',
+                                    exclude_prefixes=['AD20'])
+        keys = [r['_key'] for batch in scanner.scan_collection_batches(ordered=True) for r in batch]
+        self.assertEqual(keys, [k for k in self.all_keys if 'AD0999' < k < 'AD3500' and not k.startswith('AD20')])
+
+    def test_count_not_supported(self, scanner_mock, counter_mock):
+        with self.assertRaises(ValueError):
+            self._get_scanner(scanner_mock, counter_mock, 'testp', count=10)
@@ -0,0 +1,83 @@
+import os
+import pstats
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner
+from collection_scanner.profiling import get_profile_mode
+from collection_scanner.tests import FakeClient
+from collection_scanner.tests.indexed import IndexedFakeClient
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class ProfilingTest(TestCase):
+
+    samples = {
+        'prof_%d' % p: [('AD%.3d' % i, {'field1': 'value 1-%.3d' % i}) for i in range(p, 300, 2)] for p in range(2)
+    }
+    samples['prof2'] = [('AD%.3d' % i, {'field2': i}) for i in range(0, 300, 3)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.prev_env = os.environ
+        os.environ = dict(os.environ, SH_APIKEY='apikey', SHUB_JOBKEY='10/1/1')
+        os.environ.pop('COLLECTION_SCANNER_PROFILE', None)
+
+    def tearDown(self):
+        os.environ = self.prev_env
+        self.tmpdir.cleanup()
+
+    def _scan(self, client_mock, client_class=FakeClient, **kwargs):
+        client_mock.return_value._hsclient = client_class(self.samples)
+        scanner = CollectionScanner('prof', batchsize=100, max_next_records=50, **kwargs)
+        records = [r for batch in scanner.scan_collection_batches() for r in batch]
+        scanner.close()
+        self.assertEqual(len(records), 300)
+        return scanner.stats.as_dict()['stage_seconds']
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_profile_mode(self, client_mock):
+        self.assertEqual(get_profile_mode(), None)
+        self.assertEqual(get_profile_mode(True), 'stages')
+        self.assertEqual(get_profile_mode(False), None)
+        os.environ['COLLECTION_SCANNER_PROFILE'] = '1'
+        self.assertEqual(get_profile_mode(), 'stages')
+        self.assertEqual(get_profile_mode(False), None)
+        os.environ['COLLECTION_SCANNER_PROFILE'] = 'sampling'
+        self.assertEqual(get_profile_mode(), 'sampling')
+        with self.assertRaises(ValueError):
+            get_profile_mode('perf')
+
+    def test_stages(self, client_mock):
+        self.assertEqual(self._scan(client_mock), {})
+        stages = self._scan(client_mock, profile=True, secondary_collections=['prof2'])
+        self.assertEqual(set(stages), {'fetch', 'merge', 'read', 'join', 'filter', 'consumer'})
+        self.assertTrue(all(seconds >= 0 for seconds in stages.values()))
+
+    def test_stages_read_ahead(self, client_mock):
+        os.environ['COLLECTION_SCANNER_PROFILE'] = 'stages'
+        stages = self._scan(client_mock, prefetch=2)
+        self.assertEqual(set(stages), {'fetch', 'merge', 'read', 'filter', 'consumer'})
+        self.assertTrue(all(seconds >= 0 for seconds in stages.values()))
+
+    def test_cprofile(self, client_mock):
+        self._scan(client_mock, profile='cprofile', profile_path=self._path('scan-{pid}.prof'))
+        path = self._path('scan-{}.prof'.format(os.getpid()))
+        functions = [func[2] for func in pstats.Stats(path).stats]
+        self.assertIn('get_new_batch', functions)
+        with open(path + '.txt') as f:
+            self.assertIn('cumulative', f.read())
+
+    def test_sampling(self, client_mock):
+        os.environ['COLLECTION_SCANNER_PROFILE'] = 'sampling'
+        os.environ['COLLECTION_SCANNER_PROFILE_PATH'] = self._path('scan.stacks')
+        self._scan(client_mock, client_class=lambda samples: IndexedFakeClient(samples, latency=0.01))
+        with open(self._path('scan.stacks')) as f:
+            stacks = dict(line.rsplit(' ', 1) for line in f)
+        self.assertTrue(any(stack.startswith('MainThread;') and 'get_new_batch (scanner.py:' in stack
+                            for stack in stacks))
+        self.assertTrue(all(int(count) > 0 for count in stacks.values()))
@@ -0,0 +1,131 @@
+import os
+import multiprocessing
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner, CollectionCounter
+from collection_scanner.registry import CollectionRegistry, registry
+from collection_scanner.tests import FakeClient
+
+
+class CountingClient(FakeClient):
+    """
+    Counts the collections listings
+    """
+    def get_project(self, *args):
+        project = super().get_project(*args)
+        if not hasattr(project.collections, 'listings'):
+            collections = project.collections
+            collections.listings = 0
+            apiget = collections.apiget
+
+            def counting_apiget(call):
+                collections.listings += 1
+                return apiget(call)
+            collections.apiget = counting_apiget
+        return project
+
+
+class EndpointClient(CountingClient):
+    """
+    Identifies its projects by endpoint, as real clients do
+    """
+    endpoint = 'http://storage.example.com/'
+
+    def get_project(self, *args):
+        project = super().get_project(*args)
+        project.projectid = '10'
+        project.auth = 'apikey'
+        return project
+
+
+def _count_stores():
+    return len(registry._stores), len(registry._entries)
+
+
+class CollectionRegistryTest(TestCase):
+    samples = {
+        'test': [('AD%.3d' % i, {'field1': i}) for i in range(10)],
+        'test2': [('AD%.3d' % i, {'field2': i}) for i in range(10)],
+        'testp_0': [], 'testp_1': [], 'testp_2': [],
+        'testq_0': [], 'testq_2': [],
+        'testr_1_0': [],
+    }
+
+    def test_partitions(self):
+        hsp = CountingClient(self.samples).get_project()
+        reg = CollectionRegistry()
+        self.assertEqual(reg.get_num_partitions(hsp, 'testp'), 3)
+        self.assertIsNone(reg.get_num_partitions(hsp, 'testq'))
+        self.assertIsNone(reg.get_num_partitions(hsp, 'test'))
+        self.assertIsNone(reg.get_num_partitions(hsp, 'testr'))
+        self.assertEqual(reg.get_num_partitions(hsp, 'testr_1'), 1)
+        self.assertEqual(reg.filter_collections_exist(hsp, ['test2', 'test3', 'test']), ['test', 'test2'])
+        self.assertIs(reg.get_store(hsp, 'test'), reg.get_store(hsp, 'test'))
+        self.assertEqual(hsp.collections.listings, 1)
+
+    def test_ttl_and_invalidate(self):
+        hsp = CountingClient(self.samples).get_project()
+        reg = CollectionRegistry(ttl=60)
+        reg.list_collections(hsp)
+        reg.list_collections(hsp)
+        self.assertEqual(hsp.collections.listings, 1)
+        with patch('collection_scanner.registry.time.time', return_value=10 ** 11):
+            reg.list_collections(hsp)
+        self.assertEqual(hsp.collections.listings, 2)
+        reg.invalidate(hsp)
+        reg.list_collections(hsp)
+        self.assertEqual(hsp.collections.listings, 3)
+
+    def test_clients_not_shared(self):
+        reg = CollectionRegistry()
+        hsp1 = CountingClient(self.samples).get_project()
+        hsp2 = CountingClient({'other': []}).get_project()
+        self.assertEqual(reg.filter_collections_exist(hsp1, ['test']), ['test'])
+        self.assertEqual(reg.filter_collections_exist(hsp2, ['test']), [])
+
+    def test_stores_not_shared_by_clients(self):
+        reg = CollectionRegistry()
+        hsp1 = EndpointClient(self.samples).get_project()
+        hsp2 = EndpointClient(self.samples).get_project()
+        reg.list_collections(hsp1)
+        reg.list_collections(hsp2)
+        # the listing is shared by clients of the same endpoint and auth, but not the store handles
+        self.assertEqual((hsp1.collections.listings, hsp2.collections.listings), (1, 0))
+        self.assertIs(reg.get_store(hsp1, 'test'), hsp1.collections.new_store('test'))
+        self.assertIs(reg.get_store(hsp2, 'test'), hsp2.collections.new_store('test'))
+        self.assertIsNot(reg.get_store(hsp1, 'test'), reg.get_store(hsp2, 'test'))
+        reg.invalidate(hsp1)
+        self.assertEqual(reg._stores[hsp1.client], {})
+        self.assertEqual(len(reg._stores[hsp2.client]), 1)
+
+    def test_reset_after_fork(self):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            self.skipTest('fork not available')
+        hsp = EndpointClient(self.samples).get_project()
+        registry.get_store(hsp, 'test')
+        registry.list_collections(hsp)
+        try:
+            with multiprocessing.get_context('fork').Pool(1) as pool:
+                self.assertEqual(pool.apply(_count_stores), (0, 0))
+            self.assertIn(hsp.client, registry._stores)
+        finally:
+            registry.invalidate()
+
+    @patch('collection_scanner.counter.ScrapinghubClient')
+    @patch('collection_scanner.scanner.ScrapinghubClient')
+    def test_shared_by_scanners_and_counters(self, scanner_mock, counter_mock):
+        prev_env = os.environ
+        os.environ = dict(os.environ, SH_APIKEY='apikey', SHUB_JOBKEY='10/1/1')
+        try:
+            client = CountingClient(self.samples)
+            scanner_mock.return_value._hsclient = counter_mock.return_value._hsclient = client
+            for _ in range(5):
+                scanner = CollectionScanner('test', secondary_collections=['test2'])
+                self.assertEqual(len(list(scanner.scan_collection_batches())), 1)
+                CollectionCounter('testp').count()
+            self.assertEqual(client.get_project().collections.listings, 1)
+        finally:
+            os.environ = prev_env
+            registry.invalidate()
@@ -0,0 +1,93 @@
+import os
+import json
+import tempfile
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from requests.exceptions import ChunkedEncodingError
+from scrapinghub import ScrapinghubClient
+from scrapinghub.hubstorage.resourcetype import DownloadableResource
+
+from collection_scanner import CollectionScanner, CollectionCounter
+from collection_scanner.raw import iter_raw_records
+from collection_scanner.scanner import _CachedBlocksCollection
+from collection_scanner.tests.indexed import generate_samples, partition_samples
+from collection_scanner.tests.server import CollectionsServer, write_collection
+
+
+class CollectionsServerTest(TestCase):
+    """
+    End to end tests of scanner and counter through the http stand-in server
+    """
+    samples = generate_samples(1000, record_size=20, keylen=6)
+
+    def setUp(self):
+        self.prev_env = os.environ.copy()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        write_collection(self.tmpdir.name, 'test', self.samples, partitions=3)
+        write_collection(self.tmpdir.name, 'test2', self.samples[::4])
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.prev_env)
+        self.tmpdir.cleanup()
+
+    def _serve(self, **kwargs):
+        server = CollectionsServer.from_directory(self.tmpdir.name, **kwargs)
+        os.environ['SHUB_STORAGE'] = server.url
+        return server
+
+    def _scan(self, **kwargs):
+        scanner = CollectionScanner('test', project_id='10', apikey='apikey', batchsize=300, max_next_records=200,
+                                    meta=['_key'], **kwargs)
+        records = [r for batch in scanner.scan_collection_batches() for r in batch]
+        scanner.close()
+        return records
+
+    def test_scan(self):
+        with self._serve():
+            records = self._scan(secondary_collections=['test2'], prefix=['a', 'b'])
+        expected = sorted(key for key, _ in self.samples if key[0] in 'ab')
+        self.assertEqual([r['_key'] for r in records], expected)
+        secondary_keys = {key for key, _ in self.samples[::4]}
+        self.assertEqual(sum(1 for r in records if r['_key'] in secondary_keys), len(secondary_keys & set(expected)))
+        self.assertTrue(all(r['field'] for r in records))
+
+    def test_get_key(self):
+        key = sorted(key for key, _ in partition_samples('test', self.samples, 3)['test_0'])[1]
+        with self._serve() as server:
+            url = '{}/collections/10/s/test_0/{}?count=5&start=0&meta=_key'.format(server.url, key)
+            with urlopen(url) as response:
+                records = [json.loads(line) for line in response]
+            with self.assertRaises(HTTPError) as cm:
+                urlopen('{}/collections/10/s/test_0/missing?count=5'.format(server.url))
+        self.assertEqual([r['_key'] for r in records], [key])
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_count(self):
+        with self._serve():
+            counter = CollectionCounter('test', project_id='10', apikey='apikey')
+            self.assertEqual(counter.count(), 1000)
+            self.assertEqual(counter.count(prefix=['a']), sum(1 for key, _ in self.samples if key.startswith('a')))
+            counter.hsc.close()
+
+    @patch.object(_CachedBlocksCollection, 'RETRY_WAIT', 0)
+    def test_disconnects(self):
+        with self._serve(disconnect_rate=0.2, seed=0):
+            records = self._scan()
+        self.assertEqual([r['_key'] for r in records], sorted(key for key, _ in self.samples))
+
+    @patch.object(DownloadableResource, 'MAX_RETRIES', 1)
+    @patch.object(DownloadableResource, 'RETRY_INTERVAL', 0)
+    def test_raw_read_errors(self):
+        # cut raw reads raise, so the scanner retries them, instead of ending them silently as iter_json() does
+        with self._serve(disconnect_rate=1):
+            hsc = ScrapinghubClient('apikey')._hsclient
+            store = hsc.get_project('10').collections.new_store('test_0')
+            self.assertLess(len(list(store.iter_json(count=[200], meta=['_key']))), 200)
+            with self.assertRaises(ChunkedEncodingError):
+                list(iter_raw_records(store, count=[200], meta=['_key']))
+            hsc.close()
@@ -0,0 +1,112 @@
+import os
+import json
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from collection_scanner import CollectionScanner
+from collection_scanner.scanner import _CachedBlocksCollection
+from collection_scanner.stats import ScanHook, ScanStats, LatencyHistogram
+from collection_scanner.tests import FakeClient, FlakyCollection
+
+
+class RecorderHook(ScanHook):
+    def __init__(self):
+        self.events = []
+
+    def on_request(self, colname, requested, records, seconds):
+        self.events.append(('request', colname, requested, len(records)))
+
+    def on_retry(self, colname, attempt, exception, delay):
+        self.events.append(('retry', colname, attempt))
+
+    def on_batch(self, stats):
+        self.events.append(('batch', stats.scanned))
+
+    def on_close(self, stats):
+        self.events.append(('close', stats.scanned))
+
+
+class LatencyHistogramTest(TestCase):
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(50), None)
+        for seconds in [0.005] * 90 + [0.3] * 9 + [20]:
+            histogram.add(seconds)
+        self.assertEqual(histogram.percentile(50), 0.01)
+        self.assertEqual(histogram.percentile(90), 0.01)
+        self.assertEqual(histogram.percentile(99), 0.5)
+        self.assertEqual(histogram.percentile(100), 30)
+        self.assertEqual(histogram.as_dict()['buckets'], {'0.01': 90, '0.5': 9, '30': 1})
+
+
+@patch('collection_scanner.scanner.ScrapinghubClient')
+class ScanStatsTest(TestCase):
+
+    samples = {
+        'test': [('AD%.3d' % i, {'field1': 'value 1-%.3d' % i}) for i in range(100)],
+        'test2': [('AD%.3d' % i, {'field2': 'value 2-%.3d' % i}) for i in range(0, 100, 4)],
+    }
+
+    def setUp(self):
+        self.prev_env = os.environ
+        os.environ['SH_APIKEY'] = 'apikey'
+        os.environ['SHUB_JOBKEY'] = '10/1/1'
+
+    def tearDown(self):
+        os.environ = self.prev_env
+
+    def test_stats(self, client_mock):
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        hook = RecorderHook()
+        scanner = CollectionScanner('test', batchsize=30, max_next_records=20, exclude_prefixes=['AD05'],
+                                    secondary_collections=['test2'], hooks=[hook])
+        batches = list(scanner.scan_collection_batches())
+        scanner.close()
+        self.assertEqual(sum(len(b) for b in batches), 90)
+        # secondary collections given to an instance do not leak into the class default
+        self.assertEqual(CollectionScanner.secondary_collections, [])
+
+        stats = scanner.stats.as_dict()
+        json.dumps(stats)
+        self.assertEqual(stats['scanned'], 90)
+        self.assertEqual(stats['batches'], 4)
+        self.assertEqual(stats['exclude_jumps'], 1)
+        self.assertEqual(stats['secondary_lookups'], 90)
+        self.assertEqual(stats['secondary_hit_rate'], {'test2': 23 / 90})
+        self.assertEqual(stats['read_bytes'], None)
+        self.assertEqual(set(stats['requests']), {'test', 'test2'})
+        self.assertEqual(stats['latency']['count'], sum(stats['requests'].values()))
+
+        kinds = [event[0] for event in hook.events]
+        self.assertEqual(kinds.count('batch'), 4)
+        self.assertEqual(hook.events[-1], ('close', 90))
+        self.assertIn(('request', 'test', 20, 20), hook.events)
+
+    def test_measure_bytes(self, client_mock):
+        stats = ScanStats(measure_bytes=True)
+        stats.on_request('test', 2, [{'_key': 'a'}, {'_key': 'b'}], 0.1)
+        self.assertEqual(stats.as_dict()['read_bytes'], 2 * len(json.dumps({'_key': 'a'})))
+        client_mock.return_value._hsclient = FakeClient(self.samples)
+        scanner = CollectionScanner('test', measure_bytes=True)
+        list(scanner.scan_collection_batches())
+        stats = scanner.stats.as_dict()
+        self.assertGreater(stats['read_bytes'], 100 * len('{"field1": "value 1-000"}'))
+        self.assertGreater(stats['read_bytes_per_second'], 0)
+
+
+@patch.object(_CachedBlocksCollection, 'RETRY_WAIT', 0)
+class RetryHookTest(TestCase):
+    samples = [('AD%.3d' % i, {'_key': 'AD%.3d' % i}) for i in range(50)]
+
+    def test_on_retry(self):
+        col = _CachedBlocksCollection(FakeClient({'test': self.samples}).get_project(), 'test')
+        col.collections = [FlakyCollection('test', self.samples, failures=2, fail_after=10)]
+        hook = RecorderHook()
+        stats = ScanStats()
+        col.hooks.extend([hook, stats])
+        keys = [r['_key'] for r in col.get(count=[50], startafter=[None], meta=['_key'])]
+        self.assertEqual(len(keys), 50)
+        self.assertEqual([e for e in hook.events if e[0] == 'retry'], [('retry', 'test', 1), ('retry', 'test', 1)])
+        self.assertEqual(stats.retries['test'], 2)
+        self.assertEqual(hook.events[-1], ('request', 'test', 50, 50))